@@ -3,22 +3,22 @@ from typing import List, Optional
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy import select
-from sqlalchemy.orm import Session, subqueryload
+from sqlalchemy.orm import Session
 
 from .config import settings
+from .crud import ATTR_DEFS_LOADER
 from .database import SessionLocal
 from .enum import FilterEnum
 from .dynamic_routes import create_dynamic_router
 from .models import Schema, AttributeDefinition, AttrType
 from .general_routes import router
+from .instrumentation import InstrumentationMiddleware, metrics
+from .serialization import json_response_class
 
 
 def load_schemas(db: Session) -> List[models.Schema]:
     schemas = db.execute(
-        select(Schema)
-        .options(
-            subqueryload(Schema.attr_defs)
-        )
+        select(Schema).options(ATTR_DEFS_LOADER)
     ).scalars().all()
     return schemas
 
@@ -41,7 +41,8 @@ def load_dynamic_routes(db: Session, app: FastAPI):
 
 
 def create_app(session: Optional[Session] = None) -> FastAPI:
-    app = FastAPI(description=generate_api_description())
+    app = FastAPI(description=generate_api_description(),
+                  default_response_class=json_response_class())
     origins = ['*']
     app.add_middleware(CORSMiddleware,
         allow_origins=origins,
@@ -56,4 +57,8 @@ def create_app(session: Optional[Session] = None) -> FastAPI:
             load_dynamic_routes(db=db, app=app)
 
     app.include_router(router)
+    if settings.instrumentation or settings.slow_query_ms:
+        app.add_middleware(InstrumentationMiddleware)
+    if settings.instrumentation and settings.metrics_endpoint:
+        app.add_route('/metrics', metrics, include_in_schema=False)
     return app
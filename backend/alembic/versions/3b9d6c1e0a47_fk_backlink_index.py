@@ -0,0 +1,24 @@
+"""Index on values_fk for reverse reference lookups
+
+Revision ID: 3b9d6c1e0a47
+Revises: cf05edca26d8
+Create Date: 2026-10-19 09:12:44.310582
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '3b9d6c1e0a47'
+down_revision = 'cf05edca26d8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_values_fk_value_attribute_id', 'values_fk', ['value', 'attribute_id'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_values_fk_value_attribute_id', table_name='values_fk')
@@ -0,0 +1,24 @@
+"""Index on values_fk for forward graph traversal
+
+Revision ID: 9f2e47b5c3d1
+Revises: 3b9d6c1e0a47
+Create Date: 2026-10-19 10:03:17.892214
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '9f2e47b5c3d1'
+down_revision = '3b9d6c1e0a47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_values_fk_entity_id_attribute_id', 'values_fk',
+                    ['entity_id', 'attribute_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_values_fk_entity_id_attribute_id', table_name='values_fk')
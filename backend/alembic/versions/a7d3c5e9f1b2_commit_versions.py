@@ -0,0 +1,44 @@
+"""Versions of entities assigned when their transaction commits
+
+Revision ID: a7d3c5e9f1b2
+Revises: e5f2a8c1d9b4
+Create Date: 2026-10-20 09:12:44.301827
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7d3c5e9f1b2'
+down_revision = 'e5f2a8c1d9b4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Deferred triggers run while the transaction commits. The advisory lock is held until
+    # the commit is done, so transactions take versions one at a time in order of commits
+    # and a version is never visible before all lower ones are. The update made by the
+    # trigger itself runs at trigger depth 1, so it doesn't queue the trigger again.
+    op.execute("""
+        create or replace function entities_commit_version() returns trigger as $$
+        begin
+            perform pg_advisory_xact_lock(hashtext('entities_version_seq'));
+            update entities set version = nextval('entities_version_seq') where id = new.id;
+            return null;
+        end
+        $$ language plpgsql;
+
+        create constraint trigger entities_commit_version
+        after insert or update on entities
+        deferrable initially deferred
+        for each row when (pg_trigger_depth() = 0)
+        execute function entities_commit_version();
+        """)
+
+
+def downgrade():
+    op.execute("""
+        drop trigger entities_commit_version on entities;
+        drop function entities_commit_version();
+        """)
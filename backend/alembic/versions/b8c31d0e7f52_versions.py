@@ -0,0 +1,37 @@
+"""Version counters and modification time of schemas and entities
+
+Revision ID: b8c31d0e7f52
+Revises: 9f2e47b5c3d1
+Create Date: 2026-10-19 11:40:02.518734
+
+"""
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.schema import CreateSequence, DropSequence
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8c31d0e7f52'
+down_revision = '9f2e47b5c3d1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for table in ('schemas', 'entities'):
+        seq = f'{table}_version_seq'
+        op.execute(CreateSequence(sa.Sequence(seq)))
+        op.add_column(table, sa.Column('version', sa.BigInteger(), nullable=False,
+                                       server_default=sa.text(f"nextval('{seq}')")))
+        op.add_column(table, sa.Column('updated_at', sa.DateTime(timezone=True), nullable=False,
+                                       server_default=sa.func.now()))
+    op.create_index('ix_entities_schema_id_version', 'entities', ['schema_id', 'version'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_entities_schema_id_version', table_name='entities')
+    for table in ('schemas', 'entities'):
+        op.drop_column(table, 'updated_at')
+        op.drop_column(table, 'version')
+        op.execute(DropSequence(sa.Sequence(f'{table}_version_seq')))
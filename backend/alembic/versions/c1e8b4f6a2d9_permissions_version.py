@@ -0,0 +1,25 @@
+"""Version of effective permissions of users
+
+Revision ID: c1e8b4f6a2d9
+Revises: a7d3c5e9f1b2
+Create Date: 2026-10-20 11:03:27.640158
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c1e8b4f6a2d9'
+down_revision = 'a7d3c5e9f1b2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('users', sa.Column('permissions_version', sa.Integer(), nullable=False,
+                                     server_default='0'))
+
+
+def downgrade():
+    op.drop_column('users', 'permissions_version')
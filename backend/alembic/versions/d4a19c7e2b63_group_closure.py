@@ -0,0 +1,48 @@
+"""Closure table of group ancestors
+
+Revision ID: d4a19c7e2b63
+Revises: b8c31d0e7f52
+Create Date: 2026-10-19 15:12:40.337125
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4a19c7e2b63'
+down_revision = 'b8c31d0e7f52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'group_closure',
+        sa.Column('ancestor_id', sa.Integer(), nullable=False),
+        sa.Column('descendant_id', sa.Integer(), nullable=False),
+        sa.Column('depth', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['ancestor_id'], ['groups.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['descendant_id'], ['groups.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('ancestor_id', 'descendant_id')
+    )
+    op.create_index('ix_group_closure_descendant_id', 'group_closure',
+                    ['descendant_id', 'ancestor_id'], unique=False)
+    op.execute("""
+        with recursive closure(ancestor_id, descendant_id, depth) as (
+            select id, id, 0 from groups
+            union all
+            select groups.parent_id, closure.descendant_id, closure.depth + 1
+            from closure join groups on groups.id = closure.ancestor_id
+            where groups.parent_id is not null
+              and closure.depth < (select count(*) from groups)
+        )
+        insert into group_closure (ancestor_id, descendant_id, depth)
+        select ancestor_id, descendant_id, min(depth) from closure
+        group by ancestor_id, descendant_id;
+    """)
+
+
+def downgrade():
+    op.drop_index('ix_group_closure_descendant_id', table_name='group_closure')
+    op.drop_table('group_closure')
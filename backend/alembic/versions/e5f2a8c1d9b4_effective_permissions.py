@@ -0,0 +1,52 @@
+"""Effective permissions of users
+
+Revision ID: e5f2a8c1d9b4
+Revises: d4a19c7e2b63
+Create Date: 2026-10-19 17:41:08.915362
+
+"""
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5f2a8c1d9b4'
+down_revision = 'd4a19c7e2b63'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'effective_permissions',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('permission_id', sa.Integer(), nullable=False),
+        sa.Column('permission', postgresql.ENUM(name='permissiontype', create_type=False),
+                  nullable=False),
+        sa.Column('obj_type', postgresql.ENUM(name='permissiontargettype', create_type=False),
+                  nullable=True),
+        sa.Column('obj_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['permission_id'], ['permissions.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('user_id', 'permission_id')
+    )
+    op.create_index('ix_effective_permissions_lookup', 'effective_permissions',
+                    ['user_id', 'permission', 'obj_type', 'obj_id'], unique=False)
+    op.execute("""
+        insert into effective_permissions (user_id, permission_id, permission, obj_type, obj_id)
+        select recipient_id, id, permission, obj_type, obj_id from permissions
+        where recipient_type = 'USER'
+        union
+        select user_groups.user_id, permissions.id, permissions.permission,
+               permissions.obj_type, permissions.obj_id
+        from permissions
+        join group_closure on group_closure.ancestor_id = permissions.recipient_id
+        join user_groups on user_groups.group_id = group_closure.descendant_id
+        where permissions.recipient_type = 'GROUP';
+    """)
+
+
+def downgrade():
+    op.drop_index('ix_effective_permissions_lookup', table_name='effective_permissions')
+    op.drop_table('effective_permissions')
@@ -1,8 +1,11 @@
+import logging
 import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from typing import Optional,  Tuple, Callable
 
 from fastapi import HTTPException, Depends, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from sqlalchemy.exc import NoResultFound
@@ -15,18 +18,32 @@ from ..database import get_db
 from ..models import Schema, Entity
 from ..schemas.auth import RequirePermission
 from .backends import get
+from .backends.abstract import AbstractBackend
 from .crud import get_user, has_permission
 from .enum import PermissionType
 from .models import User, Group
+from .tokens import token_cache
 
 
+logger = logging.getLogger(__name__)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl=s.token_url, auto_error=True)
 
 
+def _prefetch(backend: AbstractBackend, username: str, password: str):
+    try:
+        backend.prefetch(username=username, password=password)
+    except Exception:
+        # `authenticate` tries again, if this backend gets its turn
+        logger.warning('Prefetch of %s failed', backend.__class__.__module__, exc_info=True)
+
+
 def authenticate_user(db: Session, username: str, password: str) -> Optional[User]:
-    _enabled_backends = get()
-    for backend_class in _enabled_backends:
-        backend = backend_class(db=db)
+    backends = [backend_class(db=db) for backend_class in get()]
+    if len(backends) > 1:
+        with ThreadPoolExecutor(max_workers=len(backends)) as executor:
+            for backend in backends:
+                executor.submit(_prefetch, backend, username, password)
+    for backend in backends:
         user = backend.authenticate(username=username, password=password)
         if user and user.is_active:
             return user
@@ -41,6 +58,10 @@ def create_access_token(data: dict, expires_delta: timedelta) -> Tuple[str, date
 
 async def authenticated_user(token: str = Depends(oauth2_scheme),
                              db: Session = Depends(get_db)) -> User:
+    cached = token_cache.get(token)
+    if cached is not None:
+        return cached.to_user(db)
+
     credentials_exception = HTTPException(
         status_code=HTTP_401_UNAUTHORIZED,
         detail='Could not validate credentials',
@@ -53,12 +74,24 @@ async def authenticated_user(token: str = Depends(oauth2_scheme),
             raise credentials_exception
     except JWTError:
         raise credentials_exception
-    user = get_user(db=db, username=username)
+    user = await run_in_threadpool(get_user, db=db, username=username)
     if user is None:
         raise credentials_exception
+    if 'exp' in payload:
+        token_cache.set(token, user, expires=payload['exp'])
     return user
 
 
+async def reading_user(request: Request, db: Session = Depends(get_db)) -> Optional[User]:
+    '''Returns authenticated user for routes, which list only readable entities if
+    `settings.enforce_read_permissions` is on, `None` without authentication otherwise
+    '''
+    if not s.enforce_read_permissions:
+        return None
+    token = await oauth2_scheme(request)
+    return await authenticated_user(token=token, db=db)
+
+
 def authorized_user(required_permission: RequirePermission) -> Callable:
     def schema_slug_from_entity_url(request: Request) -> str:
         match = re.search("/entity/(?P<schema_slug>[^/]+)/", request.url.path)
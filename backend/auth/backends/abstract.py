@@ -13,6 +13,11 @@ class AbstractBackend(ABC):
     def __init__(self, db: Session):
         self.db = db
 
+    def prefetch(self, username: str, password: str):
+        '''Does the slow part of `authenticate`, which doesn't need the database, ahead.
+        If several backends are configured, it's called concurrently for all of them
+        '''
+
     @abstractmethod
     def authenticate(self, username: str, password: str) -> Optional[User]:
         return NotImplemented
@@ -1,7 +1,12 @@
-from functools import cached_property
-from typing import Optional, Any
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Optional, Any, Callable, Dict, Iterator, Tuple
 
 from ldap3 import Server, Connection, LEVEL, ALL_ATTRIBUTES, SYNC, Entry
+from ldap3.core.exceptions import LDAPBindError, LDAPResponseTimeoutError
 
 from ...config import settings
 from ...schemas.auth import UserCreateSchema
@@ -10,10 +15,106 @@ from ..models import User
 from .abstract import AbstractBackend
 
 
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool:
+    '''Keeps connections to directory open between logins. At most `size` connections
+    are in use at once, connections, which are closed, failed while in use or are older
+    than `lifetime` seconds, are replaced by new ones
+    '''
+    def __init__(self, factory: Callable[[], Connection], size: int, lifetime: int,
+                 healthy: Callable[[Connection], bool] = lambda conn: not conn.closed):
+        self._factory = factory
+        self._healthy = healthy
+        self.lifetime = lifetime
+        self._idle: deque[Tuple[float, Connection]] = deque()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _checkout(self) -> Tuple[float, Connection]:
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                created, conn = self._idle.pop()
+            if self._healthy(conn) and time.monotonic() - created < self.lifetime:
+                return created, conn
+            self._discard(conn)
+        return time.monotonic(), self._factory()
+
+    @staticmethod
+    def _discard(conn: Connection):
+        try:
+            conn.unbind()
+        except Exception:
+            logger.debug('Could not close LDAP connection', exc_info=True)
+
+    @contextmanager
+    def connection(self) -> Iterator[Connection]:
+        if not self._slots.acquire(timeout=settings.ldap.timeout):
+            raise LDAPResponseTimeoutError('Timed out waiting for a free LDAP connection')
+        try:
+            created, conn = self._checkout()
+            try:
+                yield conn
+            except BaseException:
+                self._discard(conn)
+                raise
+            with self._lock:
+                self._idle.append((created, conn))
+        finally:
+            self._slots.release()
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, deque()
+        for _, conn in idle:
+            self._discard(conn)
+
+
+class DirectoryCache:
+    '''Directory data of users for `settings.ldap.cache_ttl` seconds'''
+    def __init__(self):
+        self._data: OrderedDict[str, Tuple[float, UserCreateSchema]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, username: str) -> Optional[UserCreateSchema]:
+        with self._lock:
+            item = self._data.get(username)
+            if item is None or item[0] <= time.monotonic():
+                self._data.pop(username, None)
+                return None
+            self._data.move_to_end(username)
+            return item[1]
+
+    def set(self, username: str, user_data: UserCreateSchema):
+        if settings.ldap.cache_ttl <= 0:
+            return
+        with self._lock:
+            self._data[username] = (time.monotonic() + settings.ldap.cache_ttl, user_data)
+            self._data.move_to_end(username)
+            while len(self._data) > settings.ldap.cache_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
 class Backend(AbstractBackend):
     _server = Server(host=settings.ldap.host,
                      use_ssl=settings.ldap.use_ssl,
                      connect_timeout=settings.ldap.timeout)
+    client_strategy = SYNC
+    directory_cache = DirectoryCache()
+    _pools: Dict[str, ConnectionPool] = {}
+    _pools_lock = threading.Lock()
+
+    def __init__(self, db):
+        super().__init__(db=db)
+        # results of `prefetch` by username
+        self._verified: Dict[str, Optional[UserCreateSchema]] = {}
 
     @staticmethod
     def search_string(username: str) -> str:
@@ -23,16 +124,50 @@ class Backend(AbstractBackend):
     def bind_user(username: str) -> str:
         return settings.ldap.bind_template.format(username=username)
 
-    @cached_property
-    def connection(self) -> Connection:
-        return Connection(
-            server=self._server,
-            user=settings.ldap.user,
-            password=settings.ldap.password,
+    @classmethod
+    def _connect(cls, service_account: bool) -> Connection:
+        conn = Connection(
+            server=cls._server,
+            user=settings.ldap.user if service_account else None,
+            password=settings.ldap.password if service_account else None,
             read_only=True,
             receive_timeout=settings.ldap.timeout,
-            client_strategy=SYNC,
+            client_strategy=cls.client_strategy,
         )
+        if service_account and not conn.bind():
+            raise LDAPBindError(f'Could not bind to LDAP as {settings.ldap.user}')
+        elif not service_account:
+            conn.open()
+        return conn
+
+    @classmethod
+    def _pool(cls, name: str) -> ConnectionPool:
+        '''Returns pool of connections bound to service account ("search")
+        or of connections for checking passwords of users ("bind")
+        '''
+        pool = cls._pools.get(name)
+        if pool is None:
+            with cls._pools_lock:
+                pool = cls._pools.get(name)
+                if pool is None:
+                    service_account = name == 'search'
+                    pool = cls._pools[name] = ConnectionPool(
+                        factory=lambda: cls._connect(service_account=service_account),
+                        size=settings.ldap.pool_size,
+                        lifetime=settings.ldap.pool_lifetime,
+                        healthy=(lambda conn: conn.bound and not conn.closed) if service_account
+                                else (lambda conn: not conn.closed)
+                    )
+        return pool
+
+    @classmethod
+    def reset(cls):
+        '''Closes pooled connections and forgets cached directory data'''
+        with cls._pools_lock:
+            pools, cls._pools = cls._pools, {}
+        for pool in pools.values():
+            pool.clear()
+        cls.directory_cache.clear()
 
     @staticmethod
     def get_attr_value(entry: Entry, attribute_name: str, default: Optional[str] = None) -> Any:
@@ -40,7 +175,11 @@ class Backend(AbstractBackend):
         return attr.value if attr else default
 
     def get_user_data(self, username: str) -> Optional[UserCreateSchema]:
-        with self.connection as conn:
+        user_data = self.directory_cache.get(username)
+        if user_data is not None:
+            return user_data
+
+        with self._pool('search').connection() as conn:
             conn.search(
                 search_base='cn=users,dc=suse,dc=de',
                 search_scope=LEVEL,
@@ -53,17 +192,23 @@ class Backend(AbstractBackend):
             params = {field: self.get_attr_value(entry=conn.entries[0], attribute_name=attr)
                       for field, attr in settings.ldap.attr.dict().items()}
 
-            return UserCreateSchema(password="", **params)
+        user_data = UserCreateSchema(password="", **params)
+        self.directory_cache.set(username, user_data)
+        return user_data
 
     def get_user(self, user_data: UserCreateSchema) -> Optional[User]:
         user, _ = get_or_create_user(db=self.db, data=user_data)
         return user
 
     def check_password(self, username: str, password: str) -> bool:
-        with self.connection as conn:
-            return conn.rebind(user=self.bind_user(username=username), password=password)
-
-    def authenticate(self, username: str, password: str) -> Optional[User]:
+        with self._pool('bind').connection() as conn:
+            try:
+                return conn.rebind(user=self.bind_user(username=username), password=password)
+            finally:
+                conn.password = None
+
+    def verify(self, username: str, password: str) -> Optional[UserCreateSchema]:
+        '''Returns directory data of user if `password` is right'''
         user_data = self.get_user_data(username=username)
         if not user_data:
             return None
@@ -71,4 +216,17 @@ class Backend(AbstractBackend):
         if not self.check_password(username=username, password=password):
             return None
 
+        return user_data
+
+    def prefetch(self, username: str, password: str):
+        self._verified[username] = self.verify(username=username, password=password)
+
+    def authenticate(self, username: str, password: str) -> Optional[User]:
+        if username in self._verified:
+            user_data = self._verified.pop(username)
+        else:
+            user_data = self.verify(username=username, password=password)
+        if not user_data:
+            return None
+
         return self.get_user(user_data=user_data)
@@ -9,7 +9,8 @@ from ..models import User
 class Backend(AbstractBackend):
     def authenticate(self, username: str, password: str) -> Optional[User]:
         user = get_user(db=self.db, username=username)
-        if user is None:
+        if user is None or not user.password:
+            # users created by other backends have no local password
             return None
         if not pwd_context.verify(password, user.password):
             return None
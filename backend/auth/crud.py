@@ -1,25 +1,25 @@
 import typing
-from typing import List, Optional, Tuple
+from typing import Callable, List, Optional, Tuple, Union
 
 import sqlalchemy
-from sqlalchemy import select, literal, or_, and_
+from sqlalchemy import select, exists, or_, and_, false, tuple_, ColumnElement
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy.sql.elements import BindParameter
 
-from ..database import STATEMENTS
+from . import closure, effective
 from .. import exceptions
 from ..models import Schema, Entity
-from .models import User, Group, Permission, UserGroup
+from .models import User, Group, Permission, UserGroup, EffectivePermission
 from ..schemas.auth import BaseGroupSchema, PermissionSchema, GroupSchema, \
-    UserCreateSchema, RequirePermission, PermissionWithIdSchema
+    UserCreateSchema, RequirePermission, PermissionWithIdSchema, PermissionCheckSchema
 from .context import get_password_hash
 from .enum import PermissionType, PermissionTargetType, RecipientType
+from .tokens import token_cache
 
 
 def _is_circular_group_reference(child_id: int, parent_id: int, db: Session) -> None:
-    all_parent_ids = [x[0] for x in db.execute(STATEMENTS.all_parent_groups,
-                                               {"groupids": [parent_id]})]
-    if child_id in all_parent_ids:
+    if closure.is_ancestor(db=db, ancestor_id=child_id, descendant_id=parent_id):
         raise exceptions.CircularGroupReferenceException()
 
 
@@ -78,6 +78,7 @@ def activate_user(db: Session, user_id: Optional[int] = None,
 
     user.is_active = True
     db.commit()
+    token_cache.forget_user(user.id)
     return True
 
 
@@ -96,6 +97,7 @@ def deactivate_user(db: Session, user_id: Optional[int] = None,
 
     user.is_active = False
     db.commit()
+    token_cache.forget_user(user.id)
     return True
 
 
@@ -132,10 +134,12 @@ def create_group(data: BaseGroupSchema, db: Session) -> Group:
     group = Group(name=data.name, parent_id=data.parent_id)
     db.add(group)
     try:
-        db.commit()
+        db.flush()
     except IntegrityError as error:
         raise exceptions.GroupExistsException(name=data.name) from error
 
+    closure.add_group(db=db, group=group)
+    db.commit()
     db.refresh(group)
     return group
 
@@ -146,6 +150,8 @@ def update_group(group_id: int, data: BaseGroupSchema, db: Session) -> [Group, b
     if data.parent_id and data.parent_id != group.parent_id:
         _is_circular_group_reference(child_id=group_id, parent_id=data.parent_id, db=db)
         group.parent_id = data.parent_id
+        closure.move_group(db=db, group_id=group_id, parent_id=data.parent_id)
+        effective.refresh_users(db=db, user_ids=closure.group_member_ids(group_id=group_id))
         has_changed = True
 
     if data.name and data.name != group.name:
@@ -165,7 +171,10 @@ def delete_group(group_id: int, db: Session) -> bool:
     group = get_group_or_raise(group_id=group_id, db=db)
     if group.subgroups:
         raise exceptions.GroupExistsException(group.subgroups[0].name)
+    member_ids = [assoc.user_id for assoc in group.members]
     db.delete(group)
+    db.flush()
+    effective.refresh_users(db=db, user_ids=member_ids)
     db.commit()
     return True
 
@@ -175,18 +184,20 @@ def add_members(group_id: int, user_ids: List[int], db: Session) -> bool:
     users = get_users(db=db, user_ids=user_ids)
 
     already_members = get_group_members(group_id=group_id, db=db)
-    was_added = False
+    added = []
 
     for user in users:
         if user in already_members:
             continue
         db.add(UserGroup(user_id=user.id, group_id=group.id))
-        was_added = True
+        added.append(user.id)
 
-    if was_added:
+    if added:
+        db.flush()
+        effective.refresh_users(db=db, user_ids=added)
         db.commit()
 
-    return was_added
+    return bool(added)
 
 
 def delete_members(group_id: int, user_ids: List[int], db: Session) -> bool:
@@ -200,6 +211,7 @@ def delete_members(group_id: int, user_ids: List[int], db: Session) -> bool:
     count = db.query(UserGroup)\
         .filter(UserGroup.group_id == group_id, UserGroup.user_id.in_(user_ids))\
         .delete()
+    effective.refresh_users(db=db, user_ids=user_ids)
     db.commit()
     if count < 1:
         raise exceptions.MissingUserGroupException(user_id=user_ids[0], group_id=group_id)
@@ -207,48 +219,135 @@ def delete_members(group_id: int, user_ids: List[int], db: Session) -> bool:
 
 
 def has_permission(user: User, permission: RequirePermission, db: Session) -> bool:
-    base_u = db.query(Permission.id)\
-        .join(Permission.user)\
-        .filter(Permission.user.property.mapper.class_.id == user.id)
-    
-    has_user_perm = base_u.filter(Permission.permission.in_([permission.permission, PermissionType.SUPERUSER]))
-
-    user_groups = [x[0] for x in db.query(UserGroup.group_id).filter(UserGroup.user_id == user.id).all()]
-    all_group_ids = [x[0] for x in db.execute(STATEMENTS.all_parent_groups, {"groupids": user_groups})]
-    has_group_perm = db.query(Permission.id)\
-        .join(Permission.group)\
-        .filter(Permission.group.property.mapper.class_.id.in_(all_group_ids),
-                Permission.permission.in_([permission.permission, PermissionType.SUPERUSER]))
-
     if isinstance(permission.target, Group):
-        q = or_(Permission.obj_id == None,
-                and_(Permission.obj_type == PermissionTargetType.GROUP,
-                     Permission.obj_id == permission.target.id))
+        q = or_(EffectivePermission.obj_id == None,
+                and_(EffectivePermission.obj_type == PermissionTargetType.GROUP,
+                     EffectivePermission.obj_id == permission.target.id))
     elif isinstance(permission.target, Schema):
-        q = or_(Permission.obj_id == None,
-                and_(Permission.obj_type == PermissionTargetType.SCHEMA,
-                     Permission.obj_id == permission.target.id))
+        q = or_(EffectivePermission.obj_id == None,
+                and_(EffectivePermission.obj_type == PermissionTargetType.SCHEMA,
+                     EffectivePermission.obj_id == permission.target.id))
     elif isinstance(permission.target, Entity):
-        q = or_(Permission.obj_id == None,
-                and_(Permission.obj_type == PermissionTargetType.ENTITY,
-                     Permission.obj_id == permission.target.id))
+        q = or_(EffectivePermission.obj_id == None,
+                and_(EffectivePermission.obj_type == PermissionTargetType.ENTITY,
+                     EffectivePermission.obj_id == permission.target.id))
         schema_id = permission.target.schema_id or db.query(Entity.schema_id)\
                                                      .filter(Entity.id == permission.target.id)\
                                                      .scalar()
-        q = or_(q, and_(Permission.obj_type == PermissionTargetType.SCHEMA,
-                        Permission.obj_id == schema_id),)
+        q = or_(q, and_(EffectivePermission.obj_type == PermissionTargetType.SCHEMA,
+                        EffectivePermission.obj_id == schema_id),)
     elif permission.target is None:
-        q = Permission.obj_id == None
+        q = EffectivePermission.obj_id == None
     else:
         raise TypeError(f"Permission management for type {type(permission.target)} "
                         f"not supported")
 
-    has_user_perm = has_user_perm.filter(q)
-    has_group_perm = has_group_perm.filter(q)
-
-    return db.query(literal(True))\
-        .filter(has_user_perm.union(has_group_perm).exists())\
-        .scalar() or False
+    granted = exists().where(
+        EffectivePermission.user_id == user.id,
+        EffectivePermission.permission.in_([permission.permission, PermissionType.SUPERUSER]),
+        q
+    )
+    return db.execute(select(granted)).scalar() or False
+
+
+def get_granted_permissions(db: Session, user: User, permissions: typing.Iterable[PermissionType]) \
+        -> List[Tuple[PermissionType, Optional[PermissionTargetType], Optional[int]]]:
+    '''Returns `(permission, obj_type, obj_id)` of all `permissions` and superuser permissions
+    granted to `user` directly or via groups. Allows to check permissions for many targets
+    without querying for each of them
+    '''
+    q = select(EffectivePermission.permission, EffectivePermission.obj_type,
+               EffectivePermission.obj_id)\
+        .where(EffectivePermission.user_id == user.id,
+               EffectivePermission.permission.in_([*permissions, PermissionType.SUPERUSER]))
+    return [tuple(i) for i in db.execute(q).all()]
+
+
+def check_permissions(db: Session, user: User, checks: List[PermissionCheckSchema]) \
+        -> List[bool]:
+    '''Tells for each of `checks` if `user` has the permission for the target, by the same
+    rules as `has_permission`. Needs at most two queries regardless of number of checks
+    '''
+    for check in checks:
+        if (check.obj_type is None) != (check.obj_id is None):
+            raise ValueError("Target/Object type and ID must be specified as pair.")
+    if not checks:
+        return []
+
+    entity_ids = {i.obj_id for i in checks if i.obj_type == PermissionTargetType.ENTITY}
+    schema_ids = dict(db.execute(select(Entity.id, Entity.schema_id)
+                                 .where(Entity.id.in_(entity_ids))).all()) if entity_ids else {}
+    targets = {(i.obj_type, i.obj_id) for i in checks if i.obj_type is not None}
+    targets.update((PermissionTargetType.SCHEMA, i) for i in schema_ids.values())
+
+    q = select(EffectivePermission.permission, EffectivePermission.obj_type,
+               EffectivePermission.obj_id)\
+        .where(EffectivePermission.user_id == user.id,
+               EffectivePermission.permission.in_({i.permission for i in checks}
+                                                  | {PermissionType.SUPERUSER}),
+               or_(EffectivePermission.obj_id == None,
+                   tuple_(EffectivePermission.obj_type, EffectivePermission.obj_id)
+                   .in_(targets) if targets else false()))
+    granted = {tuple(i) for i in db.execute(q)}
+
+    results = []
+    for check in checks:
+        applicable = [(None, None)]
+        if check.obj_type is not None:
+            applicable.append((check.obj_type, check.obj_id))
+        if check.obj_id in schema_ids and check.obj_type == PermissionTargetType.ENTITY:
+            applicable.append((PermissionTargetType.SCHEMA, schema_ids[check.obj_id]))
+        results.append(any((permission, *target) in granted
+                           for permission in (check.permission, PermissionType.SUPERUSER)
+                           for target in applicable))
+    return results
+
+
+def readable_entities(user_id: Union[int, BindParameter],
+                      schema_id: Union[int, ColumnElement[int]] = Entity.schema_id) \
+        -> ColumnElement[bool]:
+    '''Returns condition on `Entity`, which holds for entities of schema `schema_id`
+    user `user_id` may read. Meant to be joined into listing queries, so that counts and
+    pagination only see readable entities. `user_id` may be a bound parameter, so that
+    the listing statement can be reused for other users. Without `schema_id` the condition
+    holds for readable entities of any schema
+    '''
+    read = EffectivePermission.permission == PermissionType.READ_ENTITY
+    whole_schema = exists().where(
+        EffectivePermission.user_id == user_id,
+        or_(and_(EffectivePermission.permission == PermissionType.SUPERUSER,
+                 EffectivePermission.obj_id == None),
+            and_(read, EffectivePermission.obj_type == PermissionTargetType.SCHEMA,
+                 EffectivePermission.obj_id == schema_id))
+    )
+    entity_ids = select(EffectivePermission.obj_id)\
+        .where(EffectivePermission.user_id == user_id, read,
+               EffectivePermission.obj_type == PermissionTargetType.ENTITY)
+    return or_(whole_schema, Entity.id.in_(entity_ids))
+
+
+def readable_entity_check(db: Session, user: User) -> Callable[[int, int], bool]:
+    '''Returns function telling by ids of an entity and of its schema if `user` may read
+    the entity, by the same rules as `readable_entities`. Permissions are loaded once,
+    so that many entities, e.g. of pushed events, are checked without queries
+    '''
+    granted = get_granted_permissions(db=db, user=user, permissions=[PermissionType.READ_ENTITY])
+    if (PermissionType.SUPERUSER, None, None) in granted:
+        return lambda entity_id, schema_id: True
+    schema_ids = {obj_id for permission, obj_type, obj_id in granted
+                  if permission == PermissionType.READ_ENTITY
+                  and obj_type == PermissionTargetType.SCHEMA}
+    entity_ids = {obj_id for permission, obj_type, obj_id in granted
+                  if permission == PermissionType.READ_ENTITY
+                  and obj_type == PermissionTargetType.ENTITY}
+    return lambda entity_id, schema_id: schema_id in schema_ids or entity_id in entity_ids
+
+
+def get_permissions_version(db: Session, user: User) -> int:
+    '''Returns version of effective permissions of `user`, which changes whenever
+    they change
+    '''
+    return db.execute(select(User.permissions_version).where(User.id == user.id)).scalar_one()
 
 
 def get_permissions(db: Session, recipient_type: Optional[RecipientType] = None,
@@ -262,17 +361,15 @@ def get_permissions(db: Session, recipient_type: Optional[RecipientType] = None,
 
     query = db.query(Permission)
 
-    if recipient_type:
+    if recipient_type == RecipientType.USER:
+        query = query.filter(Permission.id.in_(
+            select(EffectivePermission.permission_id)
+            .where(EffectivePermission.user_id == recipient_id)
+        ))
+    elif recipient_type:
         query = query.filter(Permission.recipient_type == recipient_type,
                              Permission.recipient_id == recipient_id)
-        if recipient_type == RecipientType.USER:
-            group_ids = [x[0] for x in db.query(UserGroup.group_id)
-                                         .filter(UserGroup.user_id == recipient_id).all()]
-        else:
-            group_ids = [recipient_id]
-
-        q = db.execute(STATEMENTS.all_parent_groups, {"groupids": group_ids})
-        all_group_ids = [x[0] for x in q.fetchall()]
+        all_group_ids = closure.group_ancestor_ids(group_id=recipient_id)
         subq = db.query(Permission).filter(Permission.recipient_type == RecipientType.GROUP,
                                            Permission.recipient_id.in_(all_group_ids))
         query = query.union(subq)
@@ -291,6 +388,7 @@ def get_permissions(db: Session, recipient_type: Optional[RecipientType] = None,
         perm = PermissionWithIdSchema.from_orm(p)
         return perm
 
+    query = query.options(selectinload(Permission.user), selectinload(Permission.group))
     return [_prep_perm(p) for p in query.all()]
 
 
@@ -341,6 +439,8 @@ def grant_permission(data: PermissionSchema, db: Session) -> bool:
     try:
         permission = Permission(**args)
         db.add(permission)
+        db.flush()
+        effective.add_permission(db=db, permission=permission)
         db.commit()
         return True
     except sqlalchemy.exc.IntegrityError:
@@ -349,6 +449,7 @@ def grant_permission(data: PermissionSchema, db: Session) -> bool:
 
 
 def revoke_permissions(ids: List[int], db: Session) -> bool:
+    effective.remove_permissions(db=db, permission_ids=ids)
     count = db.query(Permission).filter(Permission.id.in_(ids)).delete()
     db.commit()
     return count > 0
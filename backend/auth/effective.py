@@ -0,0 +1,97 @@
+"""
+Maintenance of `effective_permissions`, which lists all permissions of every user including
+the ones granted to groups the user is member of and to their ancestors. Permission checks
+are a lookup in its index instead of joining permissions, memberships and groups.
+
+Rows are removed with the permission or user by FK cascade and recomputed for affected
+users when memberships or groups change. Every change bumps `User.permissions_version` of
+affected users. If the table ever drifts, rebuild it with:
+
+    python -m backend.auth.effective
+"""
+from typing import Iterable, Optional, Union
+
+from sqlalchemy import Select, delete, insert, select, union, update
+from sqlalchemy.orm import Session
+
+from ..cache import mark_written
+from .enum import RecipientType
+from .models import EffectivePermission, GroupClosure, Permission, User, UserGroup
+
+
+COLUMNS = ['user_id', 'permission_id', 'permission', 'obj_type', 'obj_id']
+UserIds = Union[Iterable[int], Select]
+
+
+def _derived(user_ids: Optional[UserIds] = None,
+             permission_id: Optional[int] = None) -> Select:
+    '''Returns query for effective permissions of `user_ids` (all users by default),
+    optionally only the ones derived from permission `permission_id`
+    '''
+    granted = (Permission.id, Permission.permission, Permission.obj_type, Permission.obj_id)
+    direct = select(Permission.recipient_id, *granted)\
+        .where(Permission.recipient_type == RecipientType.USER)
+    via_groups = select(UserGroup.user_id, *granted)\
+        .select_from(Permission)\
+        .join(GroupClosure, GroupClosure.ancestor_id == Permission.recipient_id)\
+        .join(UserGroup, UserGroup.group_id == GroupClosure.descendant_id)\
+        .where(Permission.recipient_type == RecipientType.GROUP)
+    if user_ids is not None:
+        direct = direct.where(Permission.recipient_id.in_(user_ids))
+        via_groups = via_groups.where(UserGroup.user_id.in_(user_ids))
+    if permission_id is not None:
+        direct = direct.where(Permission.id == permission_id)
+        via_groups = via_groups.where(Permission.id == permission_id)
+    # `union` drops duplicates of users getting a permission through several groups
+    return union(direct, via_groups)
+
+
+def _bump_versions(db: Session, user_ids: Optional[UserIds] = None):
+    '''Bumps `User.permissions_version` of `user_ids` (all users by default)'''
+    q = update(User).values(permissions_version=User.permissions_version + 1)
+    if user_ids is not None:
+        q = q.where(User.id.in_(user_ids))
+    db.execute(q, execution_options={'synchronize_session': False})
+
+
+def add_permission(db: Session, permission: Permission):
+    '''Adds flushed new `permission` to all users it applies to'''
+    db.execute(insert(EffectivePermission)
+               .from_select(COLUMNS, _derived(permission_id=permission.id)))
+    _bump_versions(db, select(EffectivePermission.user_id)
+                   .where(EffectivePermission.permission_id == permission.id))
+
+
+def remove_permissions(db: Session, permission_ids: Iterable[int]):
+    '''Bumps versions of users having permissions `permission_ids`, which are about to be
+    deleted. Their rows are removed by FK cascade
+    '''
+    _bump_versions(db, select(EffectivePermission.user_id)
+                   .where(EffectivePermission.permission_id.in_(list(permission_ids))))
+
+
+def refresh_users(db: Session, user_ids: UserIds):
+    '''Recomputes permissions of `user_ids` after their memberships or groups changed'''
+    if not isinstance(user_ids, Select):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+    db.execute(delete(EffectivePermission).where(EffectivePermission.user_id.in_(user_ids)))
+    db.execute(insert(EffectivePermission).from_select(COLUMNS, _derived(user_ids=user_ids)))
+    _bump_versions(db, user_ids)
+
+
+def rebuild(db: Session):
+    '''Recomputes the whole table from permissions, memberships and `group_closure`'''
+    db.execute(delete(EffectivePermission))
+    db.execute(insert(EffectivePermission).from_select(COLUMNS, _derived()))
+    _bump_versions(db)
+    mark_written(db, EffectivePermission.__tablename__)
+
+
+if __name__ == '__main__':
+    from ..database import SessionLocal
+
+    with SessionLocal() as session:
+        rebuild(session)
+        session.commit()
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, Enum, text
+from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, Enum, Index, text
 from sqlalchemy.event import listens_for
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql.schema import UniqueConstraint
@@ -22,6 +22,22 @@ class Group(Base):
         return self.name
 
 
+class GroupClosure(Base):
+    '''Every ancestor of every group, including the group itself at depth 0.
+    Maintained by `auth.closure`
+    '''
+    __tablename__ = 'group_closure'
+
+    ancestor_id = Column(Integer, ForeignKey('groups.id', ondelete='CASCADE'), primary_key=True)
+    descendant_id = Column(Integer, ForeignKey('groups.id', ondelete='CASCADE'),
+                           primary_key=True)
+    depth = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        Index('ix_group_closure_descendant_id', 'descendant_id', 'ancestor_id'),
+    )
+
+
 class User(Base):
     __tablename__ = 'users'
 
@@ -32,6 +48,8 @@ class User(Base):
     firstname = Column(String(128), nullable=True)
     lastname = Column(String(128), nullable=True)
     is_active = Column(Boolean, default=True)
+    # bumped by `auth.effective` whenever effective permissions of the user change
+    permissions_version = Column(Integer, nullable=False, default=0, server_default='0')
 
     groups = relationship('UserGroup', back_populates="user", cascade="delete")
 
@@ -93,6 +111,24 @@ class Permission(Base):
         return self.managed_group
 
 
+class EffectivePermission(Base):
+    '''Every permission of every user, granted directly or to one of groups the user
+    is member of or to their ancestors. Maintained by `auth.effective`
+    '''
+    __tablename__ = 'effective_permissions'
+
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    permission_id = Column(Integer, ForeignKey('permissions.id', ondelete='CASCADE'),
+                           primary_key=True)
+    permission = Column(Enum(PermissionType), nullable=False)
+    obj_type = Column(Enum(PermissionTargetType), nullable=True)
+    obj_id = Column(Integer, nullable=True)
+
+    __table_args__ = (
+        Index('ix_effective_permissions_lookup', 'user_id', 'permission', 'obj_type', 'obj_id'),
+    )
+
+
 class UserGroup(Base):
     __tablename__ = 'user_groups'
     id = Column(Integer, primary_key=True)
@@ -0,0 +1,77 @@
+"""
+Cache of verified access tokens.
+
+Every authenticated request used to verify its token and look its user up in the database.
+Verified tokens are remembered together with a snapshot of their user until the token
+expires or `settings.token_cache_ttl` seconds pass. (De)activating a user drops the tokens
+of the user cached in the current process; other processes see the change after the TTL.
+"""
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy.orm import Session, make_transient_to_detached
+
+from ..config import settings
+from .models import User
+
+
+@dataclass(frozen=True)
+class UserSnapshot:
+    id: int
+    username: str
+    is_active: bool
+
+    def to_user(self, db: Session) -> User:
+        '''Returns user attached to `db` without querying it, attributes missing
+        in the snapshot are loaded on first access
+        '''
+        user = User(id=self.id, username=self.username, is_active=self.is_active)
+        make_transient_to_detached(user)
+        return db.merge(user, load=False)
+
+
+class TokenCache:
+    def __init__(self):
+        self._tokens: OrderedDict[str, Tuple[float, UserSnapshot]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token: str) -> Optional[UserSnapshot]:
+        with self._lock:
+            item = self._tokens.get(token)
+            if item is None:
+                return None
+            expires, user = item
+            if expires <= time.time():
+                del self._tokens[token]
+                return None
+            self._tokens.move_to_end(token)
+            return user
+
+    def set(self, token: str, user: User, expires: float):
+        '''Remembers `user` for `token` until `expires` (a Unix timestamp),
+        but at most for `settings.token_cache_ttl` seconds
+        '''
+        if settings.token_cache_ttl <= 0:
+            return
+        expires = min(expires, time.time() + settings.token_cache_ttl)
+        snapshot = UserSnapshot(id=user.id, username=user.username, is_active=user.is_active)
+        with self._lock:
+            self._tokens[token] = (expires, snapshot)
+            self._tokens.move_to_end(token)
+            while len(self._tokens) > settings.token_cache_size:
+                self._tokens.popitem(last=False)
+
+    def forget_user(self, user_id: int):
+        with self._lock:
+            for token in [k for k, (_, user) in self._tokens.items() if user.id == user_id]:
+                del self._tokens[token]
+
+    def clear(self):
+        with self._lock:
+            self._tokens.clear()
+
+
+token_cache = TokenCache()
@@ -0,0 +1,3 @@
+"""
+Benchmarks of API on synthetic EAV data, see `python -m backend.benchmarks --help`
+"""
@@ -0,0 +1,258 @@
+"""
+Generator of synthetic EAV data for benchmarks.
+
+Schemas and permissions of benchmark users are created through `crud`, entities, their
+values, change history and additional users, groups and grants are inserted in bulk, since
+going through `crud` for each row would take longer than the benchmarks themselves.
+"""
+import random
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta, timezone
+from itertools import cycle
+from typing import Dict, List
+
+from sqlalchemy import insert, text
+from sqlalchemy.orm import Session
+
+from .. import crud
+from ..auth import closure, effective
+from ..auth.crud import create_user, create_group, add_members, grant_permission
+from ..auth.enum import PermissionTargetType, PermissionType, RecipientType
+from ..auth.models import Group, Permission, User, UserGroup
+from ..models import AttrType, Entity, Schema
+from ..schemas import AttrDefSchema, SchemaCreateSchema
+from ..schemas.auth import BaseGroupSchema, PermissionSchema, UserCreateSchema
+from ..traceability.entity import create_entity_update_request
+from ..traceability.enum import ChangeStatus, ChangeType, ContentType, EditableObjectType
+from ..traceability.models import Change, ChangeAttrType, ChangeRequest, ChangeValueStr
+
+
+VALUE_TYPES = [AttrType.STR, AttrType.INT, AttrType.FLOAT, AttrType.BOOL, AttrType.DT,
+               AttrType.DATE]
+WORDS = ['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel', 'india',
+         'juliett', 'kilo', 'lima', 'mike', 'november', 'oscar', 'papa']
+ADMIN = 'bench-admin'
+USER = 'bench-user'
+PASSWORD = 'bench-password'
+
+
+@dataclass
+class DatasetConfig:
+    attributes: int = 12
+    fk_attributes: int = 2
+    list_every: int = 4
+    entities: int = 1000
+    fk_degree: int = 2
+    history: int = 2000
+    pending: int = 50
+    group_depth: int = 3
+    permissions: int = 200
+    users: int = 0
+    groups: int = 0
+    grants: int = 0
+    seed: int = 42
+
+
+@dataclass
+class Dataset:
+    config: DatasetConfig
+    schema_slug: str = 'bench'
+    attributes: Dict[str, AttrType] = field(default_factory=dict)
+    list_attributes: List[str] = field(default_factory=list)
+    entity_ids: List[int] = field(default_factory=list)
+    pending_ids: List[int] = field(default_factory=list)
+    user_id: int = 0
+
+
+def _random_value(type_: AttrType, rnd: random.Random):
+    if type_ == AttrType.STR:
+        return f'{rnd.choice(WORDS)} {rnd.choice(WORDS)} {rnd.randint(0, 999)}'
+    if type_ == AttrType.INT:
+        return rnd.randint(0, 10000)
+    if type_ == AttrType.FLOAT:
+        return rnd.uniform(0, 10000)
+    if type_ == AttrType.BOOL:
+        return rnd.random() < 0.5
+    if type_ == AttrType.DT:
+        return datetime(2020, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=rnd.randint(0, 10**6))
+    if type_ == AttrType.DATE:
+        return date(2000, 1, 1) + timedelta(days=rnd.randint(0, 10000))
+    raise ValueError(type_)
+
+
+def _create_schema(db: Session, config: DatasetConfig, dataset: Dataset) -> Schema:
+    attributes = []
+    types = cycle(VALUE_TYPES)
+    for idx in range(config.attributes):
+        type_ = next(types)
+        name = f'{type_.name.lower()}{idx}'
+        is_list = type_ != AttrType.BOOL and config.list_every and idx % config.list_every == 3
+        attributes.append(AttrDefSchema(name=name, type=type_.name, required=idx == 0,
+                                        unique=False, list=is_list, key=idx < 3))
+        dataset.attributes[name] = type_
+        if is_list:
+            dataset.list_attributes.append(name)
+    for idx in range(config.fk_attributes):
+        name = f'fk{idx}'
+        attributes.append(AttrDefSchema(name=name, type='FK', required=False, unique=False,
+                                        list=True, key=False, bound_schema_id=-1))
+        dataset.attributes[name] = AttrType.FK
+        dataset.list_attributes.append(name)
+    return crud.create_schema(db, SchemaCreateSchema(name='Benchmark', slug=dataset.schema_slug,
+                                                     attributes=attributes))
+
+
+def _insert_entities(db: Session, config: DatasetConfig, dataset: Dataset, schema: Schema,
+                     rnd: random.Random):
+    rows = [{'schema_id': schema.id, 'slug': f'entity-{i}', 'name': f'Entity {i}',
+             'deleted': False} for i in range(config.entities)]
+    q = insert(Entity).returning(Entity.id, sort_by_parameter_order=True)
+    dataset.entity_ids = list(db.execute(q, rows).scalars())
+
+    values = {}
+    for attr_def in schema.attr_defs:
+        attr = attr_def.attribute
+        model = attr.type.value.model
+        rows = values.setdefault(model, [])
+        for entity_id in dataset.entity_ids:
+            if attr.type == AttrType.FK:
+                targets = rnd.sample(dataset.entity_ids, k=min(config.fk_degree, config.entities))
+                rows.extend({'entity_id': entity_id, 'attribute_id': attr.id, 'value': i}
+                            for i in targets if i != entity_id)
+            elif attr_def.list:
+                rows.extend({'entity_id': entity_id, 'attribute_id': attr.id,
+                             'value': _random_value(attr.type, rnd)}
+                            for _ in range(rnd.randint(1, 3)))
+            elif attr_def.required or rnd.random() < 0.8:
+                rows.append({'entity_id': entity_id, 'attribute_id': attr.id,
+                             'value': _random_value(attr.type, rnd)})
+    for model, rows in values.items():
+        db.execute(insert(model), rows)
+
+
+def _insert_history(db: Session, config: DatasetConfig, dataset: Dataset, user_id: int,
+                    rnd: random.Random):
+    '''Inserts reviewed update requests for `name` of random entities'''
+    now = datetime.now(timezone.utc)
+    requests = [{'created_by_user_id': user_id, 'reviewed_by_user_id': user_id,
+                 'created_at': now - timedelta(minutes=i), 'reviewed_at': now,
+                 'status': rnd.choice([ChangeStatus.APPROVED, ChangeStatus.DECLINED]),
+                 'object_type': EditableObjectType.ENTITY, 'change_type': ChangeType.UPDATE,
+                 'object_id': rnd.choice(dataset.entity_ids)} for i in range(config.history)]
+    if not requests:
+        return
+    q = insert(ChangeRequest).returning(ChangeRequest.id, sort_by_parameter_order=True)
+    request_ids = list(db.execute(q, requests).scalars())
+    q = insert(ChangeValueStr).returning(ChangeValueStr.id, sort_by_parameter_order=True)
+    value_ids = list(db.execute(q, [{'old_value': 'old', 'new_value': 'new'}] * len(requests))
+                     .scalars())
+    db.execute(insert(Change), [
+        {'change_request_id': request_id, 'value_id': value_id, 'object_id': request['object_id'],
+         'field_name': 'name', 'data_type': ChangeAttrType.STR, 'content_type': ContentType.ENTITY,
+         'change_type': ChangeType.UPDATE}
+        for request_id, value_id, request in zip(request_ids, value_ids, requests)
+    ])
+
+
+def _create_users(db: Session, config: DatasetConfig, dataset: Dataset, schema: Schema,
+                  rnd: random.Random):
+    '''Creates superuser `ADMIN` and `USER`, who may update entities of the benchmark schema
+    through the deepest of nested groups and may read and delete `permissions` of them
+    '''
+    admin = create_user(db, UserCreateSchema(username=ADMIN, password=PASSWORD,
+                                             email='admin@bench.example.org'))
+    grant_permission(PermissionSchema(recipient_type=RecipientType.USER, recipient_name=ADMIN,
+                                      permission=PermissionType.SUPERUSER), db)
+    user = create_user(db, UserCreateSchema(username=USER, password=PASSWORD,
+                                            email='user@bench.example.org'))
+    dataset.user_id = user.id
+    parent_id = None
+    for depth in range(config.group_depth):
+        group = create_group(BaseGroupSchema(name=f'bench-group-{depth}', parent_id=parent_id), db)
+        parent_id = group.id
+        if depth == 0:
+            grant_permission(PermissionSchema(recipient_type=RecipientType.GROUP,
+                                              recipient_name=group.name,
+                                              obj_type=PermissionTargetType.SCHEMA, obj_id=schema.id,
+                                              permission=PermissionType.UPDATE_ENTITY), db)
+    if parent_id is not None:
+        add_members(parent_id, [user.id], db)
+    for entity_id in rnd.sample(dataset.entity_ids, k=min(config.permissions, config.entities)):
+        for permission in (PermissionType.READ_ENTITY, PermissionType.DELETE_ENTITY):
+            grant_permission(PermissionSchema(recipient_type=RecipientType.USER,
+                                              recipient_name=USER,
+                                              obj_type=PermissionTargetType.ENTITY,
+                                              obj_id=entity_id, permission=permission), db)
+    return admin
+
+
+def _insert_directory(db: Session, config: DatasetConfig, dataset: Dataset, schema: Schema,
+                      rnd: random.Random):
+    '''Inserts `users` members of two random groups each, `groups` forming a forest and
+    `grants` of random permissions to them, `USER` joins a few of the groups
+    '''
+    q = insert(User).returning(User.id, sort_by_parameter_order=True)
+    user_ids = list(db.execute(q, [{'username': f'bench-user-{i}', 'password': '',
+                                    'email': f'user-{i}@bench.example.org', 'is_active': True}
+                                   for i in range(config.users)]).scalars()) if config.users else []
+    group_ids = []
+    for idx in range(config.groups):
+        # a fifth of groups are roots, the others are attached to any earlier group
+        parent_id = rnd.choice(group_ids) if group_ids and rnd.random() < 0.8 else None
+        group_ids.append(db.execute(insert(Group).returning(Group.id),
+                                    {'name': f'bench-team-{idx}', 'parent_id': parent_id})
+                         .scalar())
+    if not group_ids:
+        return
+
+    members = {(user_id, group_id) for user_id in user_ids
+               for group_id in rnd.sample(group_ids, k=min(2, len(group_ids)))}
+    members.update((dataset.user_id, group_id)
+                   for group_id in rnd.sample(group_ids, k=min(5, len(group_ids))))
+    if members:
+        db.execute(insert(UserGroup), [{'user_id': u, 'group_id': g} for u, g in members])
+
+    targets = [(PermissionTargetType.SCHEMA, schema.id)]
+    targets.extend((PermissionTargetType.ENTITY, i) for i in dataset.entity_ids)
+    recipients = [(RecipientType.USER, i) for i in user_ids]
+    recipients.extend((RecipientType.GROUP, i) for i in group_ids)
+    entity_permissions = [PermissionType.READ_ENTITY, PermissionType.UPDATE_ENTITY,
+                          PermissionType.DELETE_ENTITY]
+    grants = set()
+    for _ in range(config.grants * 2):
+        if len(grants) >= config.grants:
+            break
+        recipient_type, recipient_id = rnd.choice(recipients)
+        obj_type, obj_id = rnd.choice(targets)
+        grants.add((recipient_type, recipient_id, obj_type, obj_id,
+                    rnd.choice(entity_permissions)))
+    if grants:
+        keys = ['recipient_type', 'recipient_id', 'obj_type', 'obj_id', 'permission']
+        db.execute(insert(Permission), [dict(zip(keys, i)) for i in grants])
+    # without statistics of the freshly filled tables planner picks nested loops
+    db.execute(text('analyze groups, user_groups, permissions'))
+    closure.rebuild(db)
+    db.execute(text('analyze group_closure'))
+    effective.rebuild(db)
+
+
+def generate(db: Session, config: DatasetConfig) -> Dataset:
+    '''Fills empty database with synthetic data described by `config`'''
+    rnd = random.Random(config.seed)
+    dataset = Dataset(config=config)
+    schema = _create_schema(db, config, dataset)
+    _insert_entities(db, config, dataset, schema, rnd)
+    db.commit()
+    admin = _create_users(db, config, dataset, schema, rnd)
+    _insert_directory(db, config, dataset, schema, rnd)
+    _insert_history(db, config, dataset, admin.id, rnd)
+    db.commit()
+    for entity_id in rnd.sample(dataset.entity_ids, k=min(config.pending, config.entities)):
+        request = create_entity_update_request(db, id_or_slug=entity_id, schema_id=schema.id,
+                                               data={'name': f'Renamed {entity_id}'},
+                                               created_by=admin)
+        dataset.pending_ids.append(request.id)
+    # planner statistics are stale after bulk inserts until autovacuum gets to them
+    db.execute(text('analyze'))
+    db.commit()
+    return dataset
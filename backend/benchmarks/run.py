@@ -0,0 +1,399 @@
+"""
+Runs benchmark scenarios against a database filled by `dataset.generate`.
+
+Requests go through `create_app` and `TestClient`, so the numbers include routing,
+validation, permission checks and serialization. Results are written as JSON and can be
+compared with results of another commit with `--compare`.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from dataclasses import asdict, fields
+from datetime import datetime, timedelta, timezone
+from itertools import cycle
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from alembic import command
+from alembic.config import Config
+from fastapi.encoders import jsonable_encoder
+from fastapi.testclient import TestClient
+from fastapi_pagination import Page, Params
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker
+
+from .. import cache, config, create_app, crud
+from ..auth import create_access_token
+from ..auth.crud import get_user, has_permission
+from ..auth.enum import PermissionType
+from ..database import Base, get_db
+from ..dynamic_routes import factory
+from ..enum import ModelVariant
+from ..instrumentation import count_queries
+from ..models import AttrType, Entity
+from ..schemas.auth import RequirePermission
+from ..serialization import ListingSerializer, json_response_class
+from .dataset import ADMIN, USER, Dataset, DatasetConfig, generate
+
+
+ALEMBIC_CONFIG = os.path.join(os.path.dirname(__file__), '../alembic/alembic.ini')
+
+# scenario yields (method, url, json body, username) for every iteration
+Request = Tuple[str, str, Optional[dict], str]
+# scenarios run with `settings.enforce_read_permissions` on
+READ_ENFORCED = {'list_readable'}
+# sizes of pages rendered by `run_serialization`
+SERIALIZATION_PAGE_SIZES = (100, 1000)
+# numbers of entities `run_attr_values` loads values of
+ATTR_VALUES_PAGE_SIZES = (100, 1000, 10000)
+
+
+def _database_url(name: str) -> str:
+    s = config.settings
+    return f'postgresql+psycopg2://{s.pg_user}:{s.pg_password}@{s.pg_host}:{s.pg_port}/{name}'
+
+
+def prepare_database(url: str):
+    '''Creates database if it doesn't exist and migrates it to an empty latest revision'''
+    server = create_engine(make_url(url).set(database='postgres'), isolation_level='AUTOCOMMIT')
+    with server.connect() as conn:
+        name = make_url(url).database
+        if not conn.execute(text('select 1 from pg_database where datname = :name'),
+                            {'name': name}).scalar():
+            conn.execute(text(f'create database "{name}"'))
+    server.dispose()
+
+    engine = create_engine(url)
+    Base.metadata.drop_all(engine)
+    with engine.connect() as conn:
+        conn.execute(text('drop table if exists alembic_version'))
+        conn.commit()
+    engine.dispose()
+    config.SQLALCHEMY_DATABASE_URL = url
+    command.upgrade(Config(ALEMBIC_CONFIG), 'head')
+
+
+def _scenarios(dataset: Dataset) -> Dict[str, Callable[[], Iterator[Request]]]:
+    slug = dataset.schema_slug
+    base = f'/entity/{slug}'
+    ids = dataset.entity_ids
+    by_type = {}
+    for name, type_ in dataset.attributes.items():
+        by_type.setdefault(type_, name)
+
+    def repeat(method: str, url: str, user: str = ADMIN, body: dict = None):
+        def scenario():
+            while True:
+                yield method, url, body, user
+        return scenario
+
+    def detail():
+        for id_ in cycle(ids):
+            yield 'GET', f'{base}/{id_}', None, ADMIN
+
+    def create():
+        for idx in range(sys.maxsize):
+            yield 'POST', base, {'slug': f'bench-new-{idx}', 'name': f'New {idx}',
+                                 'str0': 'created'}, ADMIN
+
+    def update(user: str):
+        def scenario():
+            for idx, id_ in enumerate(cycle(ids)):
+                yield 'PUT', f'{base}/{id_}', {'name': f'Updated {user} {idx}'}, user
+        return scenario
+
+    def review():
+        for id_ in dataset.pending_ids:
+            yield 'POST', f'/changes/review/{id_}', {'result': 'APPROVE'}, ADMIN
+
+    scenarios = {
+        'list': repeat('GET', f'{base}?size=50'),
+        'list_readable': repeat('GET', f'{base}?size=50', user=USER),
+        'list_all_fields': repeat('GET', f'{base}?size=50&all_fields=true'),
+        'list_page_100': repeat('GET', f'{base}?size=100&all_fields=true'),
+        'order': repeat('GET', f'{base}?size=50&order_by=int1&ascending=false'),
+        'detail': detail,
+        'create': create,
+        'update': update(ADMIN),
+        'update_with_permission': update(USER),
+        'review': review,
+        'permissions': repeat('GET', f'/permissions?recipient_type=User'
+                                     f'&recipient_id={dataset.user_id}'),
+        'check_permissions': repeat('POST', '/permissions/check', user=USER, body=[
+            {'permission': permission, 'obj_type': 'Entity', 'obj_id': id_}
+            for id_ in ids[:50] for permission in ('ENT_U', 'ENT_D')
+        ]),
+    }
+    filters = []
+    if AttrType.INT in by_type:
+        filters.append(f'{by_type[AttrType.INT]}.gt=5000')
+    if AttrType.STR in by_type:
+        filters.append(f'{by_type[AttrType.STR]}.contains=alpha')
+    if filters:
+        scenarios['filter'] = repeat('GET', f'{base}?size=50&' + '&'.join(filters))
+    if AttrType.FK in by_type and AttrType.STR in by_type:
+        scenarios['filter_fk'] = repeat(
+            'GET', f'{base}?size=50&{by_type[AttrType.FK]}.{by_type[AttrType.STR]}.contains=alpha'
+        )
+    if 'int1' not in dataset.attributes:
+        del scenarios['order']
+    return scenarios
+
+
+def _parse_server_timing(header: str) -> Tuple[int, float]:
+    '''Returns number of SQL statements and milliseconds spent in database'''
+    queries, db_time = 0, 0.0
+    for metric in header.split(', '):
+        name, *params = metric.split(';')
+        if name != 'db':
+            continue
+        for param in params:
+            key, _, value = param.partition('=')
+            if key == 'dur':
+                db_time = float(value)
+            elif key == 'desc':
+                queries = int(value.strip('"').split()[0])
+    return queries, db_time
+
+
+def _summary(durations: List[float], queries: List[int], db_times: List[float]) -> dict:
+    durations = sorted(durations)
+    return {
+        'n': len(durations),
+        'min_ms': round(durations[0], 3),
+        'median_ms': round(statistics.median(durations), 3),
+        'p95_ms': round(durations[max(0, int(len(durations) * 0.95 + 0.5) - 1)], 3),
+        'mean_ms': round(statistics.fmean(durations), 3),
+        'queries': round(statistics.fmean(queries), 2),
+        'db_ms': round(statistics.fmean(db_times), 3),
+    }
+
+
+def run_scenario(client: TestClient, tokens: Dict[str, str], scenario: Iterator[Request],
+                 iterations: int, warmup: int) -> Optional[dict]:
+    durations, queries, db_times = [], [], []
+    for idx, (method, url, body, user) in enumerate(scenario):
+        if idx >= iterations + warmup:
+            break
+        start = time.perf_counter()
+        response = client.request(method, url, json=body,
+                                  headers={'Authorization': f'Bearer {tokens[user]}'})
+        duration = (time.perf_counter() - start) * 1000
+        if response.status_code >= 400:
+            raise RuntimeError(f'{method} {url} returned {response.status_code}: {response.text}')
+        if idx < warmup:
+            continue
+        durations.append(duration)
+        q, db_time = _parse_server_timing(response.headers.get('server-timing', ''))
+        queries.append(q)
+        db_times.append(db_time)
+    return _summary(durations, queries, db_times) if durations else None
+
+
+def _cycle_n(items: list, n: int) -> Iterator:
+    for _, item in zip(range(n), cycle(items)):
+        yield item
+
+
+def run_permission_check(db, dataset: Dataset, iterations: int) -> dict:
+    '''Times `has_permission` for `USER`, who is granted the permission through a group'''
+    user = get_user(db, USER)
+    durations, queries, db_times = [], [], []
+    for id_ in _cycle_n(dataset.entity_ids, iterations):
+        permission = RequirePermission(permission=PermissionType.UPDATE_ENTITY,
+                                       target=Entity(id=id_))
+        start = time.perf_counter()
+        with count_queries() as stats:
+            if not has_permission(user=user, permission=permission, db=db):
+                raise RuntimeError(f'{USER} is not allowed to update entity {id_}')
+        durations.append((time.perf_counter() - start) * 1000)
+        queries.append(stats.queries)
+        db_times.append(stats.db_time * 1000)
+    return _summary(durations, queries, db_times)
+
+
+def run_serialization(db, dataset: Dataset, iterations: int) -> Dict[str, dict]:
+    '''Times rendering of pages with all fields by `ListingSerializer`, at once and streamed,
+    and by validation against the response model as FastAPI does it. The API allows pages
+    of at most 100 entities, bigger pages show how the ways scale
+    '''
+    schema = crud.get_schema(db, dataset.schema_slug)
+    model = Page[factory(schema=schema, variant=ModelVariant.GET)]
+    serializer = ListingSerializer(factory(schema=schema, variant=ModelVariant.GET))
+    response_class = json_response_class()
+    stream_min_items = config.settings.stream_min_items
+
+    def rendered(page: Page) -> bytes:
+        config.settings.stream_min_items = 0
+        return serializer.render_page(page).body
+
+    def streamed(page: Page) -> bytes:
+        config.settings.stream_min_items = 1
+        body = serializer.render_page(page).body_iterator
+
+        async def collect() -> bytes:
+            return b''.join([i async for i in body])
+        return asyncio.run(collect())
+
+    def validated(page: Page) -> bytes:
+        value = model.parse_obj(page.dict(exclude_unset=True))
+        return response_class(jsonable_encoder(value, by_alias=True, exclude_unset=True)).body
+
+    results = {}
+    try:
+        for size in SERIALIZATION_PAGE_SIZES:
+            page = crud.get_entities(db, schema, params=Params.construct(page=1, size=size),
+                                     all_fields=True)
+            if not rendered(page) == streamed(page) == validated(page):
+                raise RuntimeError(f'Serialized pages of {size} entities differ')
+            for name, render in ((f'serialize_{size}', rendered),
+                                 (f'serialize_{size}_streamed', streamed),
+                                 (f'serialize_{size}_validated', validated)):
+                durations = []
+                for _ in range(iterations):
+                    start = time.perf_counter()
+                    render(page)
+                    durations.append((time.perf_counter() - start) * 1000)
+                results[name] = _summary(durations, [0] * iterations, [0.0] * iterations)
+    finally:
+        config.settings.stream_min_items = stream_min_items
+    return results
+
+
+def run_attr_values(db, dataset: Dataset, iterations: int) -> Dict[str, dict]:
+    '''Times loading of values of all attributes for pages of entities, which listings and
+    change histories do. Sizes bigger than the dataset are skipped
+    '''
+    schema = crud.get_schema(db, dataset.schema_slug)
+    results = {}
+    for size in ATTR_VALUES_PAGE_SIZES:
+        if size > len(dataset.entity_ids):
+            continue
+        entities = db.execute(select(Entity).where(Entity.id.in_(dataset.entity_ids[:size])))\
+            .scalars().all()
+        durations, queries, db_times = [], [], []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            with count_queries() as stats:
+                crud._get_attr_values_batch(db, entities, schema.attr_defs)
+            durations.append((time.perf_counter() - start) * 1000)
+            queries.append(stats.queries)
+            db_times.append(stats.db_time * 1000)
+        results[f'attr_values_{size}'] = _summary(durations, queries, db_times)
+    return results
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(__file__)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, baseline: dict) -> str:
+    '''Returns table with ratio of median latency and number of queries to `baseline`'''
+    lines = [f'{"scenario":<24} {"median ms":>10} {"baseline":>10} {"ratio":>7} '
+             f'{"queries":>8} {"baseline":>8}']
+    for name, result in results['scenarios'].items():
+        base = baseline.get('scenarios', {}).get(name)
+        if base is None:
+            lines.append(f'{name:<24} {result["median_ms"]:>10.2f} {"-":>10} {"-":>7} '
+                         f'{result["queries"]:>8} {"-":>8}')
+            continue
+        ratio = result['median_ms'] / base['median_ms'] if base['median_ms'] else float('inf')
+        lines.append(f'{name:<24} {result["median_ms"]:>10.2f} {base["median_ms"]:>10.2f} '
+                     f'{ratio:>7.2f} {result["queries"]:>8} {base["queries"]:>8}')
+    return '\n'.join(lines)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='python -m backend.benchmarks',
+                                     description='Benchmarks API on synthetic EAV data')
+    for field in fields(DatasetConfig):
+        parser.add_argument(f'--{field.name.replace("_", "-")}', type=int, default=field.default,
+                            dest=field.name)
+    parser.add_argument('--database', default=f'bench_{config.settings.pg_db}',
+                        help='Database to fill, its content is dropped')
+    parser.add_argument('--iterations', type=int, default=50, help='Measured requests per scenario')
+    parser.add_argument('--warmup', type=int, default=5, help='Unmeasured requests per scenario')
+    parser.add_argument('--scenario', action='append', dest='scenarios',
+                        help='Run only this scenario, can be repeated')
+    parser.add_argument('--cache', choices=['', 'memory'], default='',
+                        help='Response cache backend, off by default')
+    parser.add_argument('--output', help='File to write JSON results to, stdout by default')
+    parser.add_argument('--compare', help='JSON results of previous run to compare with')
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    dataset_config = DatasetConfig(**{i.name: getattr(args, i.name) for i in fields(DatasetConfig)})
+    url = _database_url(args.database)
+    prepare_database(url)
+
+    engine = create_engine(url)
+    Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    with Session() as db:
+        start = time.perf_counter()
+        dataset = generate(db, dataset_config)
+        generation_time = time.perf_counter() - start
+
+    config.settings.instrumentation = True
+    config.settings.cache_backend = args.cache
+    cache.set_backend(None)
+
+    def get_bench_db():
+        db = Session()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    with Session() as db:
+        app = create_app(session=db)
+    app.dependency_overrides[get_db] = get_bench_db
+    tokens = {i: create_access_token({'sub': i}, timedelta(hours=1))[0] for i in (ADMIN, USER)}
+
+    results = {
+        'commit': _git_commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'dataset': asdict(dataset_config),
+        'generation_s': round(generation_time, 3),
+        'iterations': args.iterations,
+        'scenarios': {},
+    }
+    with TestClient(app) as client:
+        for name, scenario in _scenarios(dataset).items():
+            if args.scenarios and name not in args.scenarios:
+                continue
+            config.settings.enforce_read_permissions = name in READ_ENFORCED
+            result = run_scenario(client, tokens, scenario(), args.iterations, args.warmup)
+            if result is not None:
+                results['scenarios'][name] = result
+    if not args.scenarios or 'permission_check' in args.scenarios:
+        with Session() as db:
+            results['scenarios']['permission_check'] = run_permission_check(db, dataset,
+                                                                             args.iterations)
+    if not args.scenarios or 'serialization' in args.scenarios:
+        with Session() as db:
+            results['scenarios'].update(run_serialization(db, dataset, args.iterations))
+    if not args.scenarios or 'attr_values' in args.scenarios:
+        with Session() as db:
+            results['scenarios'].update(run_attr_values(db, dataset, args.iterations))
+    engine.dispose()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(results, json.load(f)), file=sys.stderr)
@@ -0,0 +1,292 @@
+"""
+Response cache for read-heavy routes.
+
+Cached responses are stored under keys that include current generation of every scope
+the route depends on. Committing a session that wrote to tables of a scope increments
+its generation, so stale responses are never looked up again and just expire.
+"""
+import hashlib
+import json
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from functools import wraps
+from itertools import chain
+from typing import AsyncIterator, Callable, Hashable, Iterable, List, Optional, Tuple
+
+from fastapi import Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from sqlalchemy.orm import Session, ORMExecuteState
+
+from .config import settings
+from .etag import conditional_response
+
+
+class CacheBackend(ABC):
+    @abstractmethod
+    def get(self, key: str) -> Optional[bytes]:
+        return NotImplemented
+
+    @abstractmethod
+    def set(self, key: str, value: bytes, ttl: int):
+        return NotImplemented
+
+    @abstractmethod
+    def get_generations(self, scopes: Iterable[str]) -> List[int]:
+        return NotImplemented
+
+    @abstractmethod
+    def bump(self, scopes: Iterable[str]):
+        return NotImplemented
+
+
+class LRUBackend(CacheBackend):
+    '''In-process cache. Generations are local to process as well, so with several
+    worker processes a write in one of them doesn't invalidate cache of the others
+    '''
+    def __init__(self, size: int = 1024):
+        self.size = size
+        self._data: OrderedDict[str, Tuple[float, bytes]] = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes, ttl: int):
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def get_generations(self, scopes: Iterable[str]) -> List[int]:
+        with self._lock:
+            return [self._generations.get(i, 0) for i in scopes]
+
+    def bump(self, scopes: Iterable[str]):
+        with self._lock:
+            for scope in scopes:
+                self._generations[scope] = self._generations.get(scope, 0) + 1
+
+
+class RedisBackend(CacheBackend):
+    '''Cache shared by all processes in a Redis (or protocol compatible) server'''
+    def __init__(self, url: str = None, client=None, prefix: str = 'aimaas:'):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.client.get(self.prefix + key)
+
+    def set(self, key: str, value: bytes, ttl: int):
+        self.client.set(self.prefix + key, value, ex=ttl)
+
+    def get_generations(self, scopes: Iterable[str]) -> List[int]:
+        scopes = list(scopes)
+        if not scopes:
+            return []
+        values = self.client.mget([f'{self.prefix}gen:{i}' for i in scopes])
+        return [int(i or 0) for i in values]
+
+    def bump(self, scopes: Iterable[str]):
+        pipe = self.client.pipeline(transaction=False)
+        for scope in scopes:
+            pipe.incr(f'{self.prefix}gen:{scope}')
+        pipe.execute()
+
+
+_backend: Optional[CacheBackend] = None
+_backend_lock = threading.Lock()
+
+
+def get_backend() -> Optional[CacheBackend]:
+    '''Returns cache backend configured by `settings.cache_backend`
+    or `None` if caching is off
+    '''
+    global _backend
+    if _backend is None and settings.cache_backend:
+        with _backend_lock:
+            if _backend is None:
+                if settings.cache_backend == 'memory':
+                    _backend = LRUBackend(size=settings.cache_size)
+                elif settings.cache_backend == 'redis':
+                    _backend = RedisBackend(url=settings.cache_url)
+                else:
+                    raise ValueError(f'Unknown cache backend: {settings.cache_backend}')
+    return _backend
+
+
+def set_backend(backend: Optional[CacheBackend]):
+    global _backend
+    _backend = backend
+
+
+# Scopes, whose cached responses become stale when table is written to
+TABLE_SCOPES = {
+    'schemas': ('schemas', 'entities'),
+    'attributes': ('schemas', 'entities'),
+    'attr_definitions': ('schemas', 'entities'),
+    'entities': ('entities',),
+    'change_requests': ('changes',),
+    'changes': ('changes',),
+    'effective_permissions': ('permissions',),
+    'group_closure': ('permissions',),
+    'permissions': ('permissions',),
+}
+
+
+def _scopes_for_table(table: str) -> Tuple[str, ...]:
+    if table.startswith('values_'):
+        return ('entities',)
+    if table.startswith('change_values_'):
+        return ('changes',)
+    return TABLE_SCOPES.get(table, ())
+
+
+def mark_written(session: Session, *tables: str):
+    '''Makes committing `session` invalidate scopes of `tables`. Writes through the ORM
+    and SQL expressions are noticed by themselves, textual SQL has to be marked
+    '''
+    session.info.setdefault('cache_tables', set()).update(tables)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _collect_executed(orm_execute_state: ORMExecuteState):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        table = orm_execute_state.statement.table
+        orm_execute_state.session.info.setdefault('cache_tables', set()).add(table.name)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_flushed(session: Session, flush_context):
+    tables = session.info.setdefault('cache_tables', set())
+    for obj in chain(session.new, session.dirty, session.deleted):
+        tables.add(obj.__table__.name)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate(session: Session):
+    tables = session.info.pop('cache_tables', None)
+    parent = session.info.get('parent_session')
+    if parent is not None:
+        # session only released a savepoint in transaction of `parent`
+        parent.info.setdefault('cache_tables', set()).update(tables or ())
+        return
+    backend = get_backend()
+    if not tables or backend is None:
+        return
+    scopes = {scope for table in tables for scope in _scopes_for_table(table)}
+    if scopes:
+        backend.bump(sorted(scopes))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget(session: Session):
+    session.info.pop('cache_tables', None)
+
+
+def _make_key(request: Request, generations: List[int], context: Hashable) -> str:
+    route = request.scope.get('route')
+    parts = (
+        request.method,
+        route.path if route is not None else request.url.path,
+        sorted(request.path_params.items()),
+        sorted(request.query_params.multi_items()),
+        generations,
+        context
+    )
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def cached(*scopes: str, context: Optional[Callable[[Request], Hashable]] = None):
+    '''Caches response of decorated route for `settings.cache_ttl` seconds or
+    until some data from `scopes` changes. Route must have a `request` parameter
+    and has to be registered with `CachedRoute`.
+
+    Response is looked up after dependencies of route are resolved, so permission
+    checks still happen on every request. `context` returns a value that makes the
+    response differ for the same query, e.g. user identity
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            backend = get_backend()
+            request: Request = kwargs['request']
+            if backend is None:
+                return func(*args, **kwargs)
+
+            generations = backend.get_generations(scopes)
+            key = _make_key(request, generations, context(request) if context else None)
+            hit = backend.get(key)
+            if hit is not None:
+                headers, _, body = hit.partition(b'\n')
+                response = Response(content=body, headers=json.loads(headers))
+                if 'etag' in response.headers:
+                    last_modified = response.headers.get('last-modified')
+                    not_modified = conditional_response(
+                        request, response, response.headers['etag'],
+                        parsedate_to_datetime(last_modified) if last_modified else None
+                    )
+                    if not_modified is not None:
+                        return not_modified
+                return response
+            request.state.cache_key = key
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class CachedRoute(APIRoute):
+    '''Stores responses of routes decorated with `cached`'''
+    STORED_HEADERS = ('content-type', 'etag', 'last-modified', 'cache-control')
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def cached_handler(request: Request) -> Response:
+            response = await handler(request)
+            key = getattr(request.state, 'cache_key', None)
+            backend = get_backend()
+            if key is not None and backend is not None and response.status_code == 200:
+                headers = {k: v for k, v in response.headers.items() if k in self.STORED_HEADERS}
+                prefix = json.dumps(headers).encode() + b'\n'
+                if isinstance(response, StreamingResponse):
+                    response.body_iterator = self._store_streamed(
+                        backend, key, prefix, response.body_iterator
+                    )
+                else:
+                    await run_in_threadpool(backend.set, key, prefix + response.body,
+                                            settings.cache_ttl)
+            return response
+
+        return cached_handler
+
+    @staticmethod
+    async def _store_streamed(backend: CacheBackend, key: str, prefix: bytes,
+                              body: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        '''Passes chunks of streamed response on and stores the whole response once
+        it was sent
+        '''
+        chunks = [prefix]
+        async for chunk in body:
+            chunks.append(chunk)
+            yield chunk
+        await run_in_threadpool(backend.set, key, b''.join(chunks), settings.cache_ttl)
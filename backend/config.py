@@ -25,6 +25,12 @@ class LdapSettings(BaseSettings):
     search_template: str = "(uid={username})"
     attr: LdapAttributeMap = LdapAttributeMap()
     timeout: int = 5
+    # Open connections are reused for `pool_lifetime` seconds, directory data of users
+    # is cached for `cache_ttl` seconds (0 turns the cache off)
+    pool_size: int = 10
+    pool_lifetime: int = 300
+    cache_ttl: int = 300
+    cache_size: int = 1000
 
     class Config:
         env_file = '.env'
@@ -51,6 +57,44 @@ class Settings(BaseSettings):
     pg_client_encoding: str = "utf8"
 
     default_page_size: int = 10
+    traversal_max_depth: int = 10
+    traversal_max_nodes: int = 1000
+    filter_join_depth: int = 2
+    # Number of entity listing statements kept for reuse by their shape, 0 turns reuse off
+    statement_cache_size: int = 512
+    # Response cache: "memory" for in-process LRU, "redis" for shared cache at `cache_url`,
+    # empty to turn caching off. Use "redis" if app runs in several processes
+    cache_backend: str = ""
+    cache_url: str = "redis://localhost:6379/0"
+    cache_ttl: int = 300
+    cache_size: int = 1024
+    # Entity listings are rendered straight from database rows instead of being validated
+    # against their response models. Output is the same, off is meant for debugging
+    fast_serialization: bool = True
+    # Class of JSON responses: "json" encodes with standard library, "orjson" is faster,
+    # but needs orjson installed. Listings and change histories with at least
+    # `stream_min_items` items are streamed item by item, 0 turns streaming off
+    json_response: str = "json"
+    stream_min_items: int = 100
+    # Server-sent events: seconds between keep-alive comments and number of events
+    # buffered for a slow subscriber before further events are dropped for it.
+    # A lost listening connection is reopened after `events_reconnect_delay` seconds,
+    # the delay is doubled after every failed attempt up to `events_reconnect_max_delay`
+    events_keepalive: int = 15
+    events_queue_size: int = 100
+    events_reconnect_delay: float = 1
+    events_reconnect_max_delay: float = 60
+    # Adds `Server-Timing` header to responses and collects metrics per route
+    instrumentation: bool = False
+    # Exposes collected metrics for Prometheus at `/metrics`. The endpoint doesn't require
+    # authentication, so only turn it on when it can't be reached by anyone but the scraper
+    metrics_endpoint: bool = False
+    # Statements taking longer than `slow_query_ms` milliseconds are logged and listed
+    # at `/slow-queries`, this fraction of them is re-run to capture EXPLAIN ANALYZE output.
+    # 0 turns the slow query log off
+    slow_query_ms: float = 0
+    slow_query_explain_rate: float = 0.1
+    slow_query_log_size: int = 100
     timezone_offset: Union[str, int] = "utc"
 
     auth_backends: str = "local"
@@ -58,6 +102,13 @@ class Settings(BaseSettings):
     token_url = "/login"
     pwd_hash_alg: str = 'HS256'  # list of options can be found in jose.jwt.ALGORITHMS
     token_exp_minutes: int = 120
+    # Verified tokens are cached for this many seconds (0 turns the cache off). Changes
+    # of users made by other processes are noticed after this time
+    token_cache_ttl: int = 60
+    token_cache_size: int = 10000
+    # Entity listings require authentication and contain only entities the user may read,
+    # i.e. has READ_ENTITY permission for them or their schema. Off keeps listings public
+    enforce_read_permissions: bool = False
 
     ldap: LdapSettings = LdapSettings()
     help: HelpSettings = HelpSettings()
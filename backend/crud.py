@@ -1,25 +1,38 @@
-from typing import Callable, Dict, Tuple
-from collections import defaultdict, Counter
+import threading
+from datetime import datetime
+from typing import Callable, Collection, Dict, Hashable, Tuple
+from collections import OrderedDict, defaultdict, Counter
 from itertools import groupby
 
 from fastapi_pagination import Params, Page
 from fastapi_pagination.api import create_page
 from fastapi_pagination.ext.sqlalchemy import paginate_query
 from psycopg2.errors import ForeignKeyViolation
-from sqlalchemy import func, distinct, column, asc, desc, or_, select, update
-from sqlalchemy.orm import Session, aliased
+from sqlalchemy import func, distinct, column, asc, desc, or_, select, update, exists, literal, \
+    any_, all_, and_, bindparam, cast, Column, Float, Select
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.orm import Session, aliased, joinedload, selectinload
 from sqlalchemy.exc import IntegrityError, NoResultFound
-from sqlalchemy.sql.expression import delete, intersect
+from sqlalchemy.sql.elements import BindParameter
+from sqlalchemy.sql.expression import delete, intersect, ColumnElement
 from sqlalchemy.sql.selectable import CompoundSelect
 
-from .config import DEFAULT_PARAMS
-from .enum import FilterEnum
+from .auth.crud import readable_entities
+from .auth.models import User
+from .config import DEFAULT_PARAMS, settings
+from .database import STATEMENTS
+from .enum import EventType, FilterEnum, TraversalDirection
+from .events import publish
 from .models import (
+    ENTITY_FILTERS,
     AttrType,
     Attribute,
     AttributeDefinition,
+    Entity,
     Schema,
-    Value
+    Value,
+    ValueForeignKey,
+    schema_version_seq
 )
 
 from .schemas import (
@@ -35,6 +48,9 @@ from .utils import iterate_model_fields
 
 
 RESERVED_ATTR_NAMES = ['id', 'slug', 'deleted', 'name']
+# Loads definitions of schema attributes together with their attributes. Most uses of
+# a schema go through `attr_def.attribute`, which is loaded lazily one by one otherwise
+ATTR_DEFS_LOADER = selectinload(Schema.attr_defs).joinedload(AttributeDefinition.attribute)
 
 
 def get_attributes(db: Session) -> List[Attribute]:
@@ -73,8 +89,11 @@ def get_schemas(db: Session, all: bool = False, deleted_only: bool = False) -> L
     return db.execute(q).scalars().all()
 
 
-def get_schema(db: Session, id_or_slug: Union[int, str]) -> Schema:
+def get_schema(db: Session, id_or_slug: Union[int, str], attr_defs: bool = True) -> Schema:
+    '''Returns schema, its attribute definitions are loaded too unless `attr_defs` is false'''
     q = select(Schema)
+    if attr_defs:
+        q = q.options(ATTR_DEFS_LOADER)
     if isinstance(id_or_slug, int):
         q = q.where(Schema.id == id_or_slug)
     else:
@@ -86,6 +105,11 @@ def get_schema(db: Session, id_or_slug: Union[int, str]) -> Schema:
     return schema
 
 
+def get_schemas_version(db: Session) -> Tuple[Optional[int], Optional[datetime]]:
+    '''Returns the latest version of all schemas and time of the latest change'''
+    return tuple(db.execute(select(func.max(Schema.version), func.max(Schema.updated_at))).one())
+
+
 def _check_bound_schema_id(db: Session, schema_id: int):
     try:
         schema = db.query(Schema).filter(Schema.id == schema_id).one()
@@ -132,6 +156,7 @@ def create_schema(db: Session, data: SchemaCreateSchema, commit: bool = True) ->
             )
             db.add(ad)
             db.flush()
+        publish(db, EventType.SCHEMA, 'create', id=sch.id, slug=sch.slug)
         if commit:
             db.commit()
         else:
@@ -162,6 +187,7 @@ def delete_schema(db: Session, id_or_slug: Union[int, str], commit: bool = True)
                .where(Entity.schema_id == schema.id, Entity.deleted == False)
                .values(deleted=True))
     schema.deleted = True
+    publish(db, EventType.SCHEMA, 'delete', id=schema.id, slug=schema.slug)
     if commit:
         db.commit()
     else:
@@ -329,6 +355,11 @@ def update_schema(db: Session, id_or_slug: Union[int, str], data: SchemaUpdateSc
     for attr in added:
         _add_attr_to_schema(db=db, attr_schema=attr, schema=schema)
 
+    # bump version even if only attribute definitions changed
+    db.execute(update(Schema).where(Schema.id == schema.id)
+               .values(version=schema_version_seq.next_value(), updated_at=func.now()))
+    publish(db, EventType.SCHEMA, 'update', id=schema.id, slug=data.slug or schema.slug)
+
     try:
         if commit:
             db.commit()
@@ -340,91 +371,112 @@ def update_schema(db: Session, id_or_slug: Union[int, str], data: SchemaUpdateSc
     return schema
 
 
-def _get_entity_data(db: Session, entity: Entity, attr_names: List[str]) -> Dict[str, Any]:
-    data = {'id': entity.id, 'slug': entity.slug, 'deleted': entity.deleted, 'name': entity.name}
-    for attr in attr_names:
-        val_obj = entity.get(attr, db)
-        try:
-            if isinstance(val_obj, list):
-                data[attr] = [i.value for i in val_obj]
-            else:
-                data[attr] = val_obj.value
-        except AttributeError:
-            data[attr] = None
-    return data
+def _get_attr_defs(schema: Schema, attr_names: List[str]) -> List[AttributeDefinition]:
+    '''Returns definitions of attributes from `attr_names` in the same order'''
+    attr_defs = {i.attribute.name: i for i in schema.attr_defs}
+    for attr_name in attr_names:
+        if attr_name not in attr_defs:
+            raise AttributeNotDefinedException(attr_name, schema.id)
+    return [attr_defs[i] for i in dict.fromkeys(attr_names)]
 
 
 def _get_attr_values_batch(db: Session, entities: List[Entity], attrs_to_include: List[AttributeDefinition]) -> List[dict]:
     '''Gets attr. values for list of entities by splitting attrs in
     groups by type to select multiple attributes for all entities
-    in one query
+    in one query. Only value columns are selected, values of list
+    attributes are sorted by the database
     '''
-    results_map = {
-        entity.id: {
-            'id': entity.id, 
-            'slug': entity.slug, 
-            'deleted': entity.deleted, 
-            'name': entity.name
-        } 
+    by_id = {
+        entity.id: {'id': entity.id, 'slug': entity.slug, 'deleted': entity.deleted,
+                    'name': entity.name}
         for entity in entities
     }
-
-    for i in results_map.values():
-        for attr_def in attrs_to_include:
-            if attr_def.list:
-                i.update({attr_def.attribute.name: []})
-            else:
-                i.update({attr_def.attribute.name: None})
-
-    attr_groups: Dict[str, List[Attribute]] = defaultdict(list)
-    attributes = [i.attribute for i in attrs_to_include]
-    for attr in attributes:
-        attr_groups[attr.type.name].append(attr)
-    
-    ent_ids = [i.id for i in entities]
-    attr_map = {i.attribute.id: i.attribute.name for i in attrs_to_include}
-    for group, attrs in attr_groups.items():
-        value_model: Value = AttrType[group].value.model
+    results = list(by_id.values())
+    if not results or not attrs_to_include:
+        return results
+
+    # (key, is list) by attribute id
+    columns = {i.attribute.id: (i.attribute.name, i.list) for i in attrs_to_include}
+    empty = dict.fromkeys(name for name, _ in columns.values())
+    list_names = [name for name, listed in columns.values() if listed]
+    for result in results:
+        result.update(empty)
+        for name in list_names:
+            result[name] = []
+
+    attr_groups: Dict[AttrType, List[int]] = defaultdict(list)
+    for attr_def in attrs_to_include:
+        attr_groups[attr_def.attribute.type].append(attr_def.attribute.id)
+
+    ent_ids = list(by_id)
+    for type_, attr_ids in attr_groups.items():
+        value_model: Value = type_.value.model
         q = (
-            select(value_model)
-            .where(value_model.entity_id.in_(ent_ids))
-            .where(value_model.attribute_id.in_([i.id for i in attrs]))
+            select(value_model.entity_id, value_model.attribute_id, value_model.value)
+            .where(_filter_clause(value_model.entity_id, FilterEnum.IN, ent_ids))
+            .where(_filter_clause(value_model.attribute_id, FilterEnum.IN, attr_ids))
         )
-        rows = db.execute(q).scalars().all()
-        for r in rows:
-            ent: dict = results_map[r.entity_id]
-            attr: str = attr_map[r.attribute_id]
-            if isinstance(ent[attr], list):
-                ent[attr].append(r.value)
+        if any(columns[i][1] for i in attr_ids):
+            # "C" collation sorts strings by code points, as `sorted` does
+            q = q.order_by(value_model.value.collate('C') if type_ == AttrType.STR
+                           else value_model.value)
+        for entity_id, attribute_id, value in db.execute(q):
+            name, listed = columns[attribute_id]
+            if listed:
+                by_id[entity_id][name].append(value)
             else:
-                ent[attr] = r.value
-
-    for entity in results_map.values():
-        for attr in entity:
-            if isinstance(entity[attr], list):
-                entity[attr].sort()
-    
-    results = list(results_map.values())  
+                by_id[entity_id][name] = value
     return results
 
 
-def _parse_filters(filters: dict, attrs: List[str]) \
-        -> Tuple[Dict[str, Dict[FilterEnum, Any]], Dict[FilterEnum, Any]]:
+def _filter_clause(column: Column, filter: FilterEnum, value: Any) -> ColumnElement:
+    '''Returns condition applying `filter` with `value` to `column`.
+    Set membership is compiled to `= ANY(:array)`, so the statement
+    stays the same regardless of how many values are passed.
+    `value` may be a bound parameter, see `_bind_filters`
+    '''
+    if filter in (FilterEnum.IN, FilterEnum.NIN):
+        if isinstance(value, BindParameter):
+            array = bindparam(value.key, type_=ARRAY(column.type))
+        else:
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            array = literal(list(values), ARRAY(column.type))
+        return column == any_(array) if filter == FilterEnum.IN else column != all_(array)
+    return getattr(column, filter.value.op)(value)
+
+
+def _parse_filters(filters: dict, attrs: Dict[str, Collection[FilterEnum]],
+                   fk_attrs: Dict[str, Collection[str]] = None) \
+        -> Tuple[Dict[str, Dict[FilterEnum, Any]], Dict[FilterEnum, Any], Dict[str, dict]]:
     '''
-    Returns tuple of two `dict`s like `{attr_name: {op1: value, op2: value}}`.
-    First `dict` is for attribute filters, second is for `Entity.name` filters
+    Returns tuple of three `dict`s. First two are like `{attr_name: {op1: value, op2: value}}`,
+    first one is for attribute filters, second is for `Entity` fields filters.
+    `attrs` maps names of attributes to filters allowed on them. Third one maps names of FK attributes from `fk_attrs` to filters for referenced
+    entities, e.g. `rack.site.name.eq` becomes `{'rack': {'site.name.eq': value}}`.
+
+    `fk_attrs` maps names of FK attributes to names of fields and attributes of referenced
+    entities. A filter is on referenced entities only if the part after the name of FK
+    attribute starts with one of those, so `rack.eq` stays a filter on `rack` itself
     '''
     filter_map = {f.value.name: f for f in FilterEnum}
-    entity_fields = ('name', 'slug')
+    entity_fields = ENTITY_FILTERS
     attr_filters = defaultdict(dict)
     entity_filters = defaultdict(dict)
+    join_filters = defaultdict(dict)
+    fk_attrs = fk_attrs or {}
     for f, v in filters.items():
+        fk_attr, _, join_filter = f.partition('.')
+        if fk_attr in fk_attrs and join_filter.split('.', maxsplit=1)[0] in fk_attrs[fk_attr]:
+            join_filters[fk_attr][join_filter] = v
+            continue
+
         split = f.rsplit('.', maxsplit=1)
         attr = split[0]
         filter = FilterEnum.EQ if len(split) == 1 else filter_map.get(split[-1], None)
         if attr not in entity_fields and attr not in attrs:
-            raise InvalidFilterAttributeException(attr=attr, allowed_attrs=attrs)
-        if not filter:
+            raise InvalidFilterAttributeException(attr=attr, allowed_attrs=list(attrs))
+        allowed = entity_fields[attr] if attr in entity_fields else attrs[attr]
+        if not filter or filter not in allowed:
             raise InvalidFilterOperatorException(attr=attr, filter=split[-1])
 
         if attr in entity_fields:
@@ -432,18 +484,31 @@ def _parse_filters(filters: dict, attrs: List[str]) \
         else:
             attr_filters[attr][filter] = v
 
-    return attr_filters, entity_filters
+    return attr_filters, entity_filters, join_filters
 
 
-def _query_entity_with_filters(filters: dict, schema: Schema, all: bool = False,
-                               deleted_only: bool = False) -> CompoundSelect:
+def _query_entity_with_filters(db: Session, filters: dict, schema: Schema, all: bool = False,
+                               deleted_only: bool = False, depth: int = 0) -> CompoundSelect:
     '''
     Returns intersection query of several queries with filters
-    to get entities that satisfy all conditions from `filters`
+    to get entities that satisfy all conditions from `filters`.
+
+    Filters on referenced entities are compiled into a subquery on the bound schema,
+    nesting at most `settings.filter_join_depth` levels deep
     '''
     attrs = {i.attribute.name: i.attribute
              for i in schema.attr_defs if i.attribute.type.value.filters}
-    attr_filters, entity_filters = _parse_filters(filters=filters, attrs=attrs.keys())
+    list_attrs = {i.attribute.name for i in schema.attr_defs if i.list}
+    fk_attrs = {i.attribute.name: i for i in schema.attr_defs
+                if i.attribute.type == AttrType.FK and i.bound_schema_id is not None}
+    referenced_names = {
+        name: ENTITY_FILTERS.keys() | {i.attribute.name for i in attr_def.bound_schema.attr_defs}
+        for name, attr_def in fk_attrs.items()
+    }
+    attr_filters, entity_filters, join_filters = _parse_filters(
+        filters=filters, attrs={name: attr.type.value.filters for name, attr in attrs.items()},
+        fk_attrs=referenced_names
+    )
     selects = []
 
     # Add filters for entity model
@@ -457,46 +522,135 @@ def _query_entity_with_filters(filters: dict, schema: Schema, all: bool = False,
                 if field is None:
                     raise AttributeError(f"Entity has no field {field_name}")
 
-                q = q.where(getattr(Entity.name, f.value.op)(v))
+                q = q.where(_filter_clause(field, f, v))
         selects.append(q)
 
     # Add filters for attribute values
     for attr_name, filters in attr_filters.items():
         attr = attrs[attr_name]
         value_model = attr.type.value.model
+        isnull = filters.pop(FilterEnum.ISNULL, None)
+        if isnull is not None:
+            # anti-join (or semi-join) against value table
+            has_value = exists().where(value_model.entity_id == Entity.id,
+                                       value_model.attribute_id == attr.id)
+            q = select(Entity).where(Entity.schema_id == schema.id,
+                                     ~has_value if isnull else has_value)
+            if not all:
+                q = q.where(Entity.deleted == deleted_only)
+            selects.append(q)
+        # a listed value matches `nin` only if none of its items is in the list
+        nin = filters.pop(FilterEnum.NIN, None) if attr_name in list_attrs else None
+        if not filters and nin is None:
+            continue
+
         q = select(Entity).where(Entity.schema_id == schema.id).join(value_model)
         if not all:
             q = q.where(Entity.deleted == deleted_only)
         for filter, value in filters.items():
-            q = q.where(getattr(value_model.value, filter.value.op)(value))
+            q = q.where(_filter_clause(value_model.value, filter, value))
+        if nin is not None:
+            item = aliased(value_model)
+            q = q.where(~exists().where(item.entity_id == Entity.id,
+                                        item.attribute_id == attr.id,
+                                        _filter_clause(item.value, FilterEnum.IN, nin)))
         q = q.where(value_model.attribute_id == attr.id)
         selects.append(q)
+
+    # Add filters for referenced entities
+    for attr_name, filters in join_filters.items():
+        if depth >= settings.filter_join_depth:
+            raise InvalidFilterAttributeException(attr=f'{attr_name}.{next(iter(filters))}',
+                                                  allowed_attrs=list(attrs))
+        attr_def = fk_attrs[attr_name]
+        bound_schema = db.get(Schema, attr_def.bound_schema_id)
+        referenced = _query_entity_with_filters(db=db, filters=filters, schema=bound_schema,
+                                                depth=depth + 1).subquery()
+        q = (select(Entity)
+             .where(Entity.schema_id == schema.id)
+             .join(ValueForeignKey, ValueForeignKey.entity_id == Entity.id)
+             .where(ValueForeignKey.attribute_id == attr_def.attribute_id,
+                    ValueForeignKey.value.in_(select(referenced.c.id))))
+        if not all:
+            q = q.where(Entity.deleted == deleted_only)
+        selects.append(q)
     return intersect(*selects)
 
 
-def get_entities(
-        db: Session,
-        schema: Schema,
-        params: Params = DEFAULT_PARAMS,
-        all: bool = False,
-        deleted_only: bool = False,
-        all_fields: bool = False,
-        filters: dict = None,
-        order_by: str = 'name',
-        ascending: bool = True,
-    ) -> Page[EntityBaseSchema]:
-    if order_by != 'name':
-        attrs = [i for i in schema.attr_defs if i.attribute.name == order_by]
-        if not attrs:
-            raise AttributeNotDefinedException(order_by, schema.id)
+class StatementCache:
+    '''Statements of entity listings by their shape, i.e. everything that determines
+    the statement except values of filters, pagination and id of the reader. Those are
+    bound as parameters, so listings differing only in them skip building the statement
+    and share the SQL compiled by SQLAlchemy for it. Schema versions are part of shapes,
+    so statements built for older definitions of schemas are just never looked up again
+    '''
+    def __init__(self):
+        self._statements: OrderedDict[Hashable, Tuple[Select, Select]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, shape: Hashable) -> Optional[Tuple[Select, Select]]:
+        with self._lock:
+            statements = self._statements.get(shape)
+            if statements is not None:
+                self._statements.move_to_end(shape)
+            return statements
+
+    def set(self, shape: Hashable, statements: Tuple[Select, Select]):
+        if settings.statement_cache_size <= 0:
+            return
+        with self._lock:
+            self._statements[shape] = statements
+            self._statements.move_to_end(shape)
+            while len(self._statements) > settings.statement_cache_size:
+                self._statements.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._statements.clear()
+
+
+statement_cache = StatementCache()
+
 
+def _bind_filters(filters: dict) -> Tuple[dict, dict]:
+    '''Returns copy of `filters` with values replaced by bound parameters and values
+    of those parameters. Values of `isnull` filters are kept, they change the statement
+    '''
+    bound, values = {}, {}
+    for idx, (f, v) in enumerate(sorted(filters.items())):
+        op = f.rsplit('.', maxsplit=1)[-1]
+        if op == FilterEnum.ISNULL.value.name:
+            bound[f] = v
+            continue
+        if op in (FilterEnum.IN.value.name, FilterEnum.NIN.value.name):
+            v = list(v) if isinstance(v, (list, tuple, set)) else [v]
+        name = f'filter_{idx}'
+        bound[f], values[name] = bindparam(name), v
+    return bound, values
+
+
+def _listing_statements(db: Session, schema: Schema, filters: dict, all: bool,
+                        deleted_only: bool, order_by: str, ascending: bool,
+                        reader: bool) -> Tuple[Select, Select]:
+    '''Returns statements counting and listing a page of entities of `schema`.
+    Pagination is bound to parameters `limit` and `offset`, reader to `reader_id`
+    '''
     if filters:
-        q = _query_entity_with_filters(filters=filters, schema=schema, all=all, deleted_only=deleted_only)
+        q = _query_entity_with_filters(db=db, filters=filters, schema=schema, all=all,
+                                       deleted_only=deleted_only)
+        if reader:
+            readable = select(Entity).where(
+                Entity.schema_id == schema.id,
+                readable_entities(user_id=bindparam('reader_id'), schema_id=schema.id)
+            )
+            q = intersect(*q.selects, readable)
     else:
         q = select(Entity).where(Entity.schema_id == schema.id)
         if not all:
             q = q.where(Entity.deleted == deleted_only)
-    total = db.execute(select(func.count(distinct(column('id')))).select_from(q.subquery())).scalar()
+        if reader:
+            q = q.where(readable_entities(user_id=bindparam('reader_id'), schema_id=schema.id))
+    count = select(func.count(distinct(column('id')))).select_from(q.subquery())
     try:
         queries = q.selects
         q1 = queries[0]
@@ -530,23 +684,353 @@ def get_entities(
     else:
         direction = 'asc' if ascending else 'desc'
         q = q.order_by(getattr(Entity.name, direction)())
-    q = paginate_query(q, params)
-    entities = list(db.execute(select(Entity).from_statement(q)).scalars().all())
-    attr_defs = schema.attr_defs if all_fields else [i for i in schema.attr_defs
-                                                     if i.key or i.attribute.name == order_by]
+    q = q.limit(bindparam('limit')).offset(bindparam('offset'))
+    return count, select(Entity).from_statement(q)
+
+
+def get_entities(
+        db: Session,
+        schema: Schema,
+        params: Params = DEFAULT_PARAMS,
+        all: bool = False,
+        deleted_only: bool = False,
+        all_fields: bool = False,
+        filters: dict = None,
+        order_by: str = 'name',
+        ascending: bool = True,
+        fields: Optional[List[str]] = None,
+        reader: Optional[User] = None,
+    ) -> Page[EntityBaseSchema]:
+    '''Lists entities of `schema` with values of key attributes, of all attributes
+    if `all_fields` is true or only of attributes in `fields` if those are passed.
+    If `reader` is passed, only entities the user may read are listed
+    '''
+    if fields is not None:
+        attr_defs = _get_attr_defs(schema, fields)
+    if order_by != 'name':
+        attrs = [i for i in schema.attr_defs if i.attribute.name == order_by]
+        if not attrs:
+            raise AttributeNotDefinedException(order_by, schema.id)
+
+    filters, values = _bind_filters(filters or {})
+    # filters on referenced entities depend on definitions of other schemas as well
+    fk_attrs = {i.attribute.name for i in schema.attr_defs
+                if i.attribute.type == AttrType.FK and i.bound_schema_id is not None}
+    joins = any(f.partition('.')[0] in fk_attrs for f in filters)
+    shape = (
+        schema.id, schema.version, get_schemas_version(db)[0] if joins else None,
+        tuple((f, None if isinstance(v, BindParameter) else v) for f, v in filters.items()),
+        all, deleted_only, order_by, ascending, reader is not None
+    )
+    statements = statement_cache.get(shape)
+    if statements is None:
+        statements = _listing_statements(db=db, schema=schema, filters=filters, all=all,
+                                         deleted_only=deleted_only, order_by=order_by,
+                                         ascending=ascending, reader=reader is not None)
+        statement_cache.set(shape, statements)
+    count, page = statements
+
+    raw_params = params.to_raw_params().as_limit_offset()
+    values.update(limit=raw_params.limit, offset=raw_params.offset)
+    if reader is not None:
+        values['reader_id'] = reader.id
+    total = db.execute(count, values).scalar()
+    entities = list(db.execute(page, values).scalars().all())
+    if fields is None:
+        attr_defs = schema.attr_defs if all_fields else [i for i in schema.attr_defs
+                                                         if i.key or i.attribute.name == order_by]
     entities = _get_attr_values_batch(db, entities, attr_defs)
     return create_page(entities, total, params)
 
 
-def get_entity_by_id(db: Session, entity_id: int) -> Entity:
-    entity = db.execute(select(Entity).where(Entity.id == entity_id)).scalar()
+AGGREGATE_GROUP_TYPES = (AttrType.STR, AttrType.INT, AttrType.BOOL, AttrType.DATE, AttrType.FK)
+AGGREGATE_METRIC_TYPES = (AttrType.INT, AttrType.FLOAT)
+AGGREGATE_FUNCTIONS = ('sum', 'avg', 'min', 'max')
+
+
+def aggregate_entities(
+        db: Session,
+        schema: Schema,
+        group_by: Optional[List[str]] = None,
+        metrics: Optional[List[str]] = None,
+        filters: dict = None,
+        all: bool = False,
+        deleted_only: bool = False,
+        reader: Optional[User] = None
+    ) -> List[dict]:
+    '''Groups entities by values of `group_by` attributes and computes `metrics` for each
+    group. Metric is either `count` or `<function>.<attr_name>` with function being
+    one of `AGGREGATE_FUNCTIONS`. Returns list of dicts like
+    `{'group': {attr_name: value}, 'metrics': {metric: value}}`.
+
+    Entity with several values of a listed `group_by` attribute falls into several groups,
+    values of listed metric attributes are all taken into account. If `reader` is passed,
+    only entities the user may read are aggregated
+    '''
+    group_by = group_by or []
+    metrics = metrics or ['count']
+    attr_defs = {i.attribute.name: i for i in schema.attr_defs}
+
+    if filters:
+        q = _query_entity_with_filters(db=db, filters=filters, schema=schema, all=all,
+                                       deleted_only=deleted_only)
+        if reader is not None:
+            q = intersect(*q.selects, select(Entity).where(
+                Entity.schema_id == schema.id,
+                readable_entities(user_id=reader.id, schema_id=schema.id)
+            ))
+    else:
+        q = select(Entity.id).where(Entity.schema_id == schema.id)
+        if not all:
+            q = q.where(Entity.deleted == deleted_only)
+        if reader is not None:
+            q = q.where(readable_entities(user_id=reader.id, schema_id=schema.id))
+    entities = q.subquery()
+    from_ = entities
+
+    group_columns = []
+    allowed = [name for name, i in attr_defs.items() if i.attribute.type in AGGREGATE_GROUP_TYPES]
+    for attr_name in group_by:
+        if attr_name not in allowed:
+            raise InvalidAggregationException(expr=attr_name, allowed=allowed)
+        attr = attr_defs[attr_name].attribute
+        value_model = aliased(attr.type.value.model)
+        from_ = from_.outerjoin(value_model, and_(value_model.entity_id == entities.c.id,
+                                                  value_model.attribute_id == attr.id))
+        group_columns.append(value_model.value)
+
+    # values of metric attributes are pre-aggregated per entity,
+    # so that listed attributes don't multiply rows of each other
+    per_entity = {}
+    metric_columns = []
+    allowed = ['count'] + [f'{func_}.{name}' for name, i in attr_defs.items()
+                           if i.attribute.type in AGGREGATE_METRIC_TYPES
+                           for func_ in AGGREGATE_FUNCTIONS]
+    for metric in metrics:
+        if metric not in allowed:
+            raise InvalidAggregationException(expr=metric, allowed=allowed)
+        if metric == 'count':
+            metric_columns.append(func.count(entities.c.id))
+            continue
+
+        func_, attr_name = metric.split('.', maxsplit=1)
+        if attr_name not in per_entity:
+            attr = attr_defs[attr_name].attribute
+            value_model = attr.type.value.model
+            sub = (select(value_model.entity_id,
+                          func.sum(value_model.value).label('sum'),
+                          func.count(value_model.value).label('count'),
+                          func.min(value_model.value).label('min'),
+                          func.max(value_model.value).label('max'))
+                   .where(value_model.attribute_id == attr.id)
+                   .group_by(value_model.entity_id)
+                   .subquery())
+            from_ = from_.outerjoin(sub, sub.c.entity_id == entities.c.id)
+            per_entity[attr_name] = sub
+        sub = per_entity[attr_name]
+        if func_ == 'avg':
+            metric_columns.append(cast(func.sum(sub.c.sum), Float) / func.nullif(func.sum(sub.c.count), 0))
+        elif func_ == 'sum':
+            metric_columns.append(func.sum(sub.c.sum))
+        else:
+            metric_columns.append(getattr(func, func_)(getattr(sub.c, func_)))
+
+    q = (select(*[c.label(f'g{idx}') for idx, c in enumerate(group_columns)],
+                *[c.label(f'm{idx}') for idx, c in enumerate(metric_columns)])
+         .select_from(from_))
+    if group_columns:
+        q = q.group_by(*group_columns).order_by(*group_columns)
+    return [
+        {'group': {name: row[f'g{idx}'] for idx, name in enumerate(group_by)},
+         'metrics': {name: row[f'm{idx}'] for idx, name in enumerate(metrics)}}
+        for row in db.execute(q).mappings().all()
+    ]
+
+
+def get_entities_version(db: Session, schema: Schema, filters: Optional[dict] = None) \
+        -> Tuple[Tuple[int, ...], Optional[datetime]]:
+    '''Returns versions of `schema` and of the latest changed entity in it along with time
+    of that change. If `filters` refer to other schemas, their latest versions are included
+    too. Any change that can affect listing of entities from `schema` changes the result
+    '''
+    schema_ids = [schema.id]
+    if filters:
+        prefixes = {f.split('.', maxsplit=1)[0] for f in filters if '.' in f}
+        bound_ids = db.execute(
+            select(AttributeDefinition.bound_schema_id)
+            .join(Attribute)
+            .where(AttributeDefinition.schema_id == schema.id, Attribute.name.in_(prefixes),
+                   AttributeDefinition.bound_schema_id.is_not(None))
+        ).scalars().all()
+        # bound schemas of bound schemas are reachable too, when join depth allows
+        for _ in range(settings.filter_join_depth - 1):
+            bound_ids += db.execute(
+                select(AttributeDefinition.bound_schema_id)
+                .where(AttributeDefinition.schema_id.in_(bound_ids),
+                       AttributeDefinition.bound_schema_id.is_not(None))
+            ).scalars().all()
+        schema_ids.extend(sorted(set(bound_ids) - {schema.id}))
+
+    versions = []
+    last_modified = None
+    for schema_id in schema_ids:
+        schema_version, schema_updated_at = db.execute(
+            select(Schema.version, Schema.updated_at).where(Schema.id == schema_id)
+        ).one()
+        # single index lookup on `(schema_id, version)`
+        entity_version, entity_updated_at = db.execute(
+            select(Entity.version, Entity.updated_at)
+            .where(Entity.schema_id == schema_id)
+            .order_by(Entity.version.desc())
+            .limit(1)
+        ).one_or_none() or (None, None)
+        versions.extend([schema_version, entity_version])
+        last_modified = max(i for i in (last_modified, schema_updated_at, entity_updated_at)
+                            if i is not None)
+    return tuple(versions), last_modified
+
+
+def get_entity_changes(db: Session, schema: Schema, since: int = 0, limit: int = 100,
+                       fields: Optional[List[str]] = None, reader: Optional[User] = None) -> dict:
+    '''Returns up to `limit` entities of `schema` created, updated, deleted or restored after
+    version `since`, in order of their versions. Every entity is returned only once, with its
+    current data and version.
+
+    Versions are assigned again when a change is committed, one transaction at a time, so
+    a version is never visible before all lower ones and no change is missed by asking for
+    changes since `last_version` of the previous response. If `reader` is passed, only
+    entities the user may read are returned
+    '''
+    attr_defs = schema.attr_defs if fields is None else _get_attr_defs(schema, fields)
+    # index scan on `(schema_id, version)`
+    q = select(Entity).where(Entity.schema_id == schema.id, Entity.version > since)
+    if reader is not None:
+        q = q.where(readable_entities(user_id=reader.id, schema_id=schema.id))
+    entities = db.execute(q.order_by(Entity.version).limit(limit + 1)).scalars().all()
+    has_more = len(entities) > limit
+    entities = entities[:limit]
+    changes = _get_attr_values_batch(db, entities, attr_defs)
+    for change, entity in zip(changes, entities):
+        change['version'] = entity.version
+    return {
+        'changes': changes,
+        'last_version': entities[-1].version if entities else since,
+        'has_more': has_more
+    }
+
+
+def get_entity_by_id(db: Session, entity_id: int, reader: Optional[User] = None) -> Entity:
+    '''Returns entity with id `entity_id`. If `reader` is passed, entity the user
+    may not read is missing for them
+    '''
+    q = select(Entity).where(Entity.id == entity_id).options(joinedload(Entity.schema))
+    if reader is not None:
+        q = q.where(readable_entities(user_id=reader.id))
+    entity = db.execute(q).scalar()
     if entity is None:
         raise MissingEntityException(obj_id=entity_id)
     return entity
 
 
-def get_entity_model(db: Session, id_or_slug: Union[int, str], schema: Schema) -> Entity:
-    q = select(Entity).where(Entity.schema_id == schema.id)
+def get_referencing_entities(db: Session, entity_id: int, schema: Optional[Schema] = None,
+                             attr_name: Optional[str] = None, all: bool = False,
+                             params: Params = DEFAULT_PARAMS,
+                             reader: Optional[User] = None) -> Page[dict]:
+    '''Returns entities that point to entity with id `entity_id` through one of their FK
+    attributes. Every reference is reported separately along with the name of the attribute
+    holding it, so an entity referring to the target via two attributes is listed twice.
+    If `reader` is passed, both the target and referring entities have to be readable by them
+    '''
+    get_entity_by_id(db=db, entity_id=entity_id, reader=reader)
+    q = (
+        select(Entity.id, Entity.slug, Entity.name, Entity.deleted,
+               Schema.slug.label('schema'), Attribute.name.label('attribute'))
+        .select_from(ValueForeignKey)
+        .join(Entity, Entity.id == ValueForeignKey.entity_id)
+        .join(Schema, Schema.id == Entity.schema_id)
+        .join(Attribute, Attribute.id == ValueForeignKey.attribute_id)
+        .where(ValueForeignKey.value == entity_id)
+    )
+    if schema is not None:
+        q = q.where(Entity.schema_id == schema.id)
+    if attr_name is not None:
+        q = q.where(Attribute.name == attr_name)
+    if not all:
+        q = q.where(Entity.deleted == False)
+    if reader is not None:
+        q = q.where(readable_entities(user_id=reader.id))
+    q = q.distinct().order_by(Schema.slug, Entity.name, Entity.id, Attribute.name)
+
+    total = db.execute(select(func.count()).select_from(q.subquery())).scalar()
+    rows = db.execute(paginate_query(q, params)).all()
+    return create_page([dict(row._mapping) for row in rows], total, params)
+
+
+def traverse_entities(db: Session, entity_id: int,
+                      direction: TraversalDirection = TraversalDirection.FORWARD,
+                      max_depth: int = 1, attr_names: Optional[List[str]] = None,
+                      limit: int = 100, reader: Optional[User] = None) -> dict:
+    '''Walks FK references starting at entity with id `entity_id` and returns the
+    entities reached within `max_depth` hops along with the references between them.
+    Each entity is reported once with the depth it was first reached at. At most `limit`
+    entities are returned, nearest first; `truncated` tells if more would have been found.
+    If `reader` is passed, only entities the user may read and references between them
+    are returned
+    '''
+    get_entity_by_id(db=db, entity_id=entity_id, reader=reader)
+    attribute_ids = None
+    if attr_names is not None:
+        attribute_ids = db.execute(
+            select(Attribute.id).where(Attribute.name.in_(attr_names),
+                                       Attribute.type == AttrType.FK)
+        ).scalars().all()
+
+    # a walk reaches each entity at most once per depth level, so this many rows contain
+    # `limit` + 1 distinct entities unless the walk found fewer
+    depths = dict(db.execute(STATEMENTS.fk_graph_walk, {
+        'entity_id': entity_id,
+        'forward': direction != TraversalDirection.BACKWARD,
+        'backward': direction != TraversalDirection.FORWARD,
+        'max_depth': max_depth,
+        'attribute_ids': attribute_ids,
+        'scan_limit': (limit + 1) * (max_depth + 1),
+        'limit': limit + 1
+    }).all())
+    truncated = len(depths) > limit
+    if truncated:
+        del depths[max(depths, key=lambda i: (depths[i], i))]
+
+    q = (
+        select(Entity.id, Entity.slug, Entity.name, Entity.deleted,
+               Schema.slug.label('schema'))
+        .join(Schema, Schema.id == Entity.schema_id)
+        .where(Entity.id.in_(depths))
+    )
+    if reader is not None:
+        q = q.where(readable_entities(user_id=reader.id))
+    rows = db.execute(q).all()
+    depths = {row.id: depths[row.id] for row in rows}
+    nodes = sorted(({**row._mapping, 'depth': depths[row.id]} for row in rows),
+                   key=lambda i: (i['depth'], i['id']))
+
+    q = (
+        select(ValueForeignKey.entity_id.label('source'), ValueForeignKey.value.label('target'),
+               Attribute.name.label('attribute'))
+        .join(Attribute, Attribute.id == ValueForeignKey.attribute_id)
+        .where(ValueForeignKey.entity_id.in_(depths), ValueForeignKey.value.in_(depths))
+        .order_by(ValueForeignKey.entity_id, ValueForeignKey.value, Attribute.name)
+    )
+    if attribute_ids is not None:
+        q = q.where(ValueForeignKey.attribute_id.in_(attribute_ids))
+    edges = [dict(row._mapping) for row in db.execute(q).all()]
+    return {'nodes': nodes, 'edges': edges, 'truncated': truncated}
+
+
+def get_entity_model(db: Session, id_or_slug: Union[int, str], schema: Schema,
+                     reader: Optional[User] = None) -> Entity:
+    q = select(Entity).where(Entity.schema_id == schema.id).options(joinedload(Entity.schema))
+    if reader is not None:
+        q = q.where(readable_entities(user_id=reader.id, schema_id=schema.id))
     if isinstance(id_or_slug, int):
         filter = Entity.id == id_or_slug
     else:
@@ -557,10 +1041,17 @@ def get_entity_model(db: Session, id_or_slug: Union[int, str], schema: Schema) -
     return e
 
 
-def get_entity(db: Session, id_or_slug: Union[int, str], schema: Schema) -> dict:
+def get_entity(db: Session, id_or_slug: Union[int, str], schema: Schema,
+               fields: Optional[List[str]] = None) -> dict:
+    '''Returns data of entity with values of all attributes or only of those in `fields`'''
     e = get_entity_model(db=db, id_or_slug=id_or_slug, schema=schema)
-    attrs = [i.attribute.name for i in schema.attr_defs]
-    return _get_entity_data(db=db, entity=e, attr_names=attrs)
+    return get_entity_data(db=db, entity=e, schema=schema, fields=fields)
+
+
+def get_entity_data(db: Session, entity: Entity, schema: Schema,
+                    fields: Optional[List[str]] = None) -> dict:
+    attr_defs = schema.attr_defs if fields is None else _get_attr_defs(schema, fields)
+    return _get_attr_values_batch(db, [entity], attr_defs)[0]
 
 
 def _convert_values(attr_def: AttributeDefinition, value: Any, caster: Callable) -> List[Any]:
@@ -606,6 +1097,7 @@ def _check_unique_value(db: Session, attr_def: AttributeDefinition, model: Value
 def create_entity(db: Session, schema_id: int, data: dict, commit: bool = True) -> Entity:
     sch: Schema = db.execute(
         select(Schema).where(Schema.id == schema_id).where(Schema.deleted == False)
+        .options(ATTR_DEFS_LOADER)
     ).scalar()
     if sch is None:
         raise MissingSchemaException(obj_id=schema_id)
@@ -646,6 +1138,7 @@ def create_entity(db: Session, schema_id: int, data: dict, commit: bool = True)
         for val in values:
             v = model(value=val, entity_id=e.id, attribute_id=attr.id)
             db.add(v)
+    publish(db, EventType.ENTITY, 'create', id=e.id, schema_id=schema_id)
     if commit:
         db.commit()
     else:
@@ -654,7 +1147,8 @@ def create_entity(db: Session, schema_id: int, data: dict, commit: bool = True)
 
 
 def update_entity(db: Session, id_or_slug: Union[str, int], schema_id: int, data: dict, commit: bool = True) -> Entity:
-    q = select(Entity).where(Entity.schema_id == schema_id)
+    q = select(Entity).where(Entity.schema_id == schema_id)\
+        .options(joinedload(Entity.schema).options(ATTR_DEFS_LOADER))
     q = q.where(Entity.id == id_or_slug) if isinstance(id_or_slug, int) else q.where(Entity.slug == id_or_slug)
     e = db.execute(q).scalar()
     if e is None:
@@ -722,6 +1216,7 @@ def update_entity(db: Session, id_or_slug: Union[str, int], schema_id: int, data
                 if attr_id == attr_def.attribute_id:
                     raise RequiredFieldException(name)
 
+    publish(db, EventType.ENTITY, 'update', id=e.id, schema_id=schema_id)
     if commit:
         db.commit()
     else:
@@ -741,6 +1236,7 @@ def delete_entity(db: Session, id_or_slug: Union[int, str], schema_id: int, comm
     if e.deleted:
         raise NoOpChangeException(f"Entity with id {e.id} is already deleted")
     e.deleted = True
+    publish(db, EventType.ENTITY, 'delete', id=e.id, schema_id=schema_id)
     if commit:
         db.commit()
     else:
@@ -760,6 +1256,7 @@ def restore_entity(db: Session, id_or_slug: Union[int, str], schema_id: int, com
     if not e.deleted:
         raise NoOpChangeException(f"Entity with id {e.id} is not deleted")
     e.deleted = False
+    publish(db, EventType.ENTITY, 'restore', id=e.id, schema_id=schema_id)
     if commit:
         db.commit()
     else:
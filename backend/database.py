@@ -16,14 +16,34 @@ db_exception = HTTPException(
 
 
 class STATEMENTS:
-    all_parent_groups = text("""
-        with recursive ancestors(id, parent_id) as (
-            select groups.id, groups.parent_id from groups where groups.id = any(:groupids)
-            union all
-            select groups.id, groups.parent_id from ancestors, groups where groups.id = ancestors.parent_id
+    # Walks the graph spanned by FK values starting at `:entity_id`. Edges can be followed
+    # forward (entity -> referenced entity) and/or backward. `union` keeps every entity once per
+    # depth, however many paths lead there, and stops the walk on cycles after `:max_depth`
+    # hops. An entity thus takes at most `:max_depth` + 1 rows, so the scan limit bounds the
+    # work on densely connected graphs without losing entities below the limit.
+    fk_graph_walk = text("""
+        with recursive walk(entity_id, depth) as (
+            select cast(:entity_id as integer), 0
+            union
+            select edges.target, walk.depth + 1
+            from walk
+            join (
+                select entity_id as source, value as target, attribute_id
+                from values_fk where :forward
+                union all
+                select value as source, entity_id as target, attribute_id
+                from values_fk where :backward
+            ) as edges on edges.source = walk.entity_id
+            where walk.depth < :max_depth
+              and (cast(:attribute_ids as integer[]) is null
+                   or edges.attribute_id = any(:attribute_ids))
         )
 
-        select distinct id from ancestors;
+        select walk.entity_id, min(walk.depth) as depth
+        from (select entity_id, depth from walk limit :scan_limit) as walk
+        group by walk.entity_id
+        order by depth, walk.entity_id
+        limit :limit;
         """)
 
 
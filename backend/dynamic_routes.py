@@ -1,21 +1,27 @@
-from typing import Optional, Union
-from dataclasses import make_dataclass
+from typing import List, Optional, Union
+from dataclasses import make_dataclass, fields as dataclass_fields
 
-from fastapi import APIRouter, Depends, HTTPException, status, Query, Response
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Request, Response
 from fastapi.applications import FastAPI
 from fastapi_pagination import Page, Params
 from sqlalchemy.exc import DataError
 from sqlalchemy.orm.session import Session
 
-from .auth import authorized_user, authenticated_user
+from .auth import authorized_user, authenticated_user, reading_user
+from .auth.crud import get_permissions_version
 from .auth.enum import PermissionType
 from .auth.models import User
+from .config import settings
+from .cache import cached, CachedRoute
 from .database import get_db
+from .instrumentation import query_budget
+from .etag import make_etag, conditional_response
 from .enum import FilterEnum, ModelVariant
-from .models import AttrType, Schema, Entity
+from .models import AttrType, Schema, Entity, ENTITY_FILTERS
 from .schemas.auth import RequirePermission
-from .schemas.entity import EntityModelFactory, EntityBaseSchema
+from .schemas.entity import EntityModelFactory, EntityBaseSchema, AggregationSchema
 from .schemas.traceability import ChangeRequestSchema
+from .serialization import ListingSerializer
 from . import crud, exceptions
 
 from .traceability.entity import create_entity_create_request, create_entity_update_request, \
@@ -36,6 +42,16 @@ def _description_for_get_entity(schema: Schema) -> str:
     return description
 
 
+FIELDS_DESCRIPTION = 'Comma separated names of attributes to return. ' \
+                     'If passed, only values of these attributes are fetched'
+
+
+def _split_fields(fields: Optional[str]) -> Optional[List[str]]:
+    if fields is None:
+        return None
+    return [i.strip() for i in fields.split(',') if i.strip()]
+
+
 def route_get_entity(router: APIRouter, schema: Schema):
     entity_get_schema = factory(schema, ModelVariant.GET)
     description = _description_for_get_entity(schema=schema)
@@ -48,22 +64,45 @@ def route_get_entity(router: APIRouter, schema: Schema):
         description=description,
         response_model_exclude_unset=True,
         responses={
+            304: {
+                'description': "Entity wasn't modified since the version known to client",
+            },
             404: {
                 'description': "Entity with provided ID doesn't exist",
             },
             409: {
                 'description': "Entity with provided ID doesn't belong to current schema"
+            },
+            422: {
+                'description': "Attribute from `fields` is not defined on current schema"
             }
         }
     )
-    def get_entity(id_or_slug: Union[int, str], db: Session = Depends(get_db)):
+    @query_budget(8)
+    def get_entity(
+        id_or_slug: Union[int, str],
+        request: Request,
+        response: Response,
+        fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
+        db: Session = Depends(get_db),
+        reader: Optional[User] = Depends(reading_user)
+    ):
         try:
-            res = crud.get_entity(db=db, id_or_slug=id_or_slug, schema=schema)
-            return res
+            fields = _split_fields(fields)
+            entity = crud.get_entity_model(db=db, id_or_slug=id_or_slug, schema=schema,
+                                           reader=reader)
+            etag = make_etag(entity.version, entity.schema.version, fields)
+            last_modified = max(entity.updated_at, entity.schema.updated_at)
+            not_modified = conditional_response(request, response, etag, last_modified)
+            if not_modified is not None:
+                return not_modified
+            return crud.get_entity_data(db=db, entity=entity, schema=schema, fields=fields)
         except exceptions.MissingEntityException as e:
             raise HTTPException(status.HTTP_404_NOT_FOUND, str(e))
         except exceptions.MismatchingSchemaException as e:
             raise HTTPException(status.HTTP_409_CONFLICT, str(e))
+        except exceptions.AttributeNotDefinedException as e:
+            raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, str(e))
 
 
 def _description_for_get_entities(schema: Schema) -> str:
@@ -83,20 +122,33 @@ def _description_for_get_entities(schema: Schema) -> str:
     return description
 
 
-def _filters_request_model(schema: Schema):
-    '''Creates a dataclass that will be used to
-    capture filters like `<attr_name>.<operator>=<value>`
-    in entity listing queries
-    '''
-    fields = []
+def _filter_type(filter: FilterEnum, type_: type) -> type:
+    '''Returns type of query param for `filter` on values of `type_`'''
+    if filter in (FilterEnum.IN, FilterEnum.NIN):
+        return List[type_]
+    if filter == FilterEnum.ISNULL:
+        return bool
+    return type_
 
-    fields.append(('name', Optional[str], Query(None, description=FilterEnum.EQ.value.description)))
-    for filter in AttrType.STR.value.filters:
-        fields.append((f'name_{filter.value.name}', Optional[str],
-                       Query(None, alias=f'name.{filter.value.name}', description=filter.value.description)))
+
+def _filter_fields(schema: Schema, prefix: str = '', depth: int = 0):
+    '''Yields `(alias, type, description)` for every filter on `schema`,
+    including filters on entities referenced through FK attributes
+    up to `settings.filter_join_depth` hops away
+    '''
+    for field, filters in ENTITY_FILTERS.items():
+        type_ = Entity.__table__.c[field].type.python_type
+        yield f'{prefix}{field}', type_, FilterEnum.EQ.value.description
+        for filter in filters:
+            yield (f'{prefix}{field}.{filter.value.name}', _filter_type(filter, type_),
+                   filter.value.description)
 
     for attr_def in schema.attr_defs:
         attr = attr_def.attribute
+        if attr.type == AttrType.FK and attr_def.bound_schema is not None \
+                and depth < settings.filter_join_depth:
+            yield from _filter_fields(attr_def.bound_schema, prefix=f'{prefix}{attr.name}.',
+                                      depth=depth + 1)
         if not attr.type.value.filters:
             continue
 
@@ -104,21 +156,39 @@ def _filters_request_model(schema: Schema):
             .value.model  # AttrType.value -> Mapping, Mapping.model -> Value model
             .value.property.columns[0].type.python_type)  # get python type of value column in Value child
         # default filter {attr.name} which works as {attr.name}.eq, i.e. for equality filtering
-        fields.append((attr.name, Optional[type_],
-                       Query(None, alias=attr.name, description=FilterEnum.EQ.value.description)))
+        yield f'{prefix}{attr.name}', type_, FilterEnum.EQ.value.description
         for filter in attr.type.value.filters:
-            fields.append((f'{attr.name}_{filter.value.name}', Optional[type_],
-                           Query(None, alias=f'{attr.name}.{filter.value.name}',
-                                 description=filter.value.description)))
+            yield (f'{prefix}{attr.name}.{filter.value.name}', _filter_type(filter, type_),
+                   filter.value.description)
+
+
+def _filters_request_model(schema: Schema):
+    '''Creates a dataclass that will be used to
+    capture filters like `<attr_name>.<operator>=<value>`
+    or `<fk_attr_name>.<attr_name>.<operator>=<value>`
+    in entity listing queries
+    '''
+    # filters are passed by their aliases, names of fields only have to be distinct
+    fields = [(f'filter_{idx}', Optional[type_], Query(None, alias=alias, description=description))
+              for idx, (alias, type_, description) in enumerate(_filter_fields(schema))]
 
     filter_model = make_dataclass(f"{schema.slug.capitalize().replace('-', '_')}Filters",
                                   fields=fields)
     return filter_model
 
 
+def _reader_context(request: Request) -> Optional[str]:
+    '''Listings differ by user, when only readable entities are listed'''
+    if settings.enforce_read_permissions:
+        return request.headers.get('authorization')
+    return None
+
+
 def route_get_entities(router: APIRouter, schema: Schema):
     description = _description_for_get_entities(schema=schema)
+    serializer = ListingSerializer(factory(schema=schema, variant=ModelVariant.GET))
     filter_model = _filters_request_model(schema=schema)
+    aliases = {f.name: f.default.alias for f in dataclass_fields(filter_model)}
 
     @router.get(
         f'/{schema.slug}',
@@ -126,42 +196,133 @@ def route_get_entities(router: APIRouter, schema: Schema):
         tags=[schema.name],
         summary=f'List {schema.name} entities',
         description=description,
-        response_model_exclude_unset=True
+        response_model_exclude_unset=True,
+        responses={
+            304: {'description': "Listing wasn't modified since the version known to client"}
+        }
     )
+    @cached('entities', 'permissions', context=_reader_context)
+    @query_budget(11)
     def get_entities(
+        request: Request,
+        response: Response,
         all: bool = Query(False, description='If true, returns both deleted and not deleted entities'), 
         deleted_only: bool = Query(False, description='If true, returns only deleted entities. *Note:* if `all` is true `deleted_only` is not checked'), 
         all_fields: bool = Query(False, description='If true, returns data for all entity fields, not just key ones'),
+        fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION + '. Overrides `all_fields`'),
         filters: filter_model = Depends(),
         order_by: str = Query('name', description='Ordering field'),
         ascending: bool = Query(True, description='Direction of ordering'),
         db: Session = Depends(get_db),
-        params: Params = Depends()
+        params: Params = Depends(),
+        reader: Optional[User] = Depends(reading_user)
     ):
-        filters = {k: v for k, v in filters.__dict__.items() if v is not None}
-        new_filters = {}
-        for k, v in filters.items():
-            split = k.rsplit('_', maxsplit=1)
-            attr = split[0]
-            filter = split[-1] if len(split) > 1 else 'eq'
-            new_filters[f'{attr}.{filter}'] = v
+        filters = {aliases[k]: v for k, v in filters.__dict__.items() if v is not None}
+        versions, last_modified = crud.get_entities_version(db=db, schema=schema, filters=filters)
+        if reader is not None:
+            versions += (reader.id, get_permissions_version(db=db, user=reader))
+        etag = make_etag(versions, sorted(request.query_params.multi_items()))
+        not_modified = conditional_response(request, response, etag, last_modified)
+        if not_modified is not None:
+            return not_modified
         try:
-            return crud.get_entities(
+            page = crud.get_entities(
                 db=db, 
                 schema=schema,
                 params=params,
                 all=all,
                 deleted_only=deleted_only,
                 all_fields=all_fields,
-                filters=new_filters,
+                filters=filters,
                 order_by=order_by,
-                ascending=ascending
+                ascending=ascending,
+                fields=_split_fields(fields),
+                reader=reader
             )
+        except exceptions.AttributeNotDefinedException as e:
+            raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, str(e))
         # these two exceptions are not supposed to be ever raised
         except exceptions.InvalidFilterAttributeException as e:
             raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, str(e))
         except exceptions.InvalidFilterOperatorException as e:
             raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, str(e))
+        if settings.fast_serialization:
+            # returned response skips the response model, so headers are passed on
+            return serializer.render_page(page, headers=response.headers)
+        return page
+
+
+def route_aggregate_entities(router: APIRouter, schema: Schema):
+    filter_model = _filters_request_model(schema=schema)
+    aliases = {f.name: f.default.alias for f in dataclass_fields(filter_model)}
+
+    @router.get(
+        f'/{schema.slug}/_aggregate',
+        response_model=List[AggregationSchema],
+        tags=[schema.name],
+        summary=f'Aggregate {schema.name} entities',
+        description='Groups entities by values of `group_by` attributes and computes metrics for '
+                    'each group. Metric is either `count` or `<function>.<attr_name>` where function '
+                    'is one of `sum`, `avg`, `min`, `max` and attribute is numeric. '
+                    'Accepts same filters as entity listing',
+        responses={
+            422: {'description': 'Invalid attribute or metric to aggregate by or invalid filter'}
+        }
+    )
+    @query_budget(4)
+    def aggregate_entities(
+        group_by: Optional[List[str]] = Query(None, description='Attributes to group entities by'),
+        metric: List[str] = Query(['count'], description='Metrics to compute for each group'),
+        all: bool = Query(False, description='If true, aggregates both deleted and not deleted entities'),
+        deleted_only: bool = Query(False, description='If true, aggregates only deleted entities. *Note:* if `all` is true `deleted_only` is not checked'),
+        filters: filter_model = Depends(),
+        db: Session = Depends(get_db),
+        reader: Optional[User] = Depends(reading_user)
+    ):
+        filters = {aliases[k]: v for k, v in filters.__dict__.items() if v is not None}
+        try:
+            return crud.aggregate_entities(db=db, schema=schema, group_by=group_by, metrics=metric,
+                                           filters=filters, all=all, deleted_only=deleted_only,
+                                           reader=reader)
+        except (exceptions.InvalidAggregationException, exceptions.InvalidFilterAttributeException,
+                exceptions.InvalidFilterOperatorException) as e:
+            raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, str(e))
+
+
+def route_get_entity_changes(router: APIRouter, schema: Schema):
+    changes_model = factory(schema=schema, variant=ModelVariant.CHANGES)
+    serializer = ListingSerializer(changes_model.__fields__['changes'].type_)
+
+    @router.get(
+        f'/{schema.slug}/_changes',
+        response_model=changes_model,
+        tags=[schema.name],
+        summary=f'List changed {schema.name} entities',
+        description='Returns entities created, updated, deleted or restored after version '
+                    '`since`, in order of their versions. To sync incrementally, pass '
+                    '`last_version` of the response as `since` of the next request until '
+                    '`has_more` is false',
+        response_model_exclude_unset=True,
+        responses={
+            422: {'description': "Attribute from `fields` is not defined on current schema"}
+        }
+    )
+    @query_budget(8)
+    def get_entity_changes(
+        since: int = Query(0, ge=0, description='Version of the latest change known to client'),
+        limit: int = Query(100, ge=1, le=1000, description='Maximal number of returned entities'),
+        fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
+        db: Session = Depends(get_db),
+        reader: Optional[User] = Depends(reading_user)
+    ):
+        try:
+            changes = crud.get_entity_changes(db=db, schema=schema, since=since, limit=limit,
+                                              fields=_split_fields(fields), reader=reader)
+        except exceptions.AttributeNotDefinedException as e:
+            raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, str(e))
+        if settings.fast_serialization:
+            return serializer.render(changes, 'changes')
+        return changes
 
 
 def route_create_entity(router: APIRouter, schema: Schema):
@@ -349,9 +510,12 @@ def route_delete_entity(router: APIRouter, schema: Schema):
         
 
 def create_dynamic_router(schema: Schema, app: FastAPI, old_slug: str = None):
-    router = APIRouter()
+    router = APIRouter(route_class=CachedRoute)
     
     route_get_entities(router=router, schema=schema)
+    # go before `route_get_entity`, whose path matches `_aggregate` and `_changes` as well
+    route_aggregate_entities(router=router, schema=schema)
+    route_get_entity_changes(router=router, schema=schema)
     route_get_entity(router=router, schema=schema)
     route_create_entity(router=router, schema=schema)
     route_update_entity(router=router, schema=schema)
@@ -19,6 +19,9 @@ class FilterEnum(Enum):
     REGEXP = Filter('regexp', 'iregexp_match', 'matches regular expression')
     STARTS = Filter('starts', 'istartswith', 'starts with substring')
     IEQ = Filter('ieq', 'ieq', 'equal to (case insensitive)')
+    IN = Filter('in', 'in_', 'equal to any of values')
+    NIN = Filter('nin', 'not_in', 'not equal to any of values')
+    ISNULL = Filter('isnull', 'is_', 'has no value if true, has a value if false')
 
 
 class ModelVariant(Enum):
@@ -26,3 +29,16 @@ class ModelVariant(Enum):
     GET = auto()
     LIST = auto()
     UPDATE = auto()
+    CHANGES = auto()
+
+
+class TraversalDirection(Enum):
+    FORWARD = 'forward'
+    BACKWARD = 'backward'
+    BOTH = 'both'
+
+
+class EventType(Enum):
+    ENTITY = 'entity'
+    SCHEMA = 'schema'
+    CHANGE_REQUEST = 'change_request'
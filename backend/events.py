@@ -0,0 +1,178 @@
+"""
+Push notifications about changes of entities, schemas and change requests.
+
+Events are sent with `pg_notify` in the transaction that makes the change, so PostgreSQL
+delivers them only if that transaction is committed and to every process listening on
+`CHANNEL`. Each process keeps one listening connection, shared by all its subscribers.
+"""
+import asyncio
+import json
+import logging
+from typing import Callable, List, Optional
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import event, func, select, inspect
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session
+
+from . import config
+from .enum import EventType
+from .traceability.enum import ChangeStatus
+from .traceability.models import ChangeRequest
+
+
+CHANNEL = 'aimaas_events'
+# type of event telling subscribers that events may have been lost, sent regardless of
+# types they subscribed to
+RESYNC = 'resync'
+
+logger = logging.getLogger(__name__)
+
+
+def publish(db: Session, type: EventType, action: str, **data):
+    '''Sends event to listeners once current transaction of `db` is committed'''
+    payload = json.dumps({'type': type.value, 'action': action, **data})
+    db.connection().execute(select(func.pg_notify(CHANNEL, payload)))
+
+
+@event.listens_for(Session, 'after_flush')
+def _publish_change_requests(session: Session, flush_context):
+    for obj in session.new:
+        if isinstance(obj, ChangeRequest):
+            publish(session, EventType.CHANGE_REQUEST, 'create', id=obj.id,
+                    object_type=obj.object_type.value, change_type=obj.change_type.value)
+    for obj in session.dirty:
+        if isinstance(obj, ChangeRequest) and obj.status != ChangeStatus.PENDING \
+                and inspect(obj).attrs.status.history.has_changes():
+            publish(session, EventType.CHANGE_REQUEST, 'review', id=obj.id,
+                    object_type=obj.object_type.value, change_type=obj.change_type.value,
+                    status=obj.status.value)
+
+
+class EventBroker:
+    '''Listens for notifications on `CHANNEL` and passes them to subscribers.
+    Listening connection is opened with the first subscriber and closed after the last one.
+    If it is lost, it is reopened and subscribers get a `RESYNC` event, since notifications
+    sent in between are lost
+    '''
+    def __init__(self, url: Optional[str] = None, queue_size: Optional[int] = None):
+        self.url = url
+        self.queue_size = queue_size or config.settings.events_queue_size
+        self._subscribers: List[asyncio.Queue] = []
+        self._conn = None
+        # descriptor of `_conn` watched by `_loop`, kept since closed connection has none
+        self._fd: Optional[int] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = asyncio.Lock()
+        self._reconnecting: Optional[asyncio.Task] = None
+
+    def _connect(self):
+        url = make_url(self.url or config.SQLALCHEMY_DATABASE_URL).set(drivername='postgresql')
+        conn = psycopg2.connect(url.render_as_string(hide_password=False))
+        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cursor:
+            cursor.execute(f'LISTEN {CHANNEL}')
+        return conn
+
+    async def _listen(self):
+        self._conn = await run_in_threadpool(self._connect)
+        self._fd = self._conn.fileno()
+        self._loop = asyncio.get_running_loop()
+        self._loop.add_reader(self._fd, self._on_notify)
+
+    def _close(self):
+        self._loop.remove_reader(self._fd)
+        try:
+            self._conn.close()
+        except psycopg2.Error:
+            logger.debug('Could not close listening connection', exc_info=True)
+        self._conn = self._fd = None
+
+    def _dispatch(self, event: dict):
+        for queue in self._subscribers:
+            # slow subscriber loses events rather than holding memory of the process
+            if not queue.full():
+                queue.put_nowait(event)
+
+    def _on_notify(self):
+        try:
+            self._conn.poll()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            logger.warning('Lost connection listening for events, reconnecting', exc_info=True)
+            self._close()
+            self._reconnecting = self._loop.create_task(self._reconnect())
+            return
+        while self._conn.notifies:
+            notify = self._conn.notifies.pop(0)
+            self._dispatch(json.loads(notify.payload))
+
+    async def _reconnect(self):
+        delay = config.settings.events_reconnect_delay
+        try:
+            while True:
+                await asyncio.sleep(delay)
+                async with self._lock:
+                    try:
+                        await self._listen()
+                    except psycopg2.Error:
+                        delay = min(delay * 2, config.settings.events_reconnect_max_delay)
+                        logger.warning('Could not reconnect to listen for events, '
+                                       'retrying in %s s', delay, exc_info=True)
+                        continue
+                self._dispatch({'type': RESYNC})
+                return
+        finally:
+            # next subscriber connects again, if reconnecting failed unexpectedly
+            self._reconnecting = None
+
+    async def subscribe(self) -> asyncio.Queue:
+        async with self._lock:
+            if self._conn is None and self._reconnecting is None:
+                await self._listen()
+            queue = asyncio.Queue(maxsize=self.queue_size)
+            self._subscribers.append(queue)
+            return queue
+
+    async def unsubscribe(self, queue: asyncio.Queue):
+        async with self._lock:
+            self._subscribers.remove(queue)
+            if self._subscribers:
+                return
+            if self._reconnecting is not None:
+                self._reconnecting.cancel()
+                self._reconnecting = None
+            if self._conn is not None:
+                self._close()
+                self._loop = None
+
+
+broker = EventBroker()
+
+
+async def stream_events(types: Optional[List[EventType]] = None, broker: EventBroker = broker,
+                        readable: Optional[Callable[[int, int], bool]] = None):
+    '''Yields events of `types` (all if not set) formatted as server-sent events
+    until the client disconnects. After `RESYNC` events clients should reload data
+    they keep up to date by events. If `readable` is passed, events of entities are
+    only yielded if it returns true for ids of the entity and of its schema
+    '''
+    types = {i.value for i in types or EventType} | {RESYNC}
+    queue = await broker.subscribe()
+    try:
+        yield ': connected\n\n'
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout=config.settings.events_keepalive)
+            except asyncio.TimeoutError:
+                # keeps proxies from closing idle connection
+                yield ': keepalive\n\n'
+                continue
+            if event['type'] == EventType.ENTITY.value and readable is not None \
+                    and not readable(event['id'], event['schema_id']):
+                continue
+            if event['type'] in types:
+                yield f'event: {event["type"]}\ndata: {json.dumps(event)}\n\n'
+    finally:
+        await broker.unsubscribe(queue)
@@ -254,6 +254,15 @@ class InvalidFilterAttributeException(Exception):
         return f"Can't filter current schema by attribute `{self.attr}`. Allowed attributes: {', '.join(self.allowed_attrs)}"
 
 
+class InvalidAggregationException(Exception):
+    def __init__(self, expr: str, allowed: List[str]):
+        self.expr = expr
+        self.allowed = allowed
+
+    def __str__(self) -> str:
+        return f"Can't aggregate current schema by `{self.expr}`. Allowed: {', '.join(self.allowed)}"
+
+
 class NoOpChangeException(Exception):
     pass
 
@@ -1,32 +1,39 @@
 from datetime import timedelta
 from typing import Optional, List, Union
 
-from fastapi import APIRouter, Depends, HTTPException, status, Request, Query, Response
+from fastapi import APIRouter, Body, Depends, HTTPException, status, Request, Query, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi_pagination import Params, Page
 from sqlalchemy.orm import Session
 
 from .config import settings, VERSION
 from . import crud, schemas, exceptions
+from .cache import cached, CachedRoute
 from .database import get_db
-from .enum import FilterEnum
+from .etag import make_etag, conditional_response
+from .enum import EventType, FilterEnum, TraversalDirection
+from .events import stream_events
+from .instrumentation import query_budget, slow_queries
 from .models import Schema, AttrType
 from .dynamic_routes import create_dynamic_router
 from .auth import authenticate_user, authenticated_user, authorized_user, create_access_token,\
-    crud as auth_crud
+    reading_user, crud as auth_crud
 from .auth.enum import PermissionType, RecipientType, PermissionTargetType
 from .auth.models import User, Group
 from .schemas.auth import (
-    GroupSchema, RequirePermission, PermissionSchema,
+    GroupSchema, RequirePermission, PermissionSchema, PermissionCheckSchema,
+    PermissionCheckResultSchema,
     UserSchema,
     UserCreateSchema,
     BaseGroupSchema,
     Token
 )
-from .schemas.info import InfoModel, FilterModel
+from .schemas.info import InfoModel, FilterModel, SlowQueryModel
 from .schemas.traceability import ChangeRequestSchema, CountSchema
 from .traceability.crud import review_changes, get_pending_change_requests, \
-    is_user_authorized_to_review, get_pending_change_request_count
+    is_user_authorized_to_review, get_pending_change_request_count, review_changes_batch
 from .traceability.entity import get_recent_entity_changes, entity_change_details
 from .traceability.enum import ContentType
 from .traceability.schema import create_schema_create_request, create_schema_update_request, \
@@ -34,11 +41,15 @@ from .traceability.schema import create_schema_create_request, create_schema_upd
     apply_schema_delete_request, get_recent_schema_changes, schema_change_details
 
 
-router = APIRouter()
+router = APIRouter(route_class=CachedRoute)
 
 
 @router.get("/info", response_model=InfoModel)
-def get_info():
+@cached()
+def get_info(request: Request, response: Response):
+    not_modified = conditional_response(request, response, make_etag(VERSION, settings.help))
+    if not_modified is not None:
+        return not_modified
     return {
         "version": VERSION,
         "filters": [FilterModel(name=f.value.name, description=f.value.description)
@@ -49,12 +60,28 @@ def get_info():
     }
 
 
+@router.get('/slow-queries', response_model=List[SlowQueryModel], tags=['General routes'],
+            summary='List slowest SQL statements',
+            description='Statements, which took longer than configured threshold, ordered by '
+                        'total time spent executing them. Empty if slow query log is off')
+def get_slow_queries(limit: int = Query(20, ge=1, le=100),
+                     user: User = Depends(authorized_user(RequirePermission(permission=PermissionType.SUPERUSER)))):
+    return slow_queries.top(limit=limit)
+
+
 @router.get(
     '/attributes', 
     response_model=List[schemas.AttributeSchema],
     tags=['General routes']
 )
-def get_attributes(db: Session = Depends(get_db)):
+@cached('schemas')
+@query_budget(2)
+def get_attributes(request: Request, response: Response, db: Session = Depends(get_db)):
+    # attributes are created along with schemas they are defined on
+    version, last_modified = crud.get_schemas_version(db=db)
+    not_modified = conditional_response(request, response, make_etag(version), last_modified)
+    if not_modified is not None:
+        return not_modified
     return crud.get_attributes(db)
 
 
@@ -75,7 +102,10 @@ def get_attribute(attr_id: int, db: Session = Depends(get_db)):
     response_model=List[schemas.SchemaForListSchema],
     tags=['General routes']
 )
+@cached('schemas')
+@query_budget(1)
 def get_schemas(
+    request: Request,
     all: Optional[bool] = Query(False, description='If true, returns both deleted and not deleted schemas'), 
     deleted_only: Optional[bool] = Query(False, description='If true, returns only deleted entities. *Note:* if `all` is true `deleted_only` is not checked'), 
     db: Session = Depends(get_db)
@@ -132,9 +162,17 @@ def create_schema(data: schemas.SchemaCreateSchema, request: Request, db: Sessio
     response_model=schemas.SchemaDetailSchema,
     tags=['General routes']
 )
-def get_schema(id_or_slug: Union[int, str], db: Session = Depends(get_db)):
+@cached('schemas')
+@query_budget(2)
+def get_schema(id_or_slug: Union[int, str], request: Request, response: Response,
+               db: Session = Depends(get_db)):
     try:
-        return crud.get_schema(db=db, id_or_slug=id_or_slug)
+        schema = crud.get_schema(db=db, id_or_slug=id_or_slug)
+        not_modified = conditional_response(request, response, make_etag(schema.version),
+                                            schema.updated_at)
+        if not_modified is not None:
+            return not_modified
+        return schema
     except exceptions.MissingSchemaException as e:
         raise HTTPException(status.HTTP_404_NOT_FOUND, str(e))
 
@@ -216,13 +254,30 @@ def reviewchanges(request_id: int, review: schemas.ChangeReviewSchema, response:
         raise HTTPException(status.HTTP_404_NOT_FOUND, str(e))
 
 
+@router.post('/changes/review', tags=["Reviews & Changes"],
+             response_model=List[schemas.BatchReviewResultSchema],
+             summary='Review several change requests',
+             description='Approves or declines all change requests from `ids` in one transaction. '
+                         'Change request that cannot be reviewed is skipped and its result '
+                         'has the status code and error that reviewing it alone would return')
+def reviewchanges_batch(review: schemas.BatchReviewSchema, db: Session = Depends(get_db),
+                        user: User = Depends(authenticated_user)):
+    return review_changes_batch(db=db, change_request_ids=review.ids,
+                                review=schemas.ChangeReviewSchema(result=review.result,
+                                                                  comment=review.comment),
+                                reviewed_by=user)
+
+
 @router.get('/changes/pending/count', tags=["Reviews & Changes"], response_model=CountSchema)
-def get_count_pending_changerequests(db: Session = Depends(get_db)):
+@cached('changes')
+@query_budget(1)
+def get_count_pending_changerequests(request: Request, db: Session = Depends(get_db)):
     return CountSchema(count=get_pending_change_request_count(db=db))
 
 
 @router.get('/changes/pending', tags=["Reviews & Changes"],
             response_model=Page[schemas.ChangeRequestSchema])
+@query_budget(3)
 def get_pending_changerequests(
     obj_type: Optional[ContentType] = Query(None),
     db: Session = Depends(get_db),
@@ -231,12 +286,35 @@ def get_pending_changerequests(
     return get_pending_change_requests(obj_type=obj_type, params=params, db=db)
 
 
+@router.get('/events', tags=["Reviews & Changes"], response_class=StreamingResponse,
+            summary='Stream change events',
+            description='Server-sent event stream, which pushes an event when entity or schema '
+                        'is changed or when change request is created or reviewed. Event data '
+                        'is a JSON object with `type`, `action` and `id` of changed object. '
+                        'Events are not replayed on reconnect, use change feeds to catch up. '
+                        'A `resync` event, sent regardless of `type`, tells that events may have '
+                        'been lost while the server reconnected to the database. If read '
+                        'permissions are enforced, only events of entities readable when the '
+                        'stream was opened are sent')
+async def get_events(type: Optional[List[EventType]] = Query(None, description='Types of events to stream, all if not set'),
+                     db: Session = Depends(get_db),
+                     reader: Optional[User] = Depends(reading_user)):
+    readable = None
+    if reader is not None:
+        readable = await run_in_threadpool(auth_crud.readable_entity_check, db=db, user=reader)
+    # the stream stays open for long, it mustn't keep a connection of the pool
+    await run_in_threadpool(db.close)
+    return StreamingResponse(stream_events(types=type, readable=readable),
+                             media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @router.get('/changes/schema/{id_or_slug}', tags=["Reviews & Changes"],
             response_model=Page[schemas.ChangeRequestSchema])
 def get_schema_changes(id_or_slug: Union[int, str], params: Params = Depends(),
                               db: Session = Depends(get_db)):
     try:
-        schema = crud.get_schema(db=db, id_or_slug=id_or_slug)
+        schema = crud.get_schema(db=db, id_or_slug=id_or_slug, attr_defs=False)
         return get_recent_schema_changes(db=db, schema_id=schema.id, params=params)
     except exceptions.MissingSchemaException as e:
         raise HTTPException(status.HTTP_404_NOT_FOUND, str(e))
@@ -257,7 +335,7 @@ def get_schema_change_details(change_id: int, db: Session = Depends(get_db)):
 def get_entity_changes(schema_id_or_slug: Union[int, str], entity_id_or_slug: Union[int, str],
                        db: Session = Depends(get_db), params: Params = Depends()):
     try:
-        schema = crud.get_schema(db=db, id_or_slug=schema_id_or_slug)
+        schema = crud.get_schema(db=db, id_or_slug=schema_id_or_slug, attr_defs=False)
         entity = crud.get_entity_model(db=db, id_or_slug=entity_id_or_slug, schema=schema)
         return get_recent_entity_changes(db=db, entity_id=entity.id, params=params)
     except exceptions.MissingObjectException as e:
@@ -275,9 +353,69 @@ def get_entity_change_details(change_id: int, db: Session = Depends(get_db)):
         raise HTTPException(status.HTTP_404_NOT_FOUND, str(e))
 
 
-@router.get('/entities/{entity_id}', response_model=schemas.EntityByIdSchema)
-def get_entity_by_id(entity_id: int, db: Session = Depends(get_db)):
-    return crud.get_entity_by_id(db=db, entity_id=entity_id)
+@router.get('/entities/{entity_id}', response_model=schemas.EntityByIdSchema,
+            responses={404: {"description": "Entity does not exist"}})
+@query_budget(2)
+def get_entity_by_id(entity_id: int, db: Session = Depends(get_db),
+                     reader: Optional[User] = Depends(reading_user)):
+    try:
+        return crud.get_entity_by_id(db=db, entity_id=entity_id, reader=reader)
+    except exceptions.MissingEntityException as e:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, str(e))
+
+
+@router.get(
+    '/entities/{entity_id}/referenced-by',
+    response_model=Page[schemas.EntityReferenceSchema],
+    summary="List entities referring to an entity",
+    responses={
+        404: {"description": "Entity or schema does not exist"}
+    }
+)
+@query_budget(5)
+def get_referencing_entities(
+    entity_id: int,
+    schema: Optional[Union[int, str]] = Query(None, description='ID or slug of the schema the referring entities must belong to'),
+    attribute: Optional[str] = Query(None, description='Name of the FK attribute holding the reference'),
+    all: bool = Query(False, description='If true, also returns deleted referring entities'),
+    db: Session = Depends(get_db),
+    params: Params = Depends(),
+    reader: Optional[User] = Depends(reading_user)
+):
+    try:
+        if schema is not None:
+            schema = crud.get_schema(db=db, id_or_slug=schema, attr_defs=False)
+        return crud.get_referencing_entities(db=db, entity_id=entity_id, schema=schema,
+                                             attr_name=attribute, all=all, params=params,
+                                             reader=reader)
+    except (exceptions.MissingEntityException, exceptions.MissingSchemaException) as e:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, str(e))
+
+
+@router.get(
+    '/entities/{entity_id}/traverse',
+    response_model=schemas.TraversalSchema,
+    summary="Walk FK references starting at an entity",
+    responses={
+        404: {"description": "Entity does not exist"}
+    }
+)
+@query_budget(6)
+def traverse_entities(
+    entity_id: int,
+    direction: TraversalDirection = Query(TraversalDirection.FORWARD, description='Follow references held by entities (forward), pointing to them (backward) or both'),
+    depth: int = Query(1, ge=1, le=settings.traversal_max_depth, description='Maximum number of hops'),
+    attribute: Optional[List[str]] = Query(None, description='Names of the FK attributes to follow. If omitted, all are followed'),
+    limit: int = Query(100, ge=1, le=settings.traversal_max_nodes, description='Maximum number of returned entities'),
+    db: Session = Depends(get_db),
+    reader: Optional[User] = Depends(reading_user)
+):
+    try:
+        return crud.traverse_entities(db=db, entity_id=entity_id, direction=direction,
+                                      max_depth=depth, attr_names=attribute, limit=limit,
+                                      reader=reader)
+    except exceptions.MissingEntityException as e:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, str(e))
 
 
 @router.get('/groups', response_model=List[GroupSchema], tags=["Auth"])
@@ -488,6 +626,21 @@ def revoke_permissions(permission_ids: List[int], response: Response, db: Sessio
     return changed
 
 
+@router.post('/permissions/check', response_model=List[PermissionCheckResultSchema],
+             tags=["Auth"], summary="Check permissions of current user",
+             description='Tells for every passed permission and target, whether current user has '
+                         'the permission. Results are in order of passed checks')
+@query_budget(3)
+def check_permissions(checks: List[PermissionCheckSchema] = Body(..., max_items=1000),
+                      db: Session = Depends(get_db), user: User = Depends(authenticated_user)):
+    try:
+        allowed = auth_crud.check_permissions(db=db, user=user, checks=checks)
+    except ValueError as error:
+        raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, str(error))
+    return [PermissionCheckResultSchema(**check.dict(), allowed=i)
+            for check, i in zip(checks, allowed)]
+
+
 @router.post(settings.token_url, response_model=Token, tags=["Auth"])
 async def login(db: Session = Depends(get_db), form_data: OAuth2PasswordRequestForm = Depends()):
     user = authenticate_user(db, form_data.username, form_data.password)
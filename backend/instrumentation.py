@@ -0,0 +1,274 @@
+"""
+Optional per-request instrumentation: number of SQL statements, time spent in the database
+and total time of every request.
+
+Numbers are sent to clients in `Server-Timing` header and aggregated per route for
+Prometheus, which can scrape them at `/metrics` if `settings.metrics_endpoint` is on. Routes can declare a budget of SQL statements with `query_budget`;
+requests exceeding it are logged and collected in `budget_violations`, so tests can fail on
+N+1 regressions.
+
+Statements slower than `settings.slow_query_ms` are logged with their parameters, the route
+and the schema they were executed for and collected in `slow_queries`. A sample of them is
+re-run with `EXPLAIN (ANALYZE, BUFFERS)` to capture the plan.
+"""
+import logging
+import random
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .config import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class QueryStats:
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+
+
+_stats: ContextVar[Optional[QueryStats]] = ContextVar('query_stats', default=None)
+# ASGI scope of request being handled, tells slow queries where they come from
+_scope: ContextVar[Optional[Scope]] = ContextVar('request_scope', default=None)
+
+
+@dataclass
+class SlowQuery:
+    statement: str
+    count: int
+    total_ms: float
+    max_ms: float
+    parameters: str
+    route: Optional[str]
+    schema: Optional[str]
+    explain: Optional[str]
+    last_seen: datetime
+
+
+class SlowQueryLog:
+    '''Aggregates slow statements by their text, keeps at most `size` of them
+    evicting ones with the least total time
+    '''
+    def __init__(self):
+        self._queries: Dict[str, SlowQuery] = {}
+        self._lock = threading.Lock()
+
+    def record(self, statement: str, duration_ms: float, parameters: str, route: Optional[str],
+               schema: Optional[str], explain: Optional[str]):
+        with self._lock:
+            query = self._queries.get(statement)
+            if query is None:
+                if len(self._queries) >= settings.slow_query_log_size:
+                    del self._queries[min(self._queries.values(),
+                                          key=lambda i: i.total_ms).statement]
+                query = self._queries[statement] = SlowQuery(
+                    statement=statement, count=0, total_ms=0.0, max_ms=0.0, parameters=parameters,
+                    route=route, schema=schema, explain=None, last_seen=datetime.now(timezone.utc)
+                )
+            query.count += 1
+            query.total_ms += duration_ms
+            query.last_seen = datetime.now(timezone.utc)
+            if duration_ms >= query.max_ms:
+                query.max_ms = duration_ms
+                query.parameters, query.route, query.schema = parameters, route, schema
+            if explain is not None:
+                query.explain = explain
+
+    def top(self, limit: int = 20) -> List[SlowQuery]:
+        with self._lock:
+            return sorted(self._queries.values(), key=lambda i: i.total_ms, reverse=True)[:limit]
+
+    def clear(self):
+        with self._lock:
+            self._queries.clear()
+
+
+slow_queries = SlowQueryLog()
+
+
+def _request_origin() -> Tuple[Optional[str], Optional[str]]:
+    '''Returns route and slug of schema of request being handled'''
+    scope = _scope.get()
+    if scope is None:
+        return None, None
+    path = getattr(scope.get('route'), 'path', None) or scope['path']
+    match = re.match(r'/entity/(?P<schema_slug>[^/{]+)', path)
+    return f'{scope["method"]} {path}', match and match.group('schema_slug')
+
+
+def _explain(cursor, statement: str, parameters) -> Optional[str]:
+    '''Runs `statement` again with EXPLAIN (ANALYZE, BUFFERS) in a savepoint,
+    so a failure doesn't abort the transaction it was executed in
+    '''
+    dbapi_connection = cursor.connection
+    savepoint = not getattr(dbapi_connection, 'autocommit', False)
+    try:
+        with dbapi_connection.cursor() as explain_cursor:
+            if savepoint:
+                explain_cursor.execute('savepoint slow_query_explain')
+            try:
+                explain_cursor.execute(f'explain (analyze, buffers) {statement}', parameters)
+                return '\n'.join(row[0] for row in explain_cursor.fetchall())
+            except Exception:
+                if savepoint:
+                    explain_cursor.execute('rollback to savepoint slow_query_explain')
+                raise
+            finally:
+                if savepoint:
+                    explain_cursor.execute('release savepoint slow_query_explain')
+    except Exception:
+        logger.exception('Could not explain slow query')
+        return None
+
+
+def _record_slow_query(cursor, statement: str, parameters, executemany: bool, duration_ms: float):
+    route, schema = _request_origin()
+    params = repr(parameters)
+    if len(params) > 1000:
+        params = params[:1000] + '...'
+    logger.warning('Slow query (%.1f ms) in %s: %s\nParameters: %s',
+                   duration_ms, route or 'no request', statement, params)
+    explain = None
+    if not executemany and statement.lstrip()[:6].lower() == 'select' \
+            and random.random() < settings.slow_query_explain_rate:
+        explain = _explain(cursor, statement, parameters)
+    slow_queries.record(statement, duration_ms, params, route, schema, explain)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _stats.get() is not None or settings.slow_query_ms:
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if not conn.info.get('query_start'):
+        return
+    duration = time.perf_counter() - conn.info['query_start'].pop()
+    stats = _stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_time += duration
+    if settings.slow_query_ms and duration * 1000 >= settings.slow_query_ms:
+        _record_slow_query(cursor, statement, parameters, executemany, duration * 1000)
+
+
+@contextmanager
+def count_queries():
+    '''Counts SQL statements executed in the block, including those executed
+    by threads started from it
+    '''
+    stats = QueryStats()
+    token = _stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _stats.reset(token)
+
+
+def query_budget(max_queries: int) -> Callable:
+    '''Declares the maximal number of SQL statements a request to decorated route may execute'''
+    def decorator(func):
+        func.query_budget = max_queries
+        return func
+    return decorator
+
+
+# (method, route, status) -> [requests, queries, db seconds, seconds]
+_metrics: Dict[Tuple[str, str, int], List[float]] = defaultdict(lambda: [0, 0, 0.0, 0.0])
+_metrics_lock = threading.Lock()
+# latest violations, tests check that there are none
+budget_violations: deque = deque(maxlen=1000)
+
+
+def _record(method: str, route: str, status: int, stats: QueryStats, duration: float):
+    with _metrics_lock:
+        values = _metrics[(method, route, status)]
+        values[0] += 1
+        values[1] += stats.queries
+        values[2] += stats.db_time
+        values[3] += duration
+
+
+METRICS = (
+    ('aimaas_requests_total', 'counter', 'Number of handled requests'),
+    ('aimaas_request_queries_total', 'counter', 'Number of SQL statements executed by requests'),
+    ('aimaas_request_db_seconds_total', 'counter', 'Time requests spent executing SQL statements'),
+    ('aimaas_request_seconds_total', 'counter', 'Time spent handling requests'),
+)
+
+
+def render_metrics() -> str:
+    '''Returns metrics in Prometheus text exposition format'''
+    with _metrics_lock:
+        items = sorted(_metrics.items())
+    lines = []
+    for idx, (name, type_, help_) in enumerate(METRICS):
+        lines.extend([f'# HELP {name} {help_}', f'# TYPE {name} {type_}'])
+        for (method, route, status), values in items:
+            route = route.replace('\\', '\\\\').replace('"', '\\"')
+            lines.append(f'{name}{{method="{method}",route="{route}",status="{status}"}} '
+                         f'{values[idx]}')
+    return '\n'.join(lines) + '\n'
+
+
+async def metrics(request: Request) -> PlainTextResponse:
+    return PlainTextResponse(render_metrics(), media_type='text/plain; version=0.0.4')
+
+
+class InstrumentationMiddleware:
+    '''Measures every HTTP request and adds `Server-Timing` header to its response'''
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        stats = QueryStats()
+        token = _stats.set(stats)
+        scope_token = _scope.set(scope)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message: Message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                total = (time.perf_counter() - start) * 1000
+                timing = f'db;dur={stats.db_time * 1000:.1f};desc="{stats.queries} queries", ' \
+                         f'app;dur={total:.1f}'
+                message['headers'] = [*message.get('headers', []),
+                                      (b'server-timing', timing.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _stats.reset(token)
+            _scope.reset(scope_token)
+            route = scope.get('route')
+            path = getattr(route, 'path', None) or 'unmatched'
+            _record(scope['method'], path, status, stats, time.perf_counter() - start)
+            budget = getattr(getattr(route, 'endpoint', None), 'query_budget', None)
+            if budget is not None and stats.queries > budget:
+                violation = f'{scope["method"]} {path} executed {stats.queries} SQL statements, ' \
+                            f'budget is {budget}'
+                logger.warning(violation)
+                budget_violations.append(violation)
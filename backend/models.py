@@ -5,7 +5,7 @@ from typing import List, Union, Optional
 from sqlalchemy import (
     func, select, Enum, DateTime, Date,
     Boolean, Column, ForeignKey,
-    Integer, String, Float)
+    Integer, BigInteger, String, Float, Index, Sequence)
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm.session import Session
 from sqlalchemy.sql.operators import startswith_op, endswith_op, contains_op, regexp_match_op
@@ -65,6 +65,11 @@ class ValueForeignKey(Value):
     __tablename__ = 'values_fk'
     value = Column(Integer)
 
+    __table_args__ = (
+        Index('ix_values_fk_value_attribute_id', 'value', 'attribute_id'),
+        Index('ix_values_fk_entity_id_attribute_id', 'entity_id', 'attribute_id'),
+    )
+
 
 class ValueStr(Value):
     __tablename__ = 'values_str'
@@ -84,17 +89,39 @@ class ValueDate(Value):
 class AttrType(enum.Enum):
     STR = Mapping(ValueStr, str, [FilterEnum.EQ, FilterEnum.LT, FilterEnum.GT, FilterEnum.LE,
                                   FilterEnum.GE, FilterEnum.NE, FilterEnum.CONTAINS, FilterEnum.IEQ,
-                                  FilterEnum.REGEXP, FilterEnum.STARTS])
-    BOOL = Mapping(ValueBool, bool, [FilterEnum.EQ, FilterEnum.NE])
+                                  FilterEnum.REGEXP, FilterEnum.STARTS, FilterEnum.IN, FilterEnum.NIN,
+                                  FilterEnum.ISNULL])
+    BOOL = Mapping(ValueBool, bool, [FilterEnum.EQ, FilterEnum.NE, FilterEnum.ISNULL])
     INT = Mapping(ValueInt, int, [FilterEnum.EQ, FilterEnum.LT, FilterEnum.GT, FilterEnum.LE,
-                                  FilterEnum.GE, FilterEnum.NE])
+                                  FilterEnum.GE, FilterEnum.NE, FilterEnum.IN, FilterEnum.NIN,
+                                  FilterEnum.ISNULL])
     FLOAT = Mapping(ValueFloat, float, [FilterEnum.EQ, FilterEnum.LT, FilterEnum.GT, FilterEnum.LE,
-                                        FilterEnum.GE, FilterEnum.NE])
-    FK = Mapping(ValueForeignKey, int)
+                                        FilterEnum.GE, FilterEnum.NE, FilterEnum.IN, FilterEnum.NIN,
+                                        FilterEnum.ISNULL])
+    FK = Mapping(ValueForeignKey, int, [FilterEnum.EQ, FilterEnum.NE, FilterEnum.IN, FilterEnum.NIN,
+                                        FilterEnum.ISNULL])
     DT = Mapping(ValueDatetime, make_aware_datetime, [FilterEnum.EQ, FilterEnum.LT, FilterEnum.GT,
-                                                      FilterEnum.LE, FilterEnum.GE, FilterEnum.NE])
+                                                      FilterEnum.LE, FilterEnum.GE, FilterEnum.NE,
+                                                      FilterEnum.IN, FilterEnum.NIN, FilterEnum.ISNULL])
     DATE = Mapping(ValueDate, lambda x: x, [FilterEnum.EQ, FilterEnum.LT, FilterEnum.GT,
-                                            FilterEnum.LE, FilterEnum.GE, FilterEnum.NE])
+                                            FilterEnum.LE, FilterEnum.GE, FilterEnum.NE,
+                                            FilterEnum.IN, FilterEnum.NIN, FilterEnum.ISNULL])
+
+
+# filters for fields of `Entity` itself, those are never null
+ENTITY_FILTERS = {
+    'id': [i for i in AttrType.INT.value.filters if i != FilterEnum.ISNULL],
+    'name': [i for i in AttrType.STR.value.filters if i != FilterEnum.ISNULL],
+    'slug': [i for i in AttrType.STR.value.filters if i != FilterEnum.ISNULL],
+}
+
+
+# Versions are taken from sequences on every insert and update of the row,
+# so a version is unique and bigger than all versions assigned before it.
+# Entities take their version again when the transaction commits, see
+# migration a7d3c5e9f1b2, so committed versions grow in order of commits
+schema_version_seq = Sequence('schemas_version_seq', metadata=Base.metadata)
+entity_version_seq = Sequence('entities_version_seq', metadata=Base.metadata)
 
 
 class Schema(Base):
@@ -105,6 +132,10 @@ class Schema(Base):
     slug = Column(String(128), unique=True)
     deleted = Column(Boolean, default=False)
     reviewable = Column(Boolean, default=False)
+    version = Column(BigInteger, nullable=False, server_default=schema_version_seq.next_value(),
+                     onupdate=schema_version_seq.next_value())
+    updated_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now(),
+                        onupdate=func.now())
 
     entities = relationship('Entity', back_populates='schema')
     attr_defs = relationship('AttributeDefinition', back_populates='schema',
@@ -122,11 +153,16 @@ class Entity(Base):
     slug = Column(CaseInsensitiveString(128), nullable=False)
     schema_id = Column(Integer, ForeignKey('schemas.id'))
     deleted = Column(Boolean, default=False)
+    version = Column(BigInteger, nullable=False, server_default=entity_version_seq.next_value(),
+                     onupdate=entity_version_seq.next_value())
+    updated_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now(),
+                        onupdate=func.now())
 
     schema = relationship('Schema', back_populates='entities')
 
     __table_args__ = (
         UniqueConstraint('slug', 'schema_id'),
+        Index('ix_entities_schema_id_version', 'schema_id', 'version'),
     )
 
     def __str__(self):
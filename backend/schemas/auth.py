@@ -71,6 +71,16 @@ class PermissionWithIdSchema(PermissionSchema):
         orm_mode = True
 
 
+class PermissionCheckSchema(BaseModel):
+    permission: PermissionType
+    obj_type: Optional[PermissionTargetType]
+    obj_id: Optional[int]
+
+
+class PermissionCheckResultSchema(PermissionCheckSchema):
+    allowed: bool
+
+
 class BaseGroupSchema(BaseModel):
     name: str
     parent_id: Optional[int]
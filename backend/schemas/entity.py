@@ -1,5 +1,5 @@
 import re
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional
 
 from pydantic import BaseModel, validator, Field, create_model
 
@@ -34,11 +34,36 @@ class EntityByIdSchema(EntityBaseSchema):
             return v
 
 
+class EntityReferenceSchema(EntityByIdSchema):
+    attribute: str = Field(description='Name of the FK attribute holding the reference')
+
+
+class TraversalNodeSchema(EntityByIdSchema):
+    depth: int = Field(description='Number of hops from the start entity')
+
+
+class TraversalEdgeSchema(BaseModel):
+    source: int = Field(description='ID of the entity holding the reference')
+    target: int = Field(description='ID of the referenced entity')
+    attribute: str = Field(description='Name of the FK attribute holding the reference')
+
+
+class TraversalSchema(BaseModel):
+    nodes: List[TraversalNodeSchema]
+    edges: List[TraversalEdgeSchema]
+    truncated: bool = Field(description='True if the node limit cut the traversal short')
+
+
 class EntityListSchema(BaseModel):
     total: int
     entities: List[dict]
 
 
+class AggregationSchema(BaseModel):
+    group: Dict[str, Any] = Field(description='Values of `group_by` attributes shared by the group')
+    metrics: Dict[str, Any] = Field(description='Values of requested metrics for the group')
+
+
 class FilterFields(BaseModel):
     operators: Dict[str, List[str]]
     fields: Dict[str, Dict[str, str]]
@@ -97,6 +122,24 @@ class EntityModelFactory:
             self.__cache[key] = model
             return model
 
+        if variant is ModelVariant.CHANGES:
+            entity_model = self(schema=schema, variant=ModelVariant.GET)
+            change_model = create_model(
+                self.clean_modelname(schema.slug, variant) + 'Item',
+                __base__=entity_model,
+                version=(int, Field(description='Version of entity assigned by its latest change'))
+            )
+            model = create_model(
+                self.clean_modelname(schema.slug, variant),
+                changes=(List[change_model], Field(description='Changed entities in order of their '
+                                                               'versions')),
+                last_version=(int, Field(description='Version to pass as `since` to get next '
+                                                     'changes')),
+                has_more=(bool, Field(description='Indicates whether more changes are available'))
+            )
+            self.__cache[key] = model
+            return model
+
         class Config:
             extra = 'forbid'
 
@@ -1,4 +1,5 @@
 import typing
+from datetime import datetime
 
 from pydantic import BaseModel
 
@@ -13,3 +14,19 @@ class InfoModel(BaseModel):
     filters: typing.List[FilterModel]
     filters_per_type: typing.Dict[str, typing.List[str]]
     help: typing.Dict[str, typing.Optional[str]]
+
+
+class SlowQueryModel(BaseModel):
+    statement: str
+    count: int
+    total_ms: float
+    max_ms: float
+    parameters: str
+    route: typing.Optional[str]
+    schema_: typing.Optional[str]
+    explain: typing.Optional[str]
+    last_seen: datetime
+
+    class Config:
+        orm_mode = True
+        fields = {'schema_': 'schema'}
@@ -36,7 +36,20 @@ class ChangeRequestSchema(BaseModel):
 class ChangeReviewSchema(BaseModel):
     result: ReviewResult
     comment: Optional[str]
-    
+
+
+class BatchReviewSchema(ChangeReviewSchema):
+    ids: List[int] = Field(min_items=1, max_items=1000,
+                           description='IDs of change requests to review')
+
+
+class BatchReviewResultSchema(BaseModel):
+    id: int
+    status_code: int = Field(description='Status that reviewing this change request alone would '
+                                         'respond with')
+    detail: Optional[str] = Field(description='Reason, why change request was not reviewed')
+    change_request: Optional[ChangeRequestSchema]
+
 
 class ChangedEntitySchema(BaseModel):
     slug: str
@@ -0,0 +1,109 @@
+"""
+Serialization of entity listings without validating them against response models.
+
+Values in rows of listings come from value tables, so they already have the types of
+attributes. Validating the rows with pydantic and encoding the resulting models with
+`jsonable_encoder` only costs time, which grows with page size. `ListingSerializer`
+renders the same JSON FastAPI produces for the response model of a listing with
+`response_model_exclude_unset=True`: fields in order of the model, only the ones present
+in rows, dates in ISO format, encoded by the response class of the app.
+
+Responses with many items are streamed. Rows of the page are loaded before the response
+starts, but items are converted and encoded one by one while it is sent, so the encoded
+document isn't built in memory at once (unless the response is cached).
+"""
+from datetime import date
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple, Type
+
+from fastapi import Response
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
+from fastapi_pagination import Page
+from pydantic import BaseModel
+from pydantic.fields import SHAPE_LIST
+
+from .config import settings
+
+
+# number of items encoded into one chunk of streamed response
+STREAM_CHUNK_ITEMS = 50
+
+
+def json_response_class() -> Type[JSONResponse]:
+    '''Returns response class configured by `settings.json_response`'''
+    if settings.json_response == 'json':
+        return JSONResponse
+    if settings.json_response == 'orjson':
+        import orjson  # fails early if orjson is not installed
+        return ORJSONResponse
+    raise ValueError(f'Unknown JSON response class: {settings.json_response}')
+
+
+def _isoformat(value: Optional[date]) -> Optional[str]:
+    return value if value is None else value.isoformat()
+
+
+def _isoformat_list(values: Optional[List[date]]) -> Optional[List[str]]:
+    return values if values is None else [i.isoformat() for i in values]
+
+
+class ListingSerializer:
+    '''Renders rows returned by `crud` for entities of `model`, which is GET model
+    of their schema or a model derived from it
+    '''
+    def __init__(self, model: Type[BaseModel]):
+        # (key, converter to JSON compatible value or `None` if value already is one)
+        self.fields: List[Tuple[str, Optional[Callable[[Any], Any]]]] = []
+        for field in model.__fields__.values():
+            converter = None
+            if isinstance(field.type_, type) and issubclass(field.type_, date):
+                converter = _isoformat_list if field.shape == SHAPE_LIST else _isoformat
+            self.fields.append((field.alias, converter))
+
+    def item(self, row: Dict[str, Any]) -> Dict[str, Any]:
+        item = {}
+        for key, converter in self.fields:
+            if key in row:
+                item[key] = row[key] if converter is None else converter(row[key])
+        return item
+
+    async def _stream(self, render: Callable[[Any], bytes], content: Dict[str, Any],
+                      key: str) -> AsyncIterator[bytes]:
+        '''Yields the same JSON as `render` would return for `content` with items
+        converted from rows under `key`
+        '''
+        yield b'{'
+        for idx, (k, v) in enumerate(content.items()):
+            prefix = (b',' if idx else b'') + render(k) + b':'
+            if k != key:
+                yield prefix + render(v)
+                continue
+            chunk = [prefix, b'[']
+            for i, row in enumerate(v):
+                if i:
+                    chunk.append(b',')
+                chunk.append(render(self.item(row)))
+                if len(chunk) >= 2 * STREAM_CHUNK_ITEMS:
+                    yield b''.join(chunk)
+                    chunk = []
+            chunk.append(b']')
+            yield b''.join(chunk)
+        yield b'}'
+
+    def render(self, content: Dict[str, Any], key: str,
+               headers: Optional[Dict[str, str]] = None) -> Response:
+        '''Returns response with `content`, in which rows under `key` are replaced by items.
+        Response is streamed if there are at least `settings.stream_min_items` rows
+        '''
+        response_class = json_response_class()
+        rows: List[dict] = content[key]
+        if 0 < settings.stream_min_items <= len(rows):
+            # `render` of JSON responses only encodes passed content
+            render = response_class.__new__(response_class).render
+            return StreamingResponse(self._stream(render, content, key), headers=headers,
+                                     media_type=response_class.media_type)
+        return response_class({**content, key: [self.item(i) for i in rows]}, headers=headers)
+
+    def render_page(self, page: Page, headers: Optional[Dict[str, str]] = None) -> Response:
+        content = {key: getattr(page, key) for key in page.__fields__
+                   if key in page.__fields_set__}
+        return self.render(content, 'items', headers=headers)
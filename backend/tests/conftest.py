@@ -13,7 +13,9 @@ from ..auth import authenticated_user, authorized_user
 from ..auth.crud import get_or_create_user, get_user, grant_permission
 from ..auth.enum import RecipientType, PermissionType
 from ..auth.models import User, Permission
+from ..auth.tokens import token_cache
 from ..database import get_db
+from ..instrumentation import budget_violations
 from ..models import *
 from ..schemas.auth import UserCreateSchema, PermissionSchema
 from ..traceability.enum import EditableObjectType, ChangeType, ContentType
@@ -333,6 +335,27 @@ def dbsession(engine) -> Session:
     session.close()
 
 
+@pytest.fixture(scope="session", autouse=True)
+def instrumentation():
+    config.settings.instrumentation = True
+    yield
+    config.settings.instrumentation = False
+
+
+@pytest.fixture(autouse=True)
+def query_budgets():
+    '''Fails test, in which a request executed more SQL statements than its route allows'''
+    budget_violations.clear()
+    yield
+    assert not budget_violations, '\n'.join(budget_violations)
+
+
+@pytest.fixture(autouse=True)
+def clear_token_cache():
+    # users are created anew for every test
+    token_cache.clear()
+
+
 @pytest.fixture
 def testuser(dbsession) -> User:
     return get_user(db=dbsession, username=TEST_USER.username)
@@ -4,8 +4,12 @@ import pytest
 from fastapi.testclient import TestClient
 from sqlalchemy.orm import Session
 
-from ..auth import authenticate_user, authenticated_user, authorized_user
-from ..auth.crud import add_members, has_permission
+from datetime import timedelta
+
+from .. import auth
+from ..auth import authenticate_user, authenticated_user, authorized_user, create_access_token
+from ..auth.crud import add_members, has_permission, deactivate_user
+from ..auth.tokens import token_cache
 from ..auth.enum import RecipientType, PermissionTargetType, PermissionType
 from ..auth.models import User, Permission, Group
 from ..config import settings
@@ -333,6 +337,58 @@ class TestRoutePermission(CreateMixin):
         response = authorized_client.delete("/permissions", json=[9999])
         assert response.status_code == 404
 
+    def test_check_permissions(self, dbsession: Session, client: TestClient):
+        user, group, _ = self._create_user_group_with_perm(dbsession)
+        client.app.dependency_overrides[authenticated_user] = \
+            fake_authenticated_user(db=dbsession, username_override=user.username)
+        entities = self.get_default_entities(dbsession)
+        other_schema = dbsession.query(Schema).filter(Schema.slug == 'unperson').one()
+        targets = [(PermissionTargetType.ENTITY, i.id) for i in entities.values()]
+        targets += [(PermissionTargetType.SCHEMA, entities['Jack'].schema_id),
+                    (PermissionTargetType.SCHEMA, other_schema.id),
+                    (PermissionTargetType.GROUP, group.id),
+                    (PermissionTargetType.ENTITY, 9999),
+                    (None, None)]
+        checks = [{'permission': permission.value, 'obj_type': obj_type and obj_type.value,
+                   'obj_id': obj_id}
+                  for permission in (PermissionType.READ_ENTITY, PermissionType.DELETE_ENTITY,
+                                     PermissionType.CREATE_SCHEMA)
+                  for obj_type, obj_id in targets]
+
+        response = client.post('/permissions/check', json=checks)
+        assert response.status_code == 200
+        results = response.json()
+        assert [{k: v for k, v in i.items() if k != 'allowed'} for i in results] == checks
+
+        models = {None: lambda id: None, PermissionTargetType.ENTITY: Entity,
+                  PermissionTargetType.SCHEMA: Schema, PermissionTargetType.GROUP: Group}
+        expected = [has_permission(user, RequirePermission(
+                        permission=PermissionType(i['permission']),
+                        target=models[i['obj_type'] and PermissionTargetType(i['obj_type'])](
+                            id=i['obj_id'])
+                    ), dbsession) for i in checks]
+        assert [i['allowed'] for i in results] == expected
+        assert 0 < sum(expected) < len(expected)
+
+    def test_check_permissions__superuser(self, authenticated_client: TestClient):
+        response = authenticated_client.post('/permissions/check', json=[
+            {'permission': PermissionType.DELETE_SCHEMA.value},
+            {'permission': PermissionType.READ_ENTITY.value,
+             'obj_type': PermissionTargetType.ENTITY.value, 'obj_id': 1}
+        ])
+        assert [i['allowed'] for i in response.json()] == [True, True]
+
+    def test_check_permissions__raise_on_invalid_target(self, authenticated_client: TestClient):
+        response = authenticated_client.post('/permissions/check', json=[
+            {'permission': PermissionType.READ_ENTITY.value,
+             'obj_type': PermissionTargetType.ENTITY.value}
+        ])
+        assert response.status_code == 422
+        response = authenticated_client.post('/permissions/check', json=[
+            {'permission': PermissionType.READ_ENTITY.value}
+        ] * 1001)
+        assert response.status_code == 422
+
 
 class TestRouteLogin:
     def test_login(self, client: TestClient, testuser: User):
@@ -352,6 +408,52 @@ class TestRouteLogin:
         assert response.status_code == 401
 
 
+class TestTokenCache:
+    def _get(self, client: TestClient, token: str):
+        return client.get('/users/tester/memberships', headers={'Authorization': f'Bearer {token}'})
+
+    def test_verified_token_is_cached(self, client: TestClient, testuser: User, mocker):
+        get_user = mocker.spy(auth, 'get_user')
+        token, _ = create_access_token({'sub': testuser.username}, timedelta(minutes=5))
+        assert self._get(client, token).status_code == 200
+        assert self._get(client, token).status_code == 200
+        assert get_user.call_count == 1
+        assert token_cache.get(token).username == testuser.username
+
+        assert self._get(client, 'not-a-token').status_code == 401
+        assert token_cache.get('not-a-token') is None
+
+    def test_cached_user_in_writes(self, dbsession: Session, client: TestClient, testuser: User):
+        token, _ = create_access_token({'sub': testuser.username}, timedelta(minutes=5))
+        for slug in ('first', 'second'):
+            response = client.post('/entity/person', headers={'Authorization': f'Bearer {token}'},
+                                   json={'slug': slug, 'name': slug, 'age': 20})
+            assert response.status_code == 200
+        requests = dbsession.query(ChangeRequest).order_by(ChangeRequest.id.desc()).limit(2).all()
+        assert [i.created_by_user_id for i in requests] == [testuser.id] * 2
+
+    def test_cache_is_dropped_on_deactivation(self, dbsession: Session, client: TestClient,
+                                              testuser: User, mocker):
+        get_user = mocker.spy(auth, 'get_user')
+        token, _ = create_access_token({'sub': testuser.username}, timedelta(minutes=5))
+        self._get(client, token)
+        assert token_cache.get(token).is_active
+
+        deactivate_user(db=dbsession, username=testuser.username)
+        assert token_cache.get(token) is None
+        self._get(client, token)
+        assert get_user.call_count == 2
+        assert not token_cache.get(token).is_active
+
+    def test_cache_off(self, client: TestClient, testuser: User, mocker):
+        mocker.patch.object(settings, 'token_cache_ttl', 0)
+        get_user = mocker.spy(auth, 'get_user')
+        token, _ = create_access_token({'sub': testuser.username}, timedelta(minutes=5))
+        self._get(client, token)
+        self._get(client, token)
+        assert get_user.call_count == 2
+
+
 class TestRoutesRequiringAuth(CreateMixin):
     # Routes requiring authentication
     authenticated = (
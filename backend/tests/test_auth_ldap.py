@@ -0,0 +1,86 @@
+import pytest
+from ldap3 import Connection, MOCK_SYNC, Server
+
+from ..auth import authenticate_user
+from ..auth.backends.ldap import Backend
+from ..auth.crud import get_user
+from ..config import settings
+
+
+@pytest.fixture
+def directory(mocker):
+    server = Server('fake-ldap')
+    mocker.patch.object(Backend, '_server', server)
+    mocker.patch.object(Backend, 'client_strategy', MOCK_SYNC)
+    mocker.patch.object(settings, 'auth_backends', 'ldap')
+    Backend.reset()
+    conn = Connection(server, client_strategy=MOCK_SYNC)
+    conn.strategy.add_entry(settings.ldap.user, {'userPassword': settings.ldap.password,
+                                                 'objectClass': 'person'})
+    conn.strategy.add_entry('uid=ldapuser,cn=users,dc=suse,dc=de', {
+        'uid': 'ldapuser', 'userPassword': 'ldap-password', 'mail': 'ldapuser@example.org',
+        'givenName': 'Lenny', 'sn': 'Dap', 'objectClass': 'person'
+    })
+    yield conn
+    Backend.reset()
+
+
+class TestLdapBackend:
+    def test_authenticate(self, dbsession, directory):
+        user = authenticate_user(dbsession, 'ldapuser', 'ldap-password')
+        assert user.username == 'ldapuser'
+        assert user.email == 'ldapuser@example.org'
+        assert get_user(dbsession, 'ldapuser').id == user.id
+
+        assert authenticate_user(dbsession, 'ldapuser', 'wrong') is None
+        assert authenticate_user(dbsession, 'nobody', 'ldap-password') is None
+
+    def test_connections_are_reused(self, dbsession, directory, mocker):
+        connect = mocker.spy(Backend, '_connect')
+        for _ in range(3):
+            assert authenticate_user(dbsession, 'ldapuser', 'ldap-password')
+        assert authenticate_user(dbsession, 'ldapuser', 'wrong') is None
+        # one bound to service account, one for checking passwords
+        assert connect.call_count == 2
+
+    def test_broken_connections_are_replaced(self, dbsession, directory, mocker):
+        assert authenticate_user(dbsession, 'ldapuser', 'ldap-password')
+        connect = mocker.spy(Backend, '_connect')
+        for pool in Backend._pools.values():
+            for _, conn in pool._idle:
+                conn.unbind()
+        Backend.directory_cache.clear()
+        assert authenticate_user(dbsession, 'ldapuser', 'ldap-password')
+        assert connect.call_count == 2
+
+        mocker.patch.object(Backend._pools['search'], 'lifetime', 0)
+        Backend.directory_cache.clear()
+        assert authenticate_user(dbsession, 'ldapuser', 'ldap-password')
+        assert connect.call_count == 3
+
+    def test_directory_data_is_cached(self, dbsession, directory, mocker):
+        search = mocker.spy(Connection, 'search')
+        assert authenticate_user(dbsession, 'ldapuser', 'ldap-password')
+        assert authenticate_user(dbsession, 'ldapuser', 'ldap-password')
+        assert search.call_count == 1
+        # password is still checked by directory
+        assert authenticate_user(dbsession, 'ldapuser', 'wrong') is None
+
+        mocker.patch.object(settings.ldap, 'cache_ttl', 0)
+        Backend.directory_cache.clear()
+        assert authenticate_user(dbsession, 'ldapuser', 'ldap-password')
+        assert authenticate_user(dbsession, 'ldapuser', 'ldap-password')
+        assert search.call_count == 3
+
+    def test_several_backends(self, dbsession, directory, testuser, mocker):
+        mocker.patch.object(settings, 'auth_backends', 'local,ldap')
+        prefetch = mocker.spy(Backend, 'prefetch')
+        assert authenticate_user(dbsession, 'ldapuser', 'ldap-password').username == 'ldapuser'
+        assert authenticate_user(dbsession, 'tester', 'password').id == testuser.id
+        assert prefetch.call_count == 2
+
+        # failing directory doesn't prevent login with local account
+        mocker.patch.object(Backend, 'get_user_data', side_effect=OSError('unreachable'))
+        assert authenticate_user(dbsession, 'tester', 'password').id == testuser.id
+        with pytest.raises(OSError):
+            authenticate_user(dbsession, 'ldapuser', 'ldap-password')
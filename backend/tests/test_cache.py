@@ -0,0 +1,200 @@
+from datetime import timedelta
+
+import pytest
+
+from .. import crud, general_routes
+from ..auth import closure, create_access_token, effective
+from ..auth.crud import create_user, grant_permission
+from ..auth.enum import PermissionTargetType, PermissionType, RecipientType
+from ..config import settings
+from ..cache import CacheBackend, LRUBackend, RedisBackend, set_backend, get_backend
+from ..schemas import SchemaUpdateSchema, ChangeReviewSchema
+from ..schemas.auth import PermissionSchema, UserCreateSchema
+from ..traceability.crud import review_changes_batch
+from ..traceability.entity import create_entity_update_request
+from ..traceability.enum import ReviewResult
+
+from .mixins import DefaultMixin
+
+
+@pytest.fixture
+def cache():
+    backend = LRUBackend(size=100)
+    set_backend(backend)
+    yield backend
+    set_backend(None)
+
+
+def _token(username: str) -> str:
+    return create_access_token({'sub': username}, timedelta(minutes=5))[0]
+
+
+@pytest.fixture
+def redis_backend():
+    fakeredis = pytest.importorskip('fakeredis')
+    return RedisBackend(client=fakeredis.FakeRedis())
+
+
+class TestBackends:
+    def test_lru(self):
+        backend = LRUBackend(size=2)
+        backend.set('a', b'1', ttl=10)
+        backend.set('b', b'2', ttl=10)
+        assert backend.get('a') == b'1'
+        backend.set('c', b'3', ttl=10)  # evicts `b` as least recently used
+        assert backend.get('b') is None
+        assert backend.get('a') == b'1' and backend.get('c') == b'3'
+
+        backend.set('d', b'4', ttl=-1)
+        assert backend.get('d') is None
+
+    @pytest.mark.parametrize('backend', [LRUBackend(), 'redis_backend'])
+    def test_generations(self, backend, request):
+        if isinstance(backend, str):
+            backend = request.getfixturevalue(backend)
+        assert backend.get_generations(['schemas', 'entities']) == [0, 0]
+        backend.bump(['entities'])
+        backend.bump(['entities', 'changes'])
+        assert backend.get_generations(['schemas', 'entities', 'changes']) == [0, 2, 1]
+
+    def test_redis(self, redis_backend):
+        redis_backend.set('a', b'1', ttl=10)
+        assert redis_backend.get('a') == b'1'
+        assert redis_backend.get('b') is None
+        assert redis_backend.client.ttl('aimaas:a') <= 10
+
+    def test_no_backend_by_default(self):
+        assert get_backend() is None
+
+    def test_backend_is_abstract(self):
+        with pytest.raises(TypeError):
+            CacheBackend()
+
+
+class TestInvalidation(DefaultMixin):
+    def test_commit_bumps_scopes(self, dbsession, cache):
+        entity = self.get_default_entity(dbsession)
+        entity.name = 'John'
+        dbsession.commit()
+        assert cache.get_generations(['schemas', 'entities', 'changes']) == [0, 1, 0]
+
+        crud.update_entity(dbsession, id_or_slug=entity.id, schema_id=entity.schema_id,
+                           data={'age': 11})
+        assert cache.get_generations(['schemas', 'entities', 'changes']) == [0, 2, 0]
+
+        schema = self.get_default_schema(dbsession)
+        schema.reviewable = True
+        dbsession.commit()
+        assert cache.get_generations(['schemas', 'entities', 'changes']) == [1, 3, 0]
+
+    @pytest.mark.parametrize('rebuild', [closure.rebuild, effective.rebuild])
+    def test_rebuild_bumps_permissions(self, dbsession, cache, rebuild):
+        dbsession.commit()
+        before = cache.get_generations(['permissions'])
+        rebuild(dbsession)
+        dbsession.commit()
+        assert cache.get_generations(['permissions']) == [before[0] + 1]
+
+    def test_rollback_doesnt_bump(self, dbsession, cache):
+        entity = self.get_default_entity(dbsession)
+        entity.name = 'John'
+        dbsession.flush()
+        dbsession.rollback()
+        dbsession.commit()
+        assert cache.get_generations(['entities']) == [0]
+
+    def test_savepoint_sessions_defer_to_parent(self, dbsession, cache, testuser):
+        entity = self.get_default_entity(dbsession)
+        requests = [
+            create_entity_update_request(dbsession, id_or_slug=entity.id,
+                                         schema_id=entity.schema_id, data={'age': i},
+                                         created_by=testuser).id
+            for i in (11, 12)
+        ]
+        before = cache.get_generations(['entities', 'changes'])
+        review_changes_batch(dbsession, change_request_ids=requests,
+                             review=ChangeReviewSchema(result=ReviewResult.APPROVE),
+                             reviewed_by=testuser)
+        # bumped once on commit of the whole batch, not for every reviewed request
+        assert cache.get_generations(['entities', 'changes']) == [i + 1 for i in before]
+
+
+class TestCachedRoutes(DefaultMixin):
+    def test_cache_attributes(self, dbsession, client, cache, mocker):
+        spy = mocker.spy(crud, 'get_attributes')
+        first = client.get('/attributes')
+        second = client.get('/attributes')
+        assert first.json() == second.json()
+        assert second.headers['etag'] == first.headers['etag']
+        assert spy.call_count == 1
+
+        response = client.get('/attributes', headers={'If-None-Match': first.headers['etag']})
+        assert response.status_code == 304
+
+        attrs = self.get_default_attr_def_schemas(dbsession)
+        crud.update_schema(dbsession, id_or_slug='person',
+                           data=SchemaUpdateSchema(slug='person', attributes=attrs[:-1]))
+        client.get('/attributes')
+        assert spy.call_count == 2
+
+    def test_cache_entity_listing(self, dbsession, client, cache, mocker):
+        spy = mocker.spy(crud, 'get_entities')
+        assert [i['age'] for i in client.get('/entity/person').json()['items']] == [10, 12]
+        client.get('/entity/person')
+        assert spy.call_count == 1
+        client.get('/entity/person?age.gt=10')
+        assert spy.call_count == 2
+
+        entity = self.get_default_entity(dbsession)
+        crud.update_entity(dbsession, id_or_slug=entity.id, schema_id=entity.schema_id,
+                           data={'age': 11})
+        assert [i['age'] for i in client.get('/entity/person').json()['items']] == [11, 12]
+        assert spy.call_count == 3
+
+    def test_cache_streamed_entity_listing(self, dbsession, client, cache, mocker):
+        mocker.patch.object(settings, 'stream_min_items', 1)
+        spy = mocker.spy(crud, 'get_entities')
+        first = client.get('/entity/person')
+        second = client.get('/entity/person')
+        assert 'content-length' not in first.headers
+        assert second.content == first.content
+        assert second.headers['content-type'] == first.headers['content-type']
+        assert spy.call_count == 1
+
+    def test_cache_readable_entity_listing(self, dbsession, client, cache, mocker, testuser):
+        mocker.patch.object(settings, 'enforce_read_permissions', True)
+        spy = mocker.spy(crud, 'get_entities')
+        create_user(dbsession, UserCreateSchema(username='reader', password='secret',
+                                                email='reader@example.org'))
+        superuser, user = ({'Authorization': f'Bearer {_token(i)}'}
+                           for i in (testuser.username, 'reader'))
+        assert len(client.get('/entity/person', headers=superuser).json()['items']) == 2
+        assert client.get('/entity/person', headers=user).json()['items'] == []
+        client.get('/entity/person', headers=user)
+        assert spy.call_count == 2
+
+        entity = self.get_default_entity(dbsession)
+        grant_permission(PermissionSchema(recipient_type=RecipientType.USER,
+                                          recipient_name='reader',
+                                          obj_type=PermissionTargetType.ENTITY, obj_id=entity.id,
+                                          permission=PermissionType.READ_ENTITY), dbsession)
+        assert len(client.get('/entity/person', headers=user).json()['items']) == 1
+        assert spy.call_count == 3
+
+    def test_cache_pending_count(self, dbsession, client, cache, mocker, testuser):
+        spy = mocker.spy(general_routes, 'get_pending_change_request_count')
+        count = client.get('/changes/pending/count').json()['count']
+        assert client.get('/changes/pending/count').json()['count'] == count
+        assert spy.call_count == 1
+
+        entity = self.get_default_entity(dbsession)
+        create_entity_update_request(db=dbsession, id_or_slug=entity.id, schema_id=entity.schema_id,
+                                     data={'name': 'John'}, created_by=testuser)
+        assert client.get('/changes/pending/count').json()['count'] == count + 1
+        assert spy.call_count == 2
+
+    def test_no_caching_without_backend(self, dbsession, client, mocker):
+        spy = mocker.spy(crud, 'get_attributes')
+        client.get('/attributes')
+        client.get('/attributes')
+        assert spy.call_count == 2
@@ -1,12 +1,14 @@
 import pytest
 from sqlalchemy.orm import Session
 
+from ..auth import closure, effective
 from ..auth.backends.local import Backend
 from ..auth.crud import create_group, update_group, get_user_by_id, add_members, \
     delete_members, delete_group, revoke_permissions, get_permissions, has_permission, \
-    get_group, get_groups, get_group_or_raise, get_group_details, get_group_members, get_user
+    get_group, get_groups, get_group_or_raise, get_group_details, get_group_members, get_user, \
+    get_granted_permissions
 from ..auth.enum import RecipientType, PermissionTargetType, PermissionType
-from ..auth.models import User, Permission
+from ..auth.models import User, Permission, GroupClosure, EffectivePermission
 from .. import exceptions, models
 from ..schemas.auth import BaseGroupSchema, UserCreateSchema, PermissionSchema, RequirePermission
 from .mixins import CreateMixin
@@ -59,6 +61,56 @@ class TestGroup(CreateMixin):
         assert g21.parent_id == g2.id
         assert g21.name == "New G11"
 
+    @staticmethod
+    def _closure(dbsession: Session) -> set:
+        names = {g.id: g.name for g in get_groups(dbsession)}
+        return {(names[i.ancestor_id], names[i.descendant_id], i.depth)
+                for i in dbsession.query(GroupClosure)}
+
+    def test_group_closure(self, dbsession: Session):
+        a = create_group(data=BaseGroupSchema(name="a"), db=dbsession)
+        b = create_group(data=BaseGroupSchema(name="b", parent_id=a.id), db=dbsession)
+        c = create_group(data=BaseGroupSchema(name="c", parent_id=b.id), db=dbsession)
+        d = create_group(data=BaseGroupSchema(name="d"), db=dbsession)
+        assert self._closure(dbsession) == {
+            ('a', 'a', 0), ('b', 'b', 0), ('c', 'c', 0), ('d', 'd', 0),
+            ('a', 'b', 1), ('b', 'c', 1), ('a', 'c', 2)
+        }
+
+        # move subtree b -> c below d
+        update_group(group_id=b.id, data=BaseGroupSchema(name="b", parent_id=d.id), db=dbsession)
+        expected = {
+            ('a', 'a', 0), ('b', 'b', 0), ('c', 'c', 0), ('d', 'd', 0),
+            ('d', 'b', 1), ('b', 'c', 1), ('d', 'c', 2)
+        }
+        assert self._closure(dbsession) == expected
+
+        dbsession.query(GroupClosure).filter(GroupClosure.depth > 0).delete()
+        closure.rebuild(dbsession)
+        assert self._closure(dbsession) == expected
+
+        delete_group(group_id=c.id, db=dbsession)
+        assert self._closure(dbsession) == expected - {('c', 'c', 0), ('b', 'c', 1), ('d', 'c', 2)}
+
+    def test_deep_group_permissions(self, dbsession: Session):
+        user = self._create_user(dbsession)
+        parent_id = None
+        for level in range(8):
+            parent_id = create_group(data=BaseGroupSchema(name=f"level{level}", parent_id=parent_id),
+                                     db=dbsession).id
+        add_members(parent_id, [user.id], dbsession)
+        self._grant_permission(dbsession, PermissionSchema(
+            recipient_type=RecipientType.GROUP, recipient_name='level0',
+            permission=PermissionType.CREATE_SCHEMA
+        ))
+        assert has_permission(user, RequirePermission(permission=PermissionType.CREATE_SCHEMA),
+                              dbsession)
+        assert not has_permission(user, RequirePermission(permission=PermissionType.DELETE_SCHEMA),
+                                  dbsession)
+        perms = get_permissions(dbsession, recipient_type=RecipientType.USER,
+                                recipient_id=user.id)
+        assert [i.permission for i in perms] == [PermissionType.CREATE_SCHEMA]
+
     def test_add_member(self, dbsession: Session):
         group = self._create_group(dbsession)
         assert len(group.members) == 0
@@ -344,3 +396,52 @@ class TestPermission(CreateMixin):
         )
         assert permissions_count == 0
 
+    @staticmethod
+    def _effective(dbsession: Session, user_id: int) -> set:
+        return {i.permission for i in dbsession.query(EffectivePermission)
+                .filter(EffectivePermission.user_id == user_id)}
+
+    def test_effective_permissions(self, dbsession: Session):
+        user, group, parent_group = self._create_user_group_with_perm(dbsession)
+        other = create_group(BaseGroupSchema(name="other"), dbsession)
+        self._grant_permission(dbsession, PermissionSchema(
+            recipient_type=RecipientType.GROUP, recipient_name="other",
+            permission=PermissionType.CREATE_SCHEMA
+        ))
+        from_parent = {PermissionType.READ_ENTITY}
+        from_group = {PermissionType.UPDATE_ENTITY, PermissionType.CREATE_ENTITY}
+        direct = {PermissionType.DELETE_ENTITY}
+        assert self._effective(dbsession, user.id) == from_parent | from_group | direct
+
+        # user stays member of moved subgroup, but not of its old parent
+        update_group(group.id, BaseGroupSchema(name=group.name, parent_id=other.id), dbsession)
+        assert self._effective(dbsession, user.id) == \
+            from_group | direct | {PermissionType.CREATE_SCHEMA}
+
+        update_group(group.id, BaseGroupSchema(name=group.name, parent_id=parent_group.id),
+                     dbsession)
+        add_members(other.id, [user.id], dbsession)
+        assert self._effective(dbsession, user.id) == \
+            from_parent | from_group | direct | {PermissionType.CREATE_SCHEMA}
+
+        delete_members(other.id, [user.id], dbsession)
+        assert self._effective(dbsession, user.id) == from_parent | from_group | direct
+
+        revoke_permissions([i.id for i in dbsession.query(Permission)
+                            .filter(Permission.recipient_type == RecipientType.USER)], dbsession)
+        assert self._effective(dbsession, user.id) == from_parent | from_group
+
+        delete_group(group.id, dbsession)
+        assert self._effective(dbsession, user.id) == set()
+
+    def test_effective_permissions_rebuild(self, dbsession: Session, testuser: User):
+        user, _, _ = self._create_user_group_with_perm(dbsession)
+        rows = {(i.user_id, i.permission_id) for i in dbsession.query(EffectivePermission)}
+        assert {i[0] for i in rows} == {user.id, testuser.id}
+
+        dbsession.query(EffectivePermission).delete()
+        assert get_granted_permissions(dbsession, user, [PermissionType.READ_ENTITY]) == []
+        effective.rebuild(dbsession)
+        assert {(i.user_id, i.permission_id) for i in dbsession.query(EffectivePermission)} \
+            == rows
+        assert get_granted_permissions(dbsession, user, [PermissionType.READ_ENTITY])
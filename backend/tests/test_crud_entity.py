@@ -2,10 +2,14 @@ import typing
 from datetime import timezone, timedelta, datetime
 
 import pytest
+from sqlalchemy import create_engine
 from sqlalchemy.exc import DataError
+from sqlalchemy.orm import sessionmaker
 
+from .. import crud
 from ..crud import *
 from ..models import *
+from ..enum import TraversalDirection
 from ..exceptions import *
 
 from .mixins import DefaultMixin
@@ -283,6 +287,16 @@ class TestEntityRead(DefaultMixin):
         data = get_entity(dbsession, id_or_slug=jack.slug, schema=jack.schema)
         assert data == expected
 
+    def test_list_values_are_sorted(self, dbsession):
+        jack = self.get_default_entity(dbsession)
+        fav_color = dbsession.execute(select(Attribute).where(Attribute.name == 'fav_color'))\
+            .scalar_one()
+        dbsession.add_all([ValueStr(value=i, entity_id=jack.id, attribute_id=fav_color.id)
+                           for i in ('ärger', 'Red', 'Blue')])
+        dbsession.flush()
+        data = get_entity(dbsession, id_or_slug=jack.id, schema=jack.schema)
+        assert data['fav_color'] == sorted(['blue', 'red', 'ärger', 'Red', 'Blue'])
+
     def test_raise_on_entity_doesnt_exist(self, dbsession):
         with pytest.raises(MissingEntityException):
             get_entity(dbsession, id_or_slug=9999999999, schema=Schema())
@@ -295,6 +309,28 @@ class TestEntityRead(DefaultMixin):
         with pytest.raises(MissingEntityException):
             get_entity(dbsession, id_or_slug=p.id, schema=s)
 
+    def test_get_with_fields(self, dbsession):
+        jack = self.get_default_entity(dbsession)
+        data = get_entity(dbsession, id_or_slug=jack.id, schema=jack.schema,
+                          fields=['fav_color', 'age'])
+        assert data == {'id': jack.id, 'name': 'Jack', 'slug': 'Jack', 'deleted': False,
+                        'age': 10, 'fav_color': ['blue', 'red']}
+
+        res = get_entities(dbsession, schema=jack.schema, fields=['nickname'], all_fields=True)
+        assert [self.strip_ids(i) for i in res.items] == [
+            {'name': 'Jack', 'slug': 'Jack', 'deleted': False, 'nickname': 'jack'},
+            {'name': 'Jane', 'slug': 'Jane', 'deleted': False, 'nickname': 'jane'}
+        ]
+        res = get_entities(dbsession, schema=jack.schema, fields=[])
+        assert set(res.items[0]) == {'id', 'name', 'slug', 'deleted'}
+
+    def test_raise_on_invalid_fields(self, dbsession):
+        jack = self.get_default_entity(dbsession)
+        with pytest.raises(AttributeNotDefinedException):
+            get_entity(dbsession, id_or_slug=jack.id, schema=jack.schema, fields=['age', 'qwe'])
+        with pytest.raises(AttributeNotDefinedException):
+            get_entities(dbsession, schema=jack.schema, fields=['address'])
+
     def test_get_entities(self, dbsession):
         # test default behavior: return not deleted entities
         schema = self.get_default_schema(dbsession)
@@ -393,6 +429,107 @@ class TestEntityRead(DefaultMixin):
         assert len(ents) == ent_len == total
         assert [i['slug'] for i in ents] == slugs
 
+    @pytest.mark.parametrize(['filters', 'slugs'], [
+        ({'age.in': [10, 12]},                      ['Jack', 'Jane']),
+        ({'age.in': [10, 11]},                      ['Jack']),
+        ({'age.in': []},                            []),
+        ({'age.nin': [10]},                         ['Jane']),
+        ({'nickname.in': ['jane', 'john']},         ['Jane']),
+        ({'fav_color.nin': ['red', 'blue']},        []),
+        ({'fav_color.nin': ['blue']},               ['Jane']),
+        ({'fav_color.nin': ['red']},                []),
+        ({'fav_color.nin': ['blue'], 'age.lt': 11}, []),
+        ({'slug.in': ['Jack', 'Jane']},             ['Jack', 'Jane']),
+        ({'name.nin': ['Jack']},                    ['Jane']),
+        ({'born.isnull': True},                     ['Jack', 'Jane']),
+        ({'born.isnull': False},                    []),
+        ({'age.isnull': False, 'age.gt': 10},       ['Jane']),
+        ({'friends.nickname.isnull': False},        ['Jane']),
+    ])
+    def test_get_with_set_and_null_filter(self, dbsession, filters, slugs):
+        schema = self.get_default_schema(dbsession)
+        res = get_entities(dbsession, schema=schema, filters=filters)
+        assert [i['slug'] for i in res.items] == slugs
+        assert res.total == len(slugs)
+
+    def test_get_with_fk_filters(self, dbsession):
+        entities = self.get_default_entities(dbsession)
+        jack, jane = entities['Jack'], entities['Jane']
+        schema = jack.schema
+
+        for filters, slugs in [
+            ({'friends': jack.id},             ['Jane']),
+            ({'friends.eq': jack.id},          ['Jane']),
+            ({'friends.ne': jack.id},          []),
+            ({'friends.in': [jack.id, 0]},     ['Jane']),
+            ({'friends.nin': [jane.id]},       ['Jane']),
+            ({'friends.nin': [jack.id]},       []),
+            ({'friends.isnull': True},         ['Jack']),
+            ({'friends.eq': jack.id, 'friends.age.eq': 10}, ['Jane']),
+            ({'friends.eq': jack.id, 'friends.age.eq': 12}, []),
+        ]:
+            res = get_entities(dbsession, schema=schema, filters=filters)
+            assert [i['slug'] for i in res.items] == slugs, filters
+
+    def test_get_with_entity_field_filters(self, dbsession):
+        entities = self.get_default_entities(dbsession)
+        jack, jane = entities['Jack'], entities['Jane']
+        jane.name = 'Janet'
+        dbsession.flush()
+        schema = jack.schema
+
+        res = get_entities(dbsession, schema=schema, filters={'slug': 'Jane'})
+        assert [i['name'] for i in res.items] == ['Janet']
+        res = get_entities(dbsession, schema=schema, filters={'id.in': [jack.id, jane.id]})
+        assert [i['id'] for i in res.items] == [jack.id, jane.id]
+        res = get_entities(dbsession, schema=schema, filters={'id.ne': jack.id})
+        assert [i['id'] for i in res.items] == [jane.id]
+
+    @pytest.mark.parametrize('filters', [{'name.isnull': True}, {'id.contains': 1}])
+    def test_raise_on_invalid_entity_field_filter(self, dbsession, filters):
+        schema = self.get_default_schema(dbsession)
+        with pytest.raises(InvalidFilterOperatorException):
+            get_entities(dbsession, schema=schema, filters=filters)
+
+    @pytest.mark.parametrize(['filters', 'slugs'], [
+        ({'friends.age': 10},                    ['Jane']),
+        ({'friends.age.gt': 10},                 []),
+        ({'friends.name': 'Jack'},               ['Jane']),
+        ({'friends.nickname.contains': 'ac'},    ['Jane']),
+        ({'friends.age': 10, 'age.gt': 10},      ['Jane']),
+        ({'friends.age': 10, 'friends.nickname': 'jack'}, ['Jane']),
+        ({'friends.age': 10, 'friends.nickname': 'jane'}, []),
+        ({'friends.friends.age': 10},            []),
+    ])
+    def test_get_with_join_filter(self, dbsession, filters, slugs):
+        schema = self.get_default_schema(dbsession)
+        res = get_entities(dbsession, schema=schema, filters=filters)
+        assert [i['slug'] for i in res.items] == slugs
+        assert res.total == len(slugs)
+
+    def test_parse_join_filters_by_referenced_names(self):
+        filters = {'friends.eq': 1, 'friends.age.eq': 10, 'friends.name': 'Jack'}
+        attr_filters, entity_filters, join_filters = crud._parse_filters(
+            filters, attrs={'friends': [FilterEnum.EQ], 'age': [FilterEnum.EQ]},
+            fk_attrs={'friends': {'name', 'age'}}
+        )
+        assert attr_filters == {'friends': {FilterEnum.EQ: 1}}
+        assert entity_filters == {}
+        assert join_filters == {'friends': {'age.eq': 10, 'name': 'Jack'}}
+
+    def test_get_with_join_filter__skip_deleted_referenced(self, dbsession):
+        entity = self.get_default_entity(dbsession)
+        entity.deleted = True
+        dbsession.flush()
+        res = get_entities(dbsession, schema=entity.schema, filters={'friends.age': 10})
+        assert res.items == []
+
+    def test_raise_on_too_deep_join_filter(self, dbsession):
+        schema = self.get_default_schema(dbsession)
+        filters = {'friends.friends.friends.age': 10}
+        with pytest.raises(InvalidFilterAttributeException):
+            get_entities(dbsession, schema=schema, filters=filters)
+
     def test_get_with_multiple_filters_for_same_attr(self, dbsession):
         schema = self.get_default_schema(dbsession)
 
@@ -446,6 +583,31 @@ class TestEntityRead(DefaultMixin):
         assert len(ents) == ent_len
         assert [i['slug'] for i in ents] == slugs
 
+    def test_listing_statements_are_reused(self, dbsession, mocker):
+        schema = self.get_default_schema(dbsession)
+        build = mocker.spy(crud, '_listing_statements')
+        for age, slugs in ((9, ['Jack', 'Jane']), (10, ['Jane']), (12, [])):
+            res = get_entities(dbsession, schema=schema, filters={'age.gt': age},
+                               params=Params(size=1, page=2))
+            assert [i['slug'] for i in res.items] == slugs[1:]
+            assert res.total == len(slugs)
+            filters = {'age.gt': age, 'nickname.in': ['jack', 'jane'], 'friends.age.lt': 20}
+            res = get_entities(dbsession, schema=schema, filters=filters)
+            assert [i['slug'] for i in res.items] == [i for i in slugs if i == 'Jane']
+        assert build.call_count == 2
+
+        # different shape
+        get_entities(dbsession, schema=schema, filters={'age.isnull': True})
+        get_entities(dbsession, schema=schema, filters={'age.isnull': False})
+        assert build.call_count == 4
+
+        # changed schema
+        schema.reviewable = not schema.reviewable
+        dbsession.flush()
+        res = get_entities(dbsession, schema=schema, filters={'age.gt': 10})
+        assert [i['slug'] for i in res.items] == ['Jane']
+        assert build.call_count == 5
+
     def test_raise_on_invalid_filters(self, dbsession):
         schema = self.get_default_schema(dbsession)
 
@@ -457,10 +619,145 @@ class TestEntityRead(DefaultMixin):
         with pytest.raises(InvalidFilterOperatorException):
             get_entities(dbsession, schema=schema, filters=filters).items
 
-        filters = {'age.gt': 0, 'friends.lt': 20}  # we can't filter friends because it's a listed type
-        with pytest.raises(InvalidFilterAttributeException):
+        filters = {'age.gt': 0, 'friends.lt': 20}  # FK attributes can't be compared
+        with pytest.raises(InvalidFilterOperatorException):
             get_entities(dbsession, schema=schema, filters=filters).items
 
+    def test_get_referencing_entities(self, dbsession):
+        entities = self.get_default_entities(dbsession)
+        jack, jane = entities['Jack'], entities['Jane']
+
+        res = get_referencing_entities(dbsession, entity_id=jack.id)
+        assert res.total == 1
+        assert res.items == [{'id': jane.id, 'slug': 'Jane', 'name': 'Jane', 'deleted': False,
+                              'schema': 'person', 'attribute': 'friends'}]
+
+        assert get_referencing_entities(dbsession, entity_id=jack.id, attr_name='friends').total == 1
+        assert get_referencing_entities(dbsession, entity_id=jack.id, attr_name='address').total == 0
+        assert get_referencing_entities(dbsession, entity_id=jane.id).total == 0
+
+        unperson = dbsession.query(Schema).filter(Schema.slug == 'unperson').one()
+        assert get_referencing_entities(dbsession, entity_id=jack.id, schema=unperson).total == 0
+        assert get_referencing_entities(dbsession, entity_id=jack.id, schema=jane.schema).total == 1
+
+        jane.deleted = True
+        dbsession.flush()
+        assert get_referencing_entities(dbsession, entity_id=jack.id).total == 0
+        assert get_referencing_entities(dbsession, entity_id=jack.id, all=True).total == 1
+
+    def test_get_referencing_entities__raise_on_entity_doesnt_exist(self, dbsession):
+        with pytest.raises(MissingEntityException):
+            get_referencing_entities(dbsession, entity_id=9999999)
+
+    def test_traverse_entities(self, dbsession):
+        entities = self.get_default_entities(dbsession)
+        jack, jane = entities['Jack'], entities['Jane']
+
+        res = traverse_entities(dbsession, entity_id=jane.id)
+        assert [(i['id'], i['depth'], i['schema']) for i in res['nodes']] == \
+               [(jane.id, 0, 'person'), (jack.id, 1, 'person')]
+        assert res['edges'] == [{'source': jane.id, 'target': jack.id, 'attribute': 'friends'}]
+        assert not res['truncated']
+
+        res = traverse_entities(dbsession, entity_id=jack.id)
+        assert [i['id'] for i in res['nodes']] == [jack.id]
+        res = traverse_entities(dbsession, entity_id=jack.id, direction=TraversalDirection.BACKWARD)
+        assert [i['id'] for i in res['nodes']] == [jack.id, jane.id]
+        res = traverse_entities(dbsession, entity_id=jane.id, attr_names=['nickname'])
+        assert [i['id'] for i in res['nodes']] == [jane.id]
+
+        res = traverse_entities(dbsession, entity_id=jane.id, limit=1)
+        assert [i['id'] for i in res['nodes']] == [jane.id]
+        assert res['truncated']
+
+    def test_traverse_entities__cycle(self, dbsession):
+        entities = self.get_default_entities(dbsession)
+        jack, jane = entities['Jack'], entities['Jane']
+        friends = dbsession.query(Attribute).filter(Attribute.name == 'friends').one()
+        dbsession.add(ValueForeignKey(entity_id=jack.id, attribute_id=friends.id, value=jane.id))
+        dbsession.flush()
+
+        for direction in TraversalDirection:
+            res = traverse_entities(dbsession, entity_id=jane.id, direction=direction, max_depth=5)
+            assert [(i['id'], i['depth']) for i in res['nodes']] == [(jane.id, 0), (jack.id, 1)]
+            assert len(res['edges']) == 2
+            assert not res['truncated']
+
+    def test_traverse_entities__parallel_paths(self, dbsession):
+        entities = self.get_default_entities(dbsession)
+        jack, jane = entities['Jack'], entities['Jane']
+        friends = dbsession.query(Attribute).filter(Attribute.name == 'friends').one()
+        john = Entity(slug='John', name='John', schema_id=jack.schema_id)
+        dbsession.add(john)
+        dbsession.flush()
+        # Jane -> Jack by 9 values, Jack -> John
+        dbsession.add_all([ValueForeignKey(entity_id=jane.id, attribute_id=friends.id, value=jack.id)
+                           for _ in range(8)])
+        dbsession.add(ValueForeignKey(entity_id=jack.id, attribute_id=friends.id, value=john.id))
+        dbsession.flush()
+
+        res = traverse_entities(dbsession, entity_id=jane.id, max_depth=2, limit=2)
+        assert [(i['id'], i['depth']) for i in res['nodes']] == [(jane.id, 0), (jack.id, 1)]
+        assert res['truncated']
+
+        res = traverse_entities(dbsession, entity_id=jane.id, max_depth=2, limit=3)
+        assert [(i['id'], i['depth']) for i in res['nodes']] == \
+               [(jane.id, 0), (jack.id, 1), (john.id, 2)]
+        assert not res['truncated']
+
+    def test_traverse_entities__raise_on_entity_doesnt_exist(self, dbsession):
+        with pytest.raises(MissingEntityException):
+            traverse_entities(dbsession, entity_id=9999999)
+
+    def test_aggregate_entities(self, dbsession):
+        entities = self.get_default_entities(dbsession)
+        schema = entities['Jack'].schema
+
+        assert aggregate_entities(dbsession, schema=schema) == [{'group': {}, 'metrics': {'count': 2}}]
+
+        res = aggregate_entities(dbsession, schema=schema, group_by=['age'],
+                                 metrics=['count', 'sum.age'])
+        assert res == [{'group': {'age': 10}, 'metrics': {'count': 1, 'sum.age': 10}},
+                       {'group': {'age': 12}, 'metrics': {'count': 1, 'sum.age': 12}}]
+
+        res = aggregate_entities(dbsession, schema=schema, group_by=['fav_color'],
+                                 metrics=['count', 'avg.age', 'min.age', 'max.age'])
+        assert res == [
+            {'group': {'fav_color': 'black'}, 'metrics': {'count': 1, 'avg.age': 12.0, 'min.age': 12, 'max.age': 12}},
+            {'group': {'fav_color': 'blue'}, 'metrics': {'count': 1, 'avg.age': 10.0, 'min.age': 10, 'max.age': 10}},
+            {'group': {'fav_color': 'red'}, 'metrics': {'count': 2, 'avg.age': 11.0, 'min.age': 10, 'max.age': 12}},
+        ]
+
+        res = aggregate_entities(dbsession, schema=schema, group_by=['friends', 'nickname'])
+        assert res == [{'group': {'friends': entities['Jack'].id, 'nickname': 'jane'}, 'metrics': {'count': 1}},
+                       {'group': {'friends': None, 'nickname': 'jack'}, 'metrics': {'count': 1}}]
+
+    def test_aggregate_entities_with_filters(self, dbsession):
+        entity = self.get_default_entity(dbsession)
+        res = aggregate_entities(dbsession, schema=entity.schema, metrics=['count', 'sum.age'],
+                                 filters={'fav_color': 'red'})
+        assert res == [{'group': {}, 'metrics': {'count': 2, 'sum.age': 22}}]
+
+        entity.deleted = True
+        dbsession.flush()
+        res = aggregate_entities(dbsession, schema=entity.schema, metrics=['count', 'sum.age'])
+        assert res == [{'group': {}, 'metrics': {'count': 1, 'sum.age': 12}}]
+        res = aggregate_entities(dbsession, schema=entity.schema, metrics=['count', 'sum.age'],
+                                 filters={'fav_color': 'red'}, deleted_only=True)
+        assert res == [{'group': {}, 'metrics': {'count': 1, 'sum.age': 10}}]
+
+    @pytest.mark.parametrize(['group_by', 'metrics'], [
+        (['born'], ['count']),
+        (['address'], ['count']),
+        ([], ['sum.nickname']),
+        ([], ['median.age']),
+        ([], ['sum']),
+    ])
+    def test_raise_on_invalid_aggregation(self, dbsession, group_by, metrics):
+        schema = self.get_default_schema(dbsession)
+        with pytest.raises(InvalidAggregationException):
+            aggregate_entities(dbsession, schema=schema, group_by=group_by, metrics=metrics)
+
 
 class TestEntityUpdate(DefaultMixin):
     def _default_friends(self, db: Session) -> typing.List[int]:
@@ -492,6 +789,73 @@ class TestEntityUpdate(DefaultMixin):
         ).scalars().all()
         assert len(nicknames) == 1, "nickname for entity 2 wasn't deleted from database"
 
+    def test_write_paths_bump_version(self, dbsession):
+        entity = self.get_default_entity(dbsession)
+        schema_id = entity.schema_id
+        versions = [entity.version]
+
+        update_entity(dbsession, id_or_slug=entity.id, schema_id=schema_id, data={'age': 11})
+        dbsession.refresh(entity)
+        versions.append(entity.version)
+        delete_entity(dbsession, id_or_slug=entity.id, schema_id=schema_id)
+        dbsession.refresh(entity)
+        versions.append(entity.version)
+        restore_entity(dbsession, id_or_slug=entity.id, schema_id=schema_id)
+        dbsession.refresh(entity)
+        versions.append(entity.version)
+        assert versions == sorted(set(versions))
+
+        new = create_entity(dbsession, schema_id=schema_id,
+                            data={'slug': 'John', 'name': 'John', 'age': 20})
+        assert new.version > versions[-1]
+
+    def test_get_entity_changes(self, dbsession):
+        entities = self.get_default_entities(dbsession)
+        jack, jane = entities['Jack'], entities['Jane']
+        schema = jack.schema
+        res = get_entity_changes(dbsession, schema=schema)
+        assert [i['name'] for i in res['changes']] == ['Jack', 'Jane']
+        assert res['last_version'] == jane.version and not res['has_more']
+
+        since = res['last_version']
+        update_entity(dbsession, id_or_slug=jack.id, schema_id=schema.id, data={'age': 11})
+        delete_entity(dbsession, id_or_slug=jane.id, schema_id=schema.id)
+        res = get_entity_changes(dbsession, schema=schema, since=since, limit=1, fields=['age'])
+        assert res['changes'] == [{'id': jack.id, 'slug': 'Jack', 'name': 'Jack', 'deleted': False,
+                                   'age': 11, 'version': jack.version}]
+        assert res['has_more']
+        res = get_entity_changes(dbsession, schema=schema, since=res['last_version'])
+        assert [(i['name'], i['deleted']) for i in res['changes']] == [('Jane', True)]
+        assert not res['has_more']
+
+        res = get_entity_changes(dbsession, schema=schema, since=res['last_version'])
+        assert res == {'changes': [], 'last_version': jane.version, 'has_more': False}
+        with pytest.raises(AttributeNotDefinedException):
+            get_entity_changes(dbsession, schema=schema, fields=['foo'])
+
+    def test_get_entity_changes__transactions_commit_out_of_order(self, dbsession, engine):
+        schema = self.get_default_schema(dbsession)
+        since = get_entity_changes(dbsession, schema=schema)['last_version']
+        dbsession.commit()
+
+        other_engine = create_engine(engine.url)
+        Session = sessionmaker(autocommit=False, autoflush=False, bind=other_engine)
+        try:
+            with Session() as slow, Session() as fast:
+                # slow transaction changes Jack first, but commits after Jane was returned
+                update_entity(slow, id_or_slug='Jack', schema_id=schema.id, data={'age': 11},
+                              commit=False)
+                update_entity(fast, id_or_slug='Jane', schema_id=schema.id, data={'age': 13})
+                res = get_entity_changes(dbsession, schema=schema, since=since)
+                assert [i['name'] for i in res['changes']] == ['Jane']
+                dbsession.commit()
+
+                slow.commit()
+                res = get_entity_changes(dbsession, schema=schema, since=res['last_version'])
+                assert [(i['name'], i['age']) for i in res['changes']] == [('Jack', 11)]
+        finally:
+            other_engine.dispose()
+
     def test_update(self, dbsession):
         time = datetime.now(timezone(timedelta(hours=-4)))
         data = {
@@ -4,12 +4,13 @@ from sqlalchemy import select
 from sqlalchemy.orm import Session
 
 from ..crud import create_schema, get_schema, get_schemas, update_schema, delete_schema, \
-    get_entities, update_entity, get_entity
+    get_entities, update_entity, get_entity, create_entity
 from ..exceptions import SchemaExistsException, MissingSchemaException, RequiredFieldException, \
     NoOpChangeException, ListedToUnlistedException, MultipleAttributeOccurencesException, \
     InvalidAttributeChange, SchemaIsDeletedException
 from ..models import Schema, AttributeDefinition, Attribute, AttrType, Entity
 from .. schemas import AttrDefSchema, SchemaCreateSchema, AttrTypeMapping, SchemaUpdateSchema
+from ..instrumentation import count_queries
 
 from .mixins import DefaultMixin
 
@@ -229,6 +230,31 @@ class TestSchemaRead:
 
         with pytest.raises(MissingSchemaException):
             get_schema(dbsession, id_or_slug='qwertyuiop')
+
+    def test_query_count_independent_of_attributes(self, dbsession):
+        def count(func, *args, **kwargs):
+            dbsession.expire_all()
+            with count_queries() as stats:
+                func(*args, **kwargs)
+            return stats.queries
+
+        counts = []
+        for size in (1, 10):
+            attrs = [AttrDefSchema(name=f'field{i}', type='STR', required=False, unique=False,
+                                   list=False, key=False) for i in range(size)]
+            schema_id = create_schema(dbsession, SchemaCreateSchema(name=f'Wide {size}',
+                                                                    slug=f'wide-{size}',
+                                                                    attributes=attrs)).id
+            counts.append((
+                count(lambda: [i.attribute.name
+                               for i in get_schema(dbsession, schema_id).attr_defs]),
+                count(create_entity, dbsession, schema_id=schema_id,
+                      data={'slug': 'wide', 'name': 'Wide', 'field0': 'value'}),
+                count(update_entity, dbsession, id_or_slug='wide', schema_id=schema_id,
+                      data={'field0': 'new value'}),
+            ))
+        assert counts[0] == counts[1]
+        assert counts[0][0] == 2
     
     def test_get_schemas(self, dbsession):
         # test default behavior: return not deleted schemas
@@ -262,6 +288,16 @@ class TestSchemaRead:
 
 
 class TestSchemaUpdate(DefaultMixin):
+    def test_update_bumps_version(self, dbsession):
+        schema = self.get_default_schema(dbsession)
+        version = schema.version
+        attrs = self.get_default_attr_def_schemas(dbsession)
+        attrs[0].description = 'Changed description'
+        update_schema(dbsession, id_or_slug='person',
+                      data=SchemaUpdateSchema(slug='person', attributes=attrs))
+        dbsession.refresh(schema)
+        assert schema.version > version
+
     def test_update(self, dbsession):
         attrs = {a.name: a for a in self.get_default_attr_def_schemas(dbsession)}
         age = attrs["age"]
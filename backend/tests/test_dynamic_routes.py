@@ -1,10 +1,18 @@
 from datetime import datetime, timezone, timedelta
 
 import pytest
+from fastapi.testclient import TestClient
 
 from ..models import *
 from ..dynamic_routes import *
-from .. import load_schemas
+from .. import create_app, load_schemas
+from ..database import get_db
+from ..auth import create_access_token
+from ..auth.crud import add_members, create_group, create_user, delete_members, \
+    grant_permission, revoke_permissions
+from ..auth.enum import PermissionTargetType, RecipientType
+from ..auth.models import Permission, User
+from ..schemas.auth import BaseGroupSchema, PermissionSchema, UserCreateSchema
 
 from .mixins import DefaultMixin
 
@@ -17,6 +25,7 @@ class TestRouteBasics:
     def test_routes_were_generated(self, dbsession, client):
         routes = [
             '/entity/person/{id_or_slug}',
+            '/entity/person/_aggregate',
             '/entity/person',
             '/entity/unperson/{id_or_slug}',
             '/entity/unperson',
@@ -28,6 +37,18 @@ class TestRouteBasics:
         ]
         assert all([i in [route.path for route in client.app.routes] for i in routes])
 
+    def test_json_response_class(self, dbsession, client, mocker):
+        json_content = client.get('/entity/person?all_fields=true').content
+        mocker.patch.object(settings, 'json_response', 'orjson')
+        app = create_app(session=dbsession)
+        app.dependency_overrides[get_db] = lambda: dbsession
+        response = TestClient(app).get('/entity/person?all_fields=true')
+        assert response.content == json_content
+
+        mocker.patch.object(settings, 'json_response', 'ujson')
+        with pytest.raises(ValueError):
+            create_app(session=dbsession)
+
 
 class TestRouteCreateEntity(DefaultMixin):
     def test_create_without_review(self, dbsession, authorized_client):
@@ -190,6 +211,16 @@ class TestRouteGetEntity(DefaultMixin):
         assert response.status_code == 200
         assert response.json() == data
 
+    def test_get_entity_with_fields(self, dbsession, client):
+        entity = self.get_default_entity(dbsession)
+        response = client.get(f'/entity/person/{entity.id}?fields=age, fav_color')
+        assert response.status_code == 200
+        assert response.json() == {'id': entity.id, 'slug': 'Jack', 'name': 'Jack', 'deleted': False,
+                                   'age': 10, 'fav_color': ['blue', 'red']}
+
+        response = client.get(f'/entity/person/{entity.id}?fields=age,qwe')
+        assert response.status_code == 422
+
     def test_raise_on_entity_doesnt_exist(self, dbsession, client):
         response = client.get('/entity/person/99999999')
         assert response.status_code == 404
@@ -216,6 +247,19 @@ class TestRouteGetEntities(DefaultMixin):
         assert response.status_code == 200
         assert [self.strip_ids(j) for j in response.json()['items']] == data
 
+    def test_get_entities_with_fields(self, dbsession, client):
+        response = client.get('/entity/person?fields=nickname,born&all_fields=true')
+        assert response.status_code == 200
+        assert [self.strip_ids(j) for j in response.json()['items']] == [
+            {'deleted': False, 'slug': 'Jack', 'name': 'Jack', 'nickname': 'jack', 'born': None},
+            {'deleted': False, 'slug': 'Jane', 'name': 'Jane', 'nickname': 'jane', 'born': None}
+        ]
+
+    @pytest.mark.parametrize('q', ['fields=qwe', 'order_by=qwe'])
+    def test_raise_on_undefined_attribute(self, dbsession, client, q):
+        response = client.get(f'/entity/person?{q}')
+        assert response.status_code == 422
+
     def test_get_deleted_only(self, dbsession, client):
         jane = self.get_default_entities(dbsession)["Jane"]
         jane.deleted = True
@@ -274,6 +318,24 @@ class TestRouteGetEntities(DefaultMixin):
         assert response.status_code == 200
         assert response.json()["items"] == data
 
+    @pytest.mark.parametrize('stream_min_items', [0, 1])
+    @pytest.mark.parametrize('q', ['', 'all_fields=True', 'fields=born,friends,age',
+                                   'order_by=born&ascending=false', 'size=1&page=2', 'page=10'])
+    def test_fast_serialization(self, dbsession, client, mocker, q, stream_min_items):
+        mocker.patch.object(settings, 'stream_min_items', stream_min_items)
+        jane = self.get_default_entities(dbsession)['Jane']
+        crud.update_entity(dbsession, id_or_slug=jane.id, schema_id=jane.schema_id,
+                           data={'born': datetime(1990, 6, 1, 12, 30, 15, 500, timezone.utc)})
+        fast = client.get('/entity/person?' + q)
+        mocker.patch.object(settings, 'fast_serialization', False)
+        validated = client.get('/entity/person?' + q)
+        assert fast.status_code == validated.status_code == 200
+        assert fast.content == validated.content
+        # streamed responses have no length
+        ignored = {'server-timing'} if not stream_min_items else {'server-timing', 'content-length'}
+        headers = lambda r: {k: v for k, v in r.headers.items() if k not in ignored}
+        assert headers(fast) == headers(validated)
+
     @pytest.mark.parametrize(['q', 'slugs'], [
         ('size=1',        {'Jack'}),
         ('size=1&page=2', {'Jane'}),
@@ -299,8 +361,23 @@ class TestRouteGetEntities(DefaultMixin):
         ('nickname.ne=jack',     {'Jane'}),
         ('nickname.regexp=^ja',  {'Jack', 'Jane'}),
         ('nickname.contains=ne', {'Jane'}),
+        ('fav_color=black',      {'Jane'}),
         ('fav_color.eq=black',   {'Jane'}),
-        ('fav_color.ne=black',   {'Jack', 'Jane'})  # still returns both even though Jane has black fav_color, but also has red
+        ('fav_color.ne=black',   {'Jack', 'Jane'}),  # still returns both even though Jane has black fav_color, but also has red
+        ('friends.age=10',                {'Jane'}),
+        ('friends.age.lt=12',             {'Jane'}),
+        ('friends.name.starts=ja',        {'Jane'}),
+        ('friends.fav_color.eq=red',      {'Jane'}),
+        ('friends.friends.age=10',        set()),
+        ('age.in=10&age.in=12',           {'Jack', 'Jane'}),
+        ('age.nin=10',                    {'Jane'}),
+        ('slug.in=Jack&slug.in=John',     {'Jack'}),
+        ('born.isnull=true',              {'Jack', 'Jane'}),
+        ('nickname.isnull=false',         {'Jack', 'Jane'}),
+        ('friends.slug.in=Jack',          {'Jane'}),
+        ('fav_color.nin=black',           {'Jack'}),
+        ('friends.isnull=true',           {'Jack'}),
+        ('friends.isnull=false&friends.age=10', {'Jane'}),
     ])
     def test_get_with_filter(self, dbsession, client, q, slugs):
         items = client.get(f'/entity/person?{q}').json()["items"]
@@ -353,9 +430,12 @@ class TestRouteGetEntities(DefaultMixin):
             response = client.get('/entity/person?' + query)
             assert {i["slug"] for i in response.json()['items']} == {'Jack', 'Jane'}
 
-    def test_ignore_filters_for_fk(self, dbsession, client):
-        response = client.get('/entity/person?friends=1')
-        assert {i["slug"] for i in response.json()['items']} == {'Jack', 'Jane'}
+    def test_get_with_fk_filter(self, dbsession, client):
+        jack = self.get_default_entity(dbsession)
+        response = client.get(f'/entity/person?friends={jack.id}')
+        assert {i["slug"] for i in response.json()['items']} == {'Jane'}
+        response = client.get(f'/entity/person?friends.nin={jack.id}')
+        assert response.json()['items'] == []
 
     @pytest.mark.parametrize(['q', 'slugs'], [
         ('name=Jack', {'Jack'}),
@@ -380,6 +460,245 @@ class TestRouteGetEntities(DefaultMixin):
         assert {i["slug"] for i in response.json()['items']} == slugs
 
 
+class TestRouteGetReadableEntities(DefaultMixin):
+    @pytest.fixture
+    def reader(self, dbsession, mocker):
+        mocker.patch.object(settings, 'enforce_read_permissions', True)
+        user = create_user(dbsession, UserCreateSchema(username='reader', password='secret',
+                                                       email='reader@example.org'))
+        token, _ = create_access_token({'sub': user.username}, timedelta(minutes=5))
+        return {'Authorization': f'Bearer {token}'}
+
+    @staticmethod
+    def _grant(dbsession, obj_type: PermissionTargetType, obj_id: int):
+        grant_permission(PermissionSchema(recipient_type=RecipientType.USER,
+                                          recipient_name='reader', obj_type=obj_type,
+                                          obj_id=obj_id, permission=PermissionType.READ_ENTITY),
+                         dbsession)
+
+    def test_requires_authentication(self, dbsession, client, reader):
+        assert client.get('/entity/person').status_code == 401
+
+    def test_superuser_reads_all(self, dbsession, client, reader):
+        token, _ = create_access_token({'sub': 'tester'}, timedelta(minutes=5))
+        response = client.get('/entity/person', headers={'Authorization': f'Bearer {token}'})
+        assert {i['slug'] for i in response.json()['items']} == {'Jack', 'Jane'}
+
+    def test_list_readable(self, dbsession, client, reader):
+        entities = self.get_default_entities(dbsession)
+        response = client.get('/entity/person', headers=reader)
+        assert response.json()['items'] == [] and response.json()['total'] == 0
+
+        self._grant(dbsession, PermissionTargetType.ENTITY, entities['Jane'].id)
+        # other permissions don't allow reading
+        grant_permission(PermissionSchema(recipient_type=RecipientType.USER,
+                                          recipient_name='reader',
+                                          obj_type=PermissionTargetType.ENTITY,
+                                          obj_id=entities['Jack'].id,
+                                          permission=PermissionType.UPDATE_ENTITY), dbsession)
+        response = client.get('/entity/person?size=1', headers=reader)
+        assert [i['slug'] for i in response.json()['items']] == ['Jane']
+        assert response.json()['total'] == 1
+        for q, slugs in [('age.gt=9', {'Jane'}), ('age.lt=12', set()),
+                         ('friends.age=10', {'Jane'})]:
+            response = client.get(f'/entity/person?{q}', headers=reader)
+            assert {i['slug'] for i in response.json()['items']} == slugs
+            assert response.json()['total'] == len(slugs)
+
+        self._grant(dbsession, PermissionTargetType.SCHEMA, entities['Jack'].schema_id)
+        response = client.get('/entity/person?age.lt=12', headers=reader)
+        assert {i['slug'] for i in response.json()['items']} == {'Jack'}
+
+    def test_get_readable(self, dbsession, client, reader):
+        jack = self.get_default_entity(dbsession)
+        assert client.get(f'/entity/person/{jack.id}', headers=reader).status_code == 404
+        self._grant(dbsession, PermissionTargetType.ENTITY, jack.id)
+        response = client.get(f'/entity/person/{jack.id}', headers=reader)
+        assert response.status_code == 200 and response.json()['slug'] == 'Jack'
+
+    def test_aggregate_readable(self, dbsession, client, reader):
+        jack = self.get_default_entity(dbsession)
+        assert client.get('/entity/person/_aggregate').status_code == 401
+        response = client.get('/entity/person/_aggregate', headers=reader)
+        assert response.json() == [{'group': {}, 'metrics': {'count': 0}}]
+
+        self._grant(dbsession, PermissionTargetType.ENTITY, jack.id)
+        for q in ('', '?age.lt=20'):
+            response = client.get(f'/entity/person/_aggregate{q}', headers=reader)
+            assert response.json() == [{'group': {}, 'metrics': {'count': 1}}]
+
+    def test_changes_readable(self, dbsession, client, reader):
+        jack = self.get_default_entity(dbsession)
+        assert client.get('/entity/person/_changes').status_code == 401
+        response = client.get('/entity/person/_changes', headers=reader)
+        assert response.json()['changes'] == []
+
+        self._grant(dbsession, PermissionTargetType.ENTITY, jack.id)
+        response = client.get('/entity/person/_changes', headers=reader)
+        assert [i['slug'] for i in response.json()['changes']] == ['Jack']
+
+    def test_etag_changes_with_permissions(self, dbsession, client, reader):
+        jack = self.get_default_entities(dbsession)['Jack']
+        response = client.get('/entity/person', headers=reader)
+        etag = response.headers['etag']
+        response = client.get('/entity/person', headers={**reader, 'If-None-Match': etag})
+        assert response.status_code == 304
+
+        self._grant(dbsession, PermissionTargetType.ENTITY, jack.id)
+        response = client.get('/entity/person', headers={**reader, 'If-None-Match': etag})
+        assert response.status_code == 200
+        assert [i['slug'] for i in response.json()['items']] == ['Jack']
+
+        revoke_permissions([i.id for i in dbsession.query(Permission)
+                            .filter(Permission.permission == PermissionType.READ_ENTITY)],
+                           dbsession)
+        response = client.get('/entity/person', headers={**reader, 'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.json()['items'] == []
+
+    def test_etag_changes_with_swapped_groups(self, dbsession, client, reader):
+        entities = self.get_default_entities(dbsession)
+        schema_id = entities['Jack'].schema_id
+        for slug in ('Mike', 'John'):
+            dbsession.add(Entity(slug=slug, name=slug, schema_id=schema_id))
+        dbsession.flush()
+        entities = self.get_default_entities(dbsession)
+        groups = {name: create_group(BaseGroupSchema(name=name), dbsession)
+                  for name in ('first', 'second')}
+        # ids of permissions of both groups have equal count and sum
+        for name, slug in (('first', 'Jack'), ('second', 'Jane'), ('second', 'John'),
+                           ('first', 'Mike')):
+            grant_permission(PermissionSchema(recipient_type=RecipientType.GROUP,
+                                              recipient_name=name,
+                                              obj_type=PermissionTargetType.ENTITY,
+                                              obj_id=entities[slug].id,
+                                              permission=PermissionType.READ_ENTITY),
+                             dbsession)
+        user = dbsession.query(User).filter(User.username == 'reader').one()
+        add_members(groups['first'].id, [user.id], dbsession)
+        response = client.get('/entity/person', headers=reader)
+        assert [i['slug'] for i in response.json()['items']] == ['Jack', 'Mike']
+        etag = response.headers['etag']
+
+        delete_members(groups['first'].id, [user.id], dbsession)
+        add_members(groups['second'].id, [user.id], dbsession)
+        response = client.get('/entity/person', headers={**reader, 'If-None-Match': etag})
+        assert response.status_code == 200
+        assert [i['slug'] for i in response.json()['items']] == ['Jane', 'John']
+
+
+class TestRouteAggregateEntities(DefaultMixin):
+    def test_aggregate(self, dbsession, client):
+        response = client.get('/entity/person/_aggregate?group_by=fav_color&metric=count&metric=max.age&age.lt=12')
+        assert response.status_code == 200
+        assert response.json() == [
+            {'group': {'fav_color': 'blue'}, 'metrics': {'count': 1, 'max.age': 10}},
+            {'group': {'fav_color': 'red'}, 'metrics': {'count': 1, 'max.age': 10}}
+        ]
+
+        response = client.get('/entity/person/_aggregate')
+        assert response.json() == [{'group': {}, 'metrics': {'count': 2}}]
+
+    def test_entity_slug_doesnt_collide(self, dbsession, client):
+        schema = self.get_default_schema(dbsession)
+        crud.create_entity(dbsession, schema_id=schema.id,
+                           data={'slug': 'aggregate', 'name': 'Aggregate', 'nickname': 'agg',
+                                 'age': 1})
+        crud.create_entity(dbsession, schema_id=schema.id,
+                           data={'slug': 'changes', 'name': 'Changes', 'nickname': 'chg',
+                                 'age': 1})
+        for slug in ('aggregate', 'changes'):
+            response = client.get(f'/entity/person/{slug}')
+            assert response.status_code == 200
+            assert response.json()['slug'] == slug
+
+    @pytest.mark.parametrize('q', ['group_by=born', 'metric=sum.nickname', 'metric=avg'])
+    def test_raise_on_invalid_aggregation(self, dbsession, client, q):
+        response = client.get(f'/entity/person/_aggregate?{q}')
+        assert response.status_code == 422
+
+
+class TestRouteGetEntityChanges(DefaultMixin):
+    def test_get_changes(self, dbsession, client):
+        entity = self.get_default_entity(dbsession)
+        response = client.get('/entity/person/_changes?fields=age')
+        assert response.status_code == 200
+        data = response.json()
+        assert [(i['name'], i['age']) for i in data['changes']] == [('Jack', 10), ('Jane', 12)]
+        assert 'born' not in data['changes'][0]
+
+        crud.update_entity(dbsession, id_or_slug=entity.id, schema_id=entity.schema_id,
+                           data={'age': 11})
+        response = client.get(f'/entity/person/_changes?since={data["last_version"]}')
+        data = response.json()
+        assert [(i['name'], i['age']) for i in data['changes']] == [('Jack', 11)]
+        assert data['changes'][0]['version'] == data['last_version']
+        assert not data['has_more']
+
+    @pytest.mark.parametrize('stream_min_items', [0, 1, 2])
+    @pytest.mark.parametrize('q', ['', 'fields=born', 'limit=1'])
+    def test_fast_serialization(self, dbsession, client, mocker, q, stream_min_items):
+        mocker.patch.object(settings, 'stream_min_items', stream_min_items)
+        entity = self.get_default_entity(dbsession)
+        crud.update_entity(dbsession, id_or_slug=entity.id, schema_id=entity.schema_id,
+                           data={'born': datetime(1990, 6, 1, tzinfo=timezone.utc)})
+        fast = client.get('/entity/person/_changes?' + q)
+        mocker.patch.object(settings, 'fast_serialization', False)
+        validated = client.get('/entity/person/_changes?' + q)
+        assert fast.status_code == validated.status_code == 200
+        assert fast.content == validated.content
+
+    @pytest.mark.parametrize('q', ['since=-1', 'limit=0', 'fields=foo'])
+    def test_raise_on_invalid_params(self, dbsession, client, q):
+        response = client.get(f'/entity/person/_changes?{q}')
+        assert response.status_code == 422
+
+
+class TestRouteConditionalGet(DefaultMixin):
+    def test_get_entity(self, dbsession, client):
+        entity = self.get_default_entity(dbsession)
+        url = f'/entity/person/{entity.id}'
+        response = client.get(url)
+        etag = response.headers['etag']
+        assert response.headers['last-modified']
+
+        response = client.get(url, headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.headers['etag'] == etag and not response.content
+        response = client.get(url, headers={'If-None-Match': f'"other", W/{etag}'})
+        assert response.status_code == 304
+        response = client.get(url, headers={'If-Modified-Since': response.headers['last-modified']})
+        assert response.status_code == 304
+        response = client.get(url + '?fields=age', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+
+        crud.update_entity(dbsession, id_or_slug=entity.id, schema_id=entity.schema_id,
+                           data={'age': 11})
+        response = client.get(url, headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.json()['age'] == 11
+        assert response.headers['etag'] != etag
+
+    def test_get_entities(self, dbsession, client):
+        entities = self.get_default_entities(dbsession)
+        jack, jane = entities['Jack'], entities['Jane']
+        response = client.get('/entity/person?friends.age=10')
+        etag = response.headers['etag']
+        response = client.get('/entity/person?friends.age=10', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        response = client.get('/entity/person?friends.age=11', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+
+        crud.delete_entity(dbsession, id_or_slug=jack.id, schema_id=jack.schema_id)
+        response = client.get('/entity/person?friends.age=10', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.json()['items'] == []
+
+        etag = client.get('/entity/unperson').headers['etag']
+        response = client.get('/entity/unperson', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+
+
 class TestRouteUpdateEntity(DefaultMixin):
     def test_update(self, dbsession, authorized_client):
         entity = self.get_default_entity(dbsession)
@@ -0,0 +1,145 @@
+import asyncio
+
+import psycopg2
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import text
+
+from .. import config, crud
+from ..auth.crud import create_user, grant_permission, readable_entity_check
+from ..auth.enum import PermissionTargetType, PermissionType, RecipientType
+from ..enum import EventType
+from ..events import EventBroker, stream_events
+from ..schemas import ChangeReviewSchema
+from ..schemas.auth import PermissionSchema, UserCreateSchema
+from ..traceability.crud import review_changes
+from ..traceability.entity import create_entity_update_request
+from ..traceability.enum import ReviewResult
+
+from .mixins import DefaultMixin
+
+
+def collect_events(func, count: int, types=None, readable=None) -> list:
+    '''Calls `func` while listening and returns `count` events streamed afterwards'''
+    async def collect():
+        broker = EventBroker()
+        stream = stream_events(types=types, broker=broker, readable=readable)
+        assert await stream.__anext__() == ': connected\n\n'
+        await run_in_threadpool(func)
+        events = [await asyncio.wait_for(stream.__anext__(), timeout=5) for _ in range(count)]
+        await stream.aclose()
+        assert broker._conn is None
+        return events
+
+    return asyncio.run(collect())
+
+
+class TestEvents(DefaultMixin):
+    def test_entity_events(self, dbsession):
+        entity = self.get_default_entity(dbsession)
+
+        def change():
+            crud.update_entity(dbsession, id_or_slug=entity.id, schema_id=entity.schema_id,
+                               data={'age': 11})
+            crud.delete_entity(dbsession, id_or_slug=entity.id, schema_id=entity.schema_id)
+
+        events = collect_events(change, 2)
+        assert events == [
+            'event: entity\ndata: {"type": "entity", "action": "update", '
+            f'"id": {entity.id}, "schema_id": {entity.schema_id}}}\n\n',
+            'event: entity\ndata: {"type": "entity", "action": "delete", '
+            f'"id": {entity.id}, "schema_id": {entity.schema_id}}}\n\n',
+        ]
+
+    def test_change_request_events(self, dbsession, testuser):
+        entity = self.get_default_entity(dbsession)
+        change_requests = []
+
+        def change():
+            # entity update itself is only validated and rolled back, so no entity event
+            change_request = create_entity_update_request(
+                dbsession, id_or_slug=entity.id, schema_id=entity.schema_id,
+                data={'age': 11}, created_by=testuser
+            )
+            change_requests.append(change_request.id)
+            review_changes(dbsession, change_request_id=change_request.id,
+                           review=ChangeReviewSchema(result=ReviewResult.DECLINE),
+                           reviewed_by=testuser)
+
+        events = collect_events(change, 2, types=[EventType.CHANGE_REQUEST])
+        assert '"action": "create"' in events[0]
+        assert f'"id": {change_requests[0]}' in events[0]
+        assert '"action": "review"' in events[1] and '"status": "DECLINED"' in events[1]
+
+    def test_rollback_discards_events(self, dbsession):
+        entity = self.get_default_entity(dbsession)
+        schema = self.get_default_schema(dbsession)
+
+        def change():
+            crud.update_entity(dbsession, id_or_slug=entity.id, schema_id=entity.schema_id,
+                               data={'age': 11}, commit=False)
+            dbsession.rollback()
+            crud.delete_schema(dbsession, id_or_slug=schema.id)
+
+        events = collect_events(change, 1)
+        assert events[0].startswith('event: schema\n')
+
+    def test_skip_unreadable_entity_events(self, dbsession):
+        entities = self.get_default_entities(dbsession)
+        jack, jane = entities['Jack'], entities['Jane']
+        user = create_user(dbsession, UserCreateSchema(username='reader', password='secret',
+                                                       email='reader@example.org'))
+        grant_permission(PermissionSchema(recipient_type=RecipientType.USER,
+                                          recipient_name='reader',
+                                          obj_type=PermissionTargetType.ENTITY, obj_id=jack.id,
+                                          permission=PermissionType.READ_ENTITY), dbsession)
+
+        def change():
+            for entity in (jane, jack):
+                crud.update_entity(dbsession, id_or_slug=entity.id, schema_id=entity.schema_id,
+                                   data={'age': 11})
+
+        events = collect_events(change, 1, readable=readable_entity_check(dbsession, user))
+        assert f'"id": {jack.id}' in events[0]
+
+    def test_requires_authentication(self, client, mocker):
+        mocker.patch.object(config.settings, 'enforce_read_permissions', True)
+        assert client.get('/events').status_code == 401
+
+    def test_reconnect_after_connection_loss(self, dbsession, mocker):
+        mocker.patch.object(config.settings, 'events_reconnect_delay', 0.1)
+        entity = self.get_default_entity(dbsession)
+
+        def terminate(pid: int):
+            dbsession.execute(text('select pg_terminate_backend(:pid)'), {'pid': pid})
+
+        def change():
+            crud.update_entity(dbsession, id_or_slug=entity.id, schema_id=entity.schema_id,
+                               data={'age': 11})
+
+        async def collect():
+            broker = EventBroker()
+            stream = stream_events(types=[EventType.ENTITY], broker=broker)
+            assert await stream.__anext__() == ': connected\n\n'
+            # first attempt to reconnect fails
+            connect = mocker.patch.object(
+                broker, '_connect',
+                side_effect=[psycopg2.OperationalError('database is starting up'),
+                             psycopg2.InterfaceError('connection already closed'),
+                             broker._connect()]
+            )
+            await run_in_threadpool(terminate, broker._conn.get_backend_pid())
+            events = [await asyncio.wait_for(stream.__anext__(), timeout=5)]
+            assert connect.call_count == 3
+            assert broker._reconnecting is None
+            await run_in_threadpool(change)
+            events.append(await asyncio.wait_for(stream.__anext__(), timeout=5))
+            await stream.aclose()
+            assert broker._conn is None
+            return events
+
+        events = asyncio.run(collect())
+        assert events[0] == 'event: resync\ndata: {"type": "resync"}\n\n'
+        assert events[1].startswith('event: entity\ndata: {"type": "entity", "action": "update"')
+
+    def test_invalid_event_type(self, client):
+        assert client.get('/events?type=foo').status_code == 422
@@ -1,4 +1,4 @@
-from datetime import timezone, datetime
+from datetime import timezone, datetime, timedelta
 
 from fastapi.testclient import TestClient
 from dateutil import parser
@@ -6,9 +6,15 @@ from sqlalchemy import update
 from sqlalchemy.orm import Session
 import pytest
 
+from .. import crud
+from ..auth import create_access_token
+from ..auth.crud import create_user, grant_permission
+from ..auth.enum import PermissionTargetType, PermissionType, RecipientType
 from ..auth.models import User
+from ..config import settings
 from ..models import Schema
 from ..schemas import SchemaCreateSchema, SchemaUpdateSchema
+from ..schemas.auth import PermissionSchema, UserCreateSchema
 from ..traceability.entity import create_entity_update_request, create_entity_create_request, \
     create_entity_delete_request
 from ..traceability.enum import ChangeStatus
@@ -741,6 +747,129 @@ class TestRouteGetSchemaChanges:
         assert response.status_code == 404
 
 
+class TestRouteConditionalGet(DefaultMixin):
+    @pytest.mark.parametrize('url', ['/info', '/attributes', '/schema/person'])
+    def test_not_modified(self, dbsession: Session, client: TestClient, url: str):
+        response = client.get(url)
+        assert response.status_code == 200
+        response = client.get(url, headers={'If-None-Match': response.headers['etag']})
+        assert response.status_code == 304
+
+    def test_schema_update_changes_etag(self, dbsession: Session, client: TestClient):
+        etags = {url: client.get(url).headers['etag'] for url in ('/attributes', '/schema/person')}
+        attrs = self.get_default_attr_def_schemas(dbsession)
+        attrs[0].description = 'Changed description'
+        crud.update_schema(dbsession, id_or_slug='person',
+                           data=SchemaUpdateSchema(slug='person', attributes=attrs))
+        for url, etag in etags.items():
+            response = client.get(url, headers={'If-None-Match': etag})
+            assert response.status_code == 200
+
+
+class TestRouteReferencedBy(DefaultMixin):
+    def test_get_referencing_entities(self, dbsession: Session, client: TestClient):
+        entities = self.get_default_entities(dbsession)
+        jack, jane = entities['Jack'], entities['Jane']
+
+        response = client.get(f'/entities/{jack.id}/referenced-by')
+        assert response.status_code == 200
+        data = response.json()
+        assert data['total'] == 1
+        assert data['items'] == [{'id': jane.id, 'slug': 'Jane', 'name': 'Jane', 'deleted': False,
+                                  'schema': 'person', 'attribute': 'friends'}]
+
+        response = client.get(f'/entities/{jack.id}/referenced-by?schema=unperson')
+        assert response.json()['total'] == 0
+        response = client.get(f'/entities/{jack.id}/referenced-by?schema=person&attribute=friends')
+        assert response.json()['total'] == 1
+
+    @pytest.mark.parametrize('url', ['/entities/12345678/referenced-by',
+                                     '/entities/{id}/referenced-by?schema=nonexistent'])
+    def test_raise_on_missing(self, dbsession: Session, client: TestClient, url: str):
+        response = client.get(url.format(id=self.get_default_entity(dbsession).id))
+        assert response.status_code == 404
+
+
+class TestRouteTraverse(DefaultMixin):
+    def test_traverse_entities(self, dbsession: Session, client: TestClient):
+        entities = self.get_default_entities(dbsession)
+        jack, jane = entities['Jack'], entities['Jane']
+
+        response = client.get(f'/entities/{jack.id}/traverse?direction=backward&depth=2&attribute=friends')
+        assert response.status_code == 200
+        assert response.json() == {
+            'nodes': [
+                {'id': jack.id, 'slug': 'Jack', 'name': 'Jack', 'deleted': False, 'schema': 'person', 'depth': 0},
+                {'id': jane.id, 'slug': 'Jane', 'name': 'Jane', 'deleted': False, 'schema': 'person', 'depth': 1}
+            ],
+            'edges': [{'source': jane.id, 'target': jack.id, 'attribute': 'friends'}],
+            'truncated': False
+        }
+
+    @pytest.mark.parametrize('query', ['depth=0', 'depth=1000', 'limit=0', 'direction=sideways'])
+    def test_raise_on_invalid_params(self, dbsession: Session, client: TestClient, query: str):
+        response = client.get(f'/entities/{self.get_default_entity(dbsession).id}/traverse?{query}')
+        assert response.status_code == 422
+
+    def test_raise_on_missing(self, client: TestClient):
+        response = client.get('/entities/12345678/traverse')
+        assert response.status_code == 404
+
+
+class TestRoutesReadableEntities(DefaultMixin):
+    @pytest.fixture
+    def reader(self, dbsession, mocker):
+        mocker.patch.object(settings, 'enforce_read_permissions', True)
+        user = create_user(dbsession, UserCreateSchema(username='reader', password='secret',
+                                                       email='reader@example.org'))
+        token, _ = create_access_token({'sub': user.username}, timedelta(minutes=5))
+        return {'Authorization': f'Bearer {token}'}
+
+    @staticmethod
+    def _grant(dbsession, entity_id: int):
+        grant_permission(PermissionSchema(recipient_type=RecipientType.USER,
+                                          recipient_name='reader',
+                                          obj_type=PermissionTargetType.ENTITY, obj_id=entity_id,
+                                          permission=PermissionType.READ_ENTITY), dbsession)
+
+    def test_get_entity_by_id(self, dbsession, client, reader):
+        jack = self.get_default_entity(dbsession)
+        assert client.get(f'/entities/{jack.id}').status_code == 401
+        assert client.get(f'/entities/{jack.id}', headers=reader).status_code == 404
+        self._grant(dbsession, jack.id)
+        response = client.get(f'/entities/{jack.id}', headers=reader)
+        assert response.status_code == 200 and response.json()['slug'] == 'Jack'
+
+    def test_get_referencing_entities(self, dbsession, client, reader):
+        entities = self.get_default_entities(dbsession)
+        jack, jane = entities['Jack'], entities['Jane']
+        url = f'/entities/{jack.id}/referenced-by'
+        assert client.get(url, headers=reader).status_code == 404
+
+        self._grant(dbsession, jack.id)
+        response = client.get(url, headers=reader)
+        assert response.status_code == 200 and response.json()['total'] == 0
+
+        self._grant(dbsession, jane.id)
+        response = client.get(url, headers=reader)
+        assert [i['slug'] for i in response.json()['items']] == ['Jane']
+
+    def test_traverse_entities(self, dbsession, client, reader):
+        entities = self.get_default_entities(dbsession)
+        jack, jane = entities['Jack'], entities['Jane']
+        url = f'/entities/{jack.id}/traverse?direction=backward'
+        assert client.get(url, headers=reader).status_code == 404
+
+        self._grant(dbsession, jack.id)
+        response = client.get(url, headers=reader).json()
+        assert [i['slug'] for i in response['nodes']] == ['Jack'] and response['edges'] == []
+
+        self._grant(dbsession, jane.id)
+        response = client.get(url, headers=reader).json()
+        assert [i['slug'] for i in response['nodes']] == ['Jack', 'Jane']
+        assert response['edges'] == [{'source': jane.id, 'target': jack.id, 'attribute': 'friends'}]
+
+
 class TestTraceabilityRoutes(DefaultMixin):
     def test_review_changes(self, dbsession: Session, authorized_client: TestClient,
                             testuser: User):
@@ -779,6 +908,24 @@ class TestTraceabilityRoutes(DefaultMixin):
         assert json['status'] == 'DECLINED'
         assert json['comment'] == 'test2'
 
+    def test_review_changes_batch(self, dbsession: Session, authorized_client: TestClient,
+                                  testuser: User):
+        entity = self.get_default_entity(dbsession)
+        change_request = create_entity_update_request(
+            db=dbsession, id_or_slug=entity.id, schema_id=entity.schema_id, data={'age': 20},
+            created_by=testuser
+        )
+        review = {'result': 'DECLINE', 'comment': 'test', 'ids': [change_request.id, 23456]}
+        response = authorized_client.post('/changes/review', json=review)
+        assert response.status_code == 200
+        first, second = response.json()
+        assert first['status_code'] == 200 and first['change_request']['status'] == 'DECLINED'
+        assert second == {'id': 23456, 'status_code': 404, 'change_request': None,
+                          'detail': second['detail']}
+
+        response = authorized_client.post('/changes/review', json={**review, 'ids': []})
+        assert response.status_code == 422
+
     def test_raise_on_change_doesnt_exist(self, dbsession: Session, authorized_client: TestClient):
         review = {
             'result': 'APPROVE',
@@ -0,0 +1,118 @@
+import asyncio
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import text
+
+from .. import config, create_app, crud
+from ..database import get_db
+from ..instrumentation import count_queries, budget_violations, slow_queries, _explain
+
+from .conftest import OldStyleTestClient
+from .mixins import DefaultMixin
+
+
+class TestInstrumentation(DefaultMixin):
+    def test_count_queries(self, dbsession):
+        with count_queries() as stats:
+            crud.get_schemas(dbsession)
+            crud.get_attributes(dbsession)
+        assert stats.queries == 2
+        assert stats.db_time > 0
+
+        async def in_thread():
+            with count_queries() as stats:
+                await run_in_threadpool(crud.get_schemas, dbsession)
+            return stats
+
+        assert asyncio.run(in_thread()).queries == 1
+
+    def test_server_timing(self, dbsession, client):
+        response = client.get('/schema')
+        db, app = response.headers['server-timing'].split(', ')
+        assert db.startswith('db;dur=') and db.endswith(';desc="1 queries"')
+        assert app.startswith('app;dur=')
+
+    def test_metrics(self, dbsession, mocker):
+        mocker.patch.object(config.settings, 'metrics_endpoint', True)
+        app = create_app(session=dbsession)
+        app.dependency_overrides[get_db] = lambda: dbsession
+        client = OldStyleTestClient(app)
+        client.get('/schema')
+        client.get('/entity/person/12345678')
+        response = client.get('/metrics')
+        assert response.status_code == 200
+        lines = response.text.splitlines()
+        assert '# TYPE aimaas_requests_total counter' in lines
+        assert any(i.startswith('aimaas_requests_total{method="GET",route="/schema",status="200"} ')
+                   for i in lines)
+        assert any(i.startswith('aimaas_request_queries_total{method="GET",'
+                                'route="/entity/person/{id_or_slug}",status="404"} ')
+                   for i in lines)
+
+    def test_metrics_endpoint_off(self, dbsession, client):
+        assert client.get('/metrics').status_code == 404
+
+    def test_query_budget(self, dbsession, client, mocker):
+        route = next(i for i in client.app.routes if getattr(i, 'path', None) == '/schema'
+                     and 'GET' in i.methods)
+        mocker.patch.object(route.endpoint, 'query_budget', 0)
+        client.get('/schema')
+        assert list(budget_violations) == ['GET /schema executed 1 SQL statements, budget is 0']
+        budget_violations.clear()
+
+    def test_entity_query_budget(self, dbsession, authorized_client, mocker):
+        route = next(i for i in authorized_client.app.routes
+                     if getattr(i, 'path', None) == '/entity/person' and 'GET' in i.methods)
+        assert route.endpoint.query_budget > 1
+        mocker.patch.object(route.endpoint, 'query_budget', 1)
+        response = authorized_client.get('/entity/person')
+        assert response.status_code == 200
+        assert len(budget_violations) == 1
+        assert budget_violations[0].startswith('GET /entity/person executed ')
+        assert budget_violations[0].endswith(' SQL statements, budget is 1')
+        budget_violations.clear()
+
+    def test_slow_queries(self, dbsession, authorized_client, mocker):
+        mocker.patch.object(config.settings, 'slow_query_ms', 0.001)
+        mocker.patch.object(config.settings, 'slow_query_explain_rate', 1)
+        slow_queries.clear()
+        response = authorized_client.get('/entity/person', params={'age.gt': 10})
+        assert response.status_code == 200
+        mocker.patch.object(config.settings, 'slow_query_ms', 0)
+
+        response = authorized_client.get('/slow-queries', params={'limit': 100})
+        assert response.status_code == 200
+        queries = response.json()
+        assert queries == sorted(queries, key=lambda i: i['total_ms'], reverse=True)
+        entity_queries = [i for i in queries if 'values_int' in i['statement']]
+        assert entity_queries
+        for query in entity_queries:
+            assert query['route'] == 'GET /entity/person'
+            assert query['schema'] == 'person'
+            assert query['count'] >= 1 and query['max_ms'] <= query['total_ms']
+        assert any('10' in i['parameters'] and 'Buffers' in (i['explain'] or '')
+                   for i in entity_queries)
+        slow_queries.clear()
+
+    def test_slow_queries_log_size(self, dbsession, mocker):
+        mocker.patch.object(config.settings, 'slow_query_log_size', 2)
+        slow_queries.clear()
+        for statement, duration in (('a', 3), ('b', 1), ('c', 2), ('a', 1)):
+            slow_queries.record(statement, duration, '{}', None, None, None)
+        assert [(i.statement, i.count, i.total_ms) for i in slow_queries.top()] == \
+            [('a', 2, 4), ('c', 1, 2)]
+        slow_queries.clear()
+
+    def test_explain_failure_keeps_transaction(self, dbsession):
+        dbsession.execute(text("update entities set name = 'Renamed' where slug = 'Jack'"))
+        dbapi_connection = dbsession.connection().connection.dbapi_connection
+        with dbapi_connection.cursor() as cursor:
+            assert _explain(cursor, 'select * from missing_table', {}) is None
+            plan = _explain(cursor, 'select * from entities where slug = %(slug)s', {'slug': 'Jack'})
+            assert 'rows=1 ' in plan and 'Buffers' in plan
+        assert dbsession.execute(text("select name from entities where slug = 'Jack'")).scalar() \
+            == 'Renamed'
+        dbsession.rollback()
+
+    def test_slow_queries_permission(self, dbsession, client):
+        assert client.get('/slow-queries').status_code == 401
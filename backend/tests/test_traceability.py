@@ -2,18 +2,23 @@ from datetime import datetime
 from itertools import chain
 
 from fastapi_pagination import Params
+from fastapi import HTTPException
 import pytest
 from sqlalchemy import select, update
 from sqlalchemy.orm import Session
 
 from ..auth.models import User
 from ..schemas.traceability import ChangeReviewSchema
-from ..traceability.crud import decline_change_request, review_changes, get_pending_change_requests
+from ..traceability import crud as traceability_crud
+from ..traceability.crud import decline_change_request, review_changes, get_pending_change_requests, \
+    review_changes_batch, get_reviewable_request_ids, is_user_authorized_to_review
+from ..traceability.entity import create_entity_update_request, create_entity_delete_request
+from ..traceability.schema import create_schema_delete_request
 from ..traceability.enum import ChangeType, ContentType, EditableObjectType, ChangeStatus, \
     ReviewResult
 from ..traceability.models import ChangeRequest, Change, ChangeAttrType, ChangeValueStr
 
-from .mixins import DefaultMixin
+from .mixins import DefaultMixin, CreateMixin
 
 
 class TestReview(DefaultMixin):
@@ -130,6 +135,62 @@ class TestReview(DefaultMixin):
         assert change_request.reviewed_at >= change_request.created_at
         assert change_request.reviewed_by == user
 
+    def test_review_changes_batch(self, dbsession: Session):
+        user = dbsession.execute(select(User)).scalar()
+        entities = self.get_default_entities(dbsession)
+        jack, jane = entities['Jack'], entities['Jane']
+        requests = [
+            create_entity_update_request(dbsession, id_or_slug=e.id, schema_id=e.schema_id,
+                                         data={'nickname': 'same'}, created_by=user)
+            for e in (jack, jane)
+        ]
+        ids = [requests[0].id, requests[1].id, requests[0].id, 23456]
+        results = review_changes_batch(dbsession, change_request_ids=ids,
+                                       review=ChangeReviewSchema(result=ReviewResult.APPROVE),
+                                       reviewed_by=user)
+        assert [(i['id'], i['status_code']) for i in results] == [
+            (requests[0].id, 200), (requests[1].id, 409), (23456, 404)
+        ]
+        assert results[0]['change_request'].status == ChangeStatus.APPROVED
+        assert results[1]['change_request'].status == ChangeStatus.PENDING
+        assert 'detail' in results[1] and 'detail' in results[2]
+        # only the failed request was rolled back
+        dbsession.expire_all()
+        assert jack.get('nickname', dbsession).value == 'same'
+        assert jane.get('nickname', dbsession).value == 'jane'
+
+        results = review_changes_batch(dbsession, change_request_ids=[requests[0].id],
+                                       review=ChangeReviewSchema(result=ReviewResult.DECLINE),
+                                       reviewed_by=user)
+        assert results[0]['status_code'] == 208
+
+    def test_review_changes_batch_unexpected_error(self, dbsession: Session, mocker):
+        user = dbsession.execute(select(User)).scalar()
+        entities = self.get_default_entities(dbsession)
+        requests = [
+            create_entity_update_request(dbsession, id_or_slug=e.id, schema_id=e.schema_id,
+                                         data={'nickname': 'new'}, created_by=user)
+            for e in (entities['Jack'], entities['Jane'])
+        ]
+        reviewers = []
+
+        def review(db, change_request_id, review, reviewed_by):
+            reviewers.append((reviewed_by.id, reviewed_by in db))
+            if len(reviewers) == 1:
+                raise RuntimeError('boom')
+            return requests[1], True
+
+        mocker.patch.object(traceability_crud, 'review_changes', side_effect=review)
+        results = review_changes_batch(dbsession, change_request_ids=[r.id for r in requests],
+                                       review=ChangeReviewSchema(result=ReviewResult.APPROVE),
+                                       reviewed_by=user)
+        assert [(i['id'], i['status_code']) for i in results] == [
+            (requests[0].id, 500), (requests[1].id, 200)
+        ]
+        assert 'boom' not in results[0]['detail']
+        # reviewer is attached to the session of each request
+        assert reviewers == [(user.id, True), (user.id, True)]
+
     def test_get_pending_change_requests(self, dbsession: Session):
         # 10 requests, 9 UPD, 1 CREATE
         schema_requests = dbsession.query(ChangeRequest)\
@@ -154,3 +215,34 @@ class TestReview(DefaultMixin):
         # no limit, all types
         requests = get_pending_change_requests(dbsession)
         assert requests.total == 0
+
+
+class TestReviewPermissions(CreateMixin):
+    def test_get_reviewable_request_ids(self, dbsession: Session):
+        user, _, _ = self._create_user_group_with_perm(dbsession)
+        superuser = dbsession.execute(select(User).where(User.username == 'tester')).scalar()
+        entities = self.get_default_entities(dbsession)
+        jack, jane = entities['Jack'], entities['Jane']
+        requests = [
+            create_entity_update_request(dbsession, id_or_slug=jane.id, schema_id=jane.schema_id,
+                                         data={'age': 20}, created_by=superuser),
+            create_entity_delete_request(dbsession, id_or_slug=jack.id, schema_id=jack.schema_id,
+                                         created_by=superuser),
+            create_entity_delete_request(dbsession, id_or_slug=jane.id, schema_id=jane.schema_id,
+                                         created_by=superuser),
+            create_schema_delete_request(dbsession, id_or_slug=jack.schema_id,
+                                         created_by=superuser),
+        ]
+
+        reviewable = get_reviewable_request_ids(dbsession, user=user, requests=requests)
+        assert reviewable == {requests[0].id, requests[1].id}
+        for request in requests:
+            try:
+                is_user_authorized_to_review(dbsession, user=user, request_id=request.id)
+            except HTTPException:
+                assert request.id not in reviewable
+            else:
+                assert request.id in reviewable
+
+        assert get_reviewable_request_ids(dbsession, user=superuser, requests=requests) \
+            == {i.id for i in requests}
@@ -1,3 +1,4 @@
+import logging
 import typing
 from datetime import datetime, timezone
 from typing import Optional, List
@@ -5,15 +6,18 @@ from typing import Optional, List
 from fastapi.exceptions import HTTPException
 from fastapi_pagination import Params, Page
 from fastapi_pagination.ext.sqlalchemy import paginate
+from pydantic import ValidationError
 from sqlalchemy import select, desc
-from sqlalchemy.exc import NoResultFound
+from sqlalchemy.exc import NoResultFound, IntegrityError
 from sqlalchemy.orm import Session
-from starlette.status import HTTP_403_FORBIDDEN
+from starlette.status import HTTP_200_OK, HTTP_208_ALREADY_REPORTED, HTTP_403_FORBIDDEN, \
+    HTTP_404_NOT_FOUND, HTTP_409_CONFLICT, HTTP_500_INTERNAL_SERVER_ERROR
 
+from .. import exceptions
 from ..config import DEFAULT_PARAMS
 from ..exceptions import MissingChangeException, MissingChangeRequestException
-from ..auth.crud import has_permission
-from ..auth.enum import PermissionType
+from ..auth.crud import has_permission, get_granted_permissions
+from ..auth.enum import PermissionType, PermissionTargetType
 from ..auth.models import User
 from ..models import Schema, Entity
 from ..schemas.auth import RequirePermission
@@ -27,6 +31,8 @@ from .schema import apply_schema_create_request, apply_schema_update_request, \
     apply_schema_delete_request
 
 
+logger = logging.getLogger(__name__)
+
 REQUIRED_PERMISSIONS = {
     (EditableObjectType.SCHEMA, ChangeType.CREATE): (PermissionType.CREATE_SCHEMA, Schema),
     (EditableObjectType.SCHEMA, ChangeType.UPDATE): (PermissionType.UPDATE_SCHEMA, Schema),
@@ -60,6 +66,48 @@ def is_user_authorized_to_review(db: Session, user: User, request_id: int) -> No
                             detail="You are not authorized for this action")
 
 
+def get_reviewable_request_ids(db: Session, user: User,
+                               requests: typing.Iterable[ChangeRequest]) -> typing.Set[int]:
+    '''Returns IDs of `requests` that `user` is authorized to review. Same as calling
+    `is_user_authorized_to_review` for each request, but with a fixed number of queries
+    '''
+    requests = list(requests)
+    create_request_ids = [r.id for r in requests
+                          if (r.object_type, r.change_type) == (EditableObjectType.ENTITY,
+                                                                ChangeType.CREATE)]
+    schema_ids = dict(db.execute(
+        select(Change.change_request_id, ChangeValueInt.new_value)
+        .join(ChangeValueInt, ChangeValueInt.id == Change.value_id)
+        .where(Change.change_request_id.in_(create_request_ids), Change.field_name == "schema_id")
+    ).all()) if create_request_ids else {}
+    entity_ids = [r.object_id for r in requests if r.object_type == EditableObjectType.ENTITY]
+    entity_schema_ids = dict(db.execute(
+        select(Entity.id, Entity.schema_id).where(Entity.id.in_(entity_ids))
+    ).all()) if entity_ids else {}
+    granted = get_granted_permissions(db=db, user=user,
+                                      permissions={p for p, _ in REQUIRED_PERMISSIONS.values()})
+
+    reviewable = set()
+    for request in requests:
+        required = REQUIRED_PERMISSIONS.get((request.object_type, request.change_type))
+        if required is None:
+            continue
+        req_perm, Model = required
+        if request.object_type == EditableObjectType.ENTITY \
+                and request.change_type == ChangeType.CREATE:
+            target = (PermissionTargetType.SCHEMA, schema_ids.get(request.id))
+        else:
+            target = (PermissionTargetType[Model.__name__.upper()], request.object_id)
+        targets = {target}
+        if Model is Entity:
+            targets.add((PermissionTargetType.SCHEMA, entity_schema_ids.get(request.object_id)))
+        if any(perm in (req_perm, PermissionType.SUPERUSER)
+               and (obj_id is None or (obj_type, obj_id) in targets)
+               for perm, obj_type, obj_id in granted):
+            reviewable.add(request.id)
+    return reviewable
+
+
 def get_change_request(db: Session, request_id: int) -> ChangeRequest:
     try:
         return db.query(ChangeRequest).filter(ChangeRequest.id == request_id).one()
@@ -132,3 +180,74 @@ def get_pending_change_requests(db: Session, params: Params = DEFAULT_PARAMS,
         q = q.filter(ChangeRequest.object_type == obj_type)
 
     return paginate(q, params)
+
+
+# Errors of a change request, which can't be applied to the current data anymore
+REVIEW_CONFLICT_ERRORS = (
+    exceptions.SchemaExistsException,
+    exceptions.EntityExistsException,
+    exceptions.DeletedObjectException,
+    exceptions.BaseAttributeException,
+    exceptions.UniqueValueException,
+    exceptions.RequiredFieldException,
+    exceptions.ListedToUnlistedException,
+    exceptions.MultipleAttributeOccurencesException,
+    exceptions.MismatchingSchemaException,
+    exceptions.NoOpChangeException,
+    ValidationError,
+    IntegrityError,
+)
+
+
+def review_changes_batch(db: Session, change_request_ids: typing.List[int],
+                         review: ChangeReviewSchema, reviewed_by: User) -> typing.List[dict]:
+    '''Reviews change requests in one transaction and returns result for each of them.
+    Every request is reviewed in a savepoint, so a request that fails is rolled back and
+    reported without affecting the others
+    '''
+    change_request_ids = list(dict.fromkeys(change_request_ids))
+    requests = {r.id: r for r in db.query(ChangeRequest)
+                                   .filter(ChangeRequest.id.in_(change_request_ids))}
+    reviewable = get_reviewable_request_ids(db=db, user=reviewed_by, requests=requests.values())
+    reviewer = db.get(User, reviewed_by.id)
+
+    connection = db.connection()
+    results = []
+    for request_id in change_request_ids:
+        result = {'id': request_id}
+        results.append(result)
+        if request_id not in requests:
+            result.update(status_code=HTTP_404_NOT_FOUND,
+                          detail=str(MissingChangeRequestException(obj_id=request_id)))
+            continue
+        if request_id not in reviewable:
+            result.update(status_code=HTTP_403_FORBIDDEN,
+                          detail="You are not authorized for this action")
+            continue
+
+        # `commit` and `rollback` of this session only release or roll back its savepoint
+        with Session(bind=connection, join_transaction_mode='create_savepoint',
+                     autoflush=db.autoflush, info={'parent_session': db}) as item_db:
+            try:
+                _, changed = review_changes(db=item_db, change_request_id=request_id,
+                                            review=review,
+                                            reviewed_by=item_db.merge(reviewer, load=False))
+            except exceptions.MissingObjectException as e:
+                item_db.rollback()
+                result.update(status_code=HTTP_404_NOT_FOUND, detail=str(e))
+            except REVIEW_CONFLICT_ERRORS as e:
+                item_db.rollback()
+                result.update(status_code=HTTP_409_CONFLICT, detail=str(e))
+            except Exception:
+                item_db.rollback()
+                logger.exception('Review of change request %s failed', request_id)
+                result.update(status_code=HTTP_500_INTERNAL_SERVER_ERROR,
+                              detail='Internal Server Error')
+            else:
+                result['status_code'] = HTTP_200_OK if changed else HTTP_208_ALREADY_REPORTED
+    db.commit()
+
+    for result in results:
+        if result['id'] in requests:
+            result['change_request'] = requests[result['id']]
+    return results
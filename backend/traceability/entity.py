@@ -128,7 +128,8 @@ def entity_change_details(db: Session, change_request_id: int) -> EntityChangeDe
     for change in entity_changes:
         _fill_in_entity_change(change=change_, entity_change=change, entity=entity, db=db)
 
-    attr_defs = {attr_def.attribute_id: attr_def for attr_def in entity.schema.attr_defs}
+    schema = crud.get_schema(db=db, id_or_slug=entity.schema_id)
+    attr_defs = {attr_def.attribute_id: attr_def for attr_def in schema.attr_defs}
     for attr_id, changes in groupby(fields_changes, key=lambda x: x.attribute_id):
         _changes = list(changes)
         ValueModel = _changes[0].data_type.value.model
@@ -426,7 +427,8 @@ def apply_entity_update_request(db: Session, change_request: ChangeRequest, revi
         raise MissingEntityUpdateRequestException(obj_id=change_request.id)
 
     entity = crud.get_entity_by_id(db=db, entity_id=change_request.object_id)
-    attr_defs = {attr_def.attribute_id: attr_def for attr_def in entity.schema.attr_defs}
+    schema = crud.get_schema(db=db, id_or_slug=entity.schema_id)
+    attr_defs = {attr_def.attribute_id: attr_def for attr_def in schema.attr_defs}
 
     single_changes = []
     listed_changes = defaultdict(list)
@@ -458,7 +460,7 @@ def apply_entity_update_request(db: Session, change_request: ChangeRequest, revi
         data[attr_name] = [i.new_value for i in values if i.new_value is not None]
 
     factory = EntityModelFactory()
-    UpdateModel = factory(schema=entity.schema, variant=ModelVariant.UPDATE)
+    UpdateModel = factory(schema=schema, variant=ModelVariant.UPDATE)
     entity = crud.update_entity(
         db=db, 
         id_or_slug=entity.id, 